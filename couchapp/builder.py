@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Build the documents of many couchapps in a pool of processes. Building
+a document (decoding fields, macros, hashing and encoding attachments)
+is CPU bound, so threads don't help but processes do. Documents come
+back to the caller pickled, in the order of the folders.
+"""
+
+import collections
+import itertools
+import logging
+import pickle
+import traceback
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from couchapp.errors import AppError
+from couchapp.localdoc import document
+
+logger = logging.getLogger(__name__)
+
+
+def build_doc(args):
+    """ build the document of the folder `path` and return (doc, None)
+    or (None, (error, traceback)) if it failed. """
+    path, with_attachments = args
+    try:
+        doc = document(path)
+        doc.doc(with_attachments=with_attachments)
+        return doc, None
+    except Exception, e:
+        tb = traceback.format_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = AppError("can't build %s: %s" % (path, e))
+        return None, (e, tb)
+
+
+def process_pool(workers):
+    """ return a pool of `workers` processes which can be given to
+    several calls of `build`, or None if documents are built in this
+    process. The caller terminates the pool. """
+    if workers <= 1 or multiprocessing is None:
+        return None
+    return multiprocessing.Pool(workers)
+
+
+def build(paths, workers=1, with_attachments=True, lazy=True, pool=None):
+    """ yield the `LocalDoc` of each folder of `paths`, in order.
+    Documents are built by `workers` processes, an error is raised
+    again when the document in error would have been returned. At most
+    twice `workers` documents are built ahead of the caller.
+
+    :attr paths: list of couchapp folders
+    :attr workers: int, number of processes. With one worker or one
+    folder, and no `pool`, documents are built in this process with
+    `workers` threads for the attachments.
+    :attr with_attachments: if False only signatures of attachments are
+    computed, like `LocalDoc.doc`.
+    :attr lazy: with one worker, documents are built by the caller when
+    used. If False they are built before being returned, without
+    encoding attachments.
+    :attr pool: pool of `workers` processes (see `process_pool`) used
+    instead of a new one. It isn't terminated by `build`.
+    """
+    paths = list(paths)
+    if pool is None and (workers <= 1 or len(paths) <= 1 or 
+            multiprocessing is None):
+        for path in paths:
+            doc = document(path, workers=workers)
+            if not lazy:
+                doc.doc(with_attachments=False)
+            yield doc
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(min(workers, len(paths)))
+    try:
+        pending = collections.deque()
+        paths = iter(paths)
+        while True:
+            for path in itertools.islice(paths, 2 * workers - len(pending)):
+                pending.append((path, pool.apply_async(build_doc,
+                                            [(path, with_attachments)])))
+            if not pending:
+                break
+            path, result = pending.popleft()
+            doc, error = result.get()
+            if error is not None:
+                e, tb = error
+                logger.debug("error building %s:\n%s" % (path, tb))
+                raise e
+            yield doc
+    finally:
+        if own_pool:
+            pool.terminate()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Persistent caches stored in the `.couchapp/cache` folder of a couchapp.
+
+Entries are keyed by the path of the file relative to the application
+folder and are only reused while the size, mtime and inode of the file
+are unchanged.
+"""
+
+from __future__ import with_statement
+
+import copy
+import logging
+import os
+import threading
+
+from couchapp import util
+
+CACHE_DIR = os.path.join('.couchapp', 'cache')
+
+logger = logging.getLogger(__name__)
+
+
+def stat_key(st):
+    """ return the signature of a stat result used to detect changes
+
+    :attr st: result of `os.stat`
+
+    :return: list, [size, mtime in nanoseconds, inode]
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class FileCache(object):
+    """ on-disk cache of values computed from the files of a couchapp """
+
+    version = 1
+
+    def __init__(self, appdir, name):
+        self.appdir = appdir
+        self.name = name
+        self.path = os.path.join(appdir, CACHE_DIR, "%s.json" % name)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._used = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def __repr__(self):
+        return "<%s (%s)>" % (self.__class__.__name__, self.path)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        data = util.read_json(self.path)
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.entries = data.get('entries', {})
+
+    def _key(self, fpath):
+        return util.relpath(fpath, self.appdir).replace(os.sep, '/')
+
+    def get(self, fpath, st=None, default=None):
+        """ return the cached value for `fpath` or `default` if the file
+        changed since it was cached. """
+        if st is None:
+            st = os.stat(fpath)
+        key = self._key(fpath)
+        with self._lock:
+            self._used.add(key)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stat_key(st):
+                self.misses += 1
+                return default
+            self.hits += 1
+        value = entry[1]
+        if isinstance(value, (dict, list)):
+            # callers are free to modify what they get
+            value = copy.deepcopy(value)
+        return value
+
+    def set(self, fpath, value, st=None):
+        if st is None:
+            st = os.stat(fpath)
+        key = self._key(fpath)
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._used.add(key)
+            self.entries[key] = [stat_key(st), value]
+            self._dirty = True
+
+    def prune(self):
+        """ remove entries not used since the cache was loaded """
+        with self._lock:
+            for key in list(self.entries.keys()):
+                if key not in self._used:
+                    del self.entries[key]
+                    self._dirty = True
+
+    def save(self):
+        logger.debug("%s cache: %s hits, %s misses" % (self.name, self.hits,
+                                                        self.misses))
+        self.hits = self.misses = 0
+        if not self._dirty:
+            return
+        cachedir = os.path.dirname(self.path)
+        tmpfile = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            with self._lock:
+                util.write_json(tmpfile, {
+                    'version': self.version,
+                    'entries': self.entries
+                })
+                self._dirty = False
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError), e:
+            logger.warning("can't save %s cache: %s" % (self.name, e))
+
+
+class SignatureCache(FileCache):
+    """ cache of the md5 signatures of attachments """
+
+    def __init__(self, appdir):
+        FileCache.__init__(self, appdir, 'signatures')
+
+    def sign(self, fpath, st=None):
+        """ like `util.sign` but only hash the file if it changed since
+        its signature was cached. """
+        if st is None:
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                return ''
+        signature = self.get(fpath, st)
+        if signature is None:
+            signature = util.sign(fpath)
+            if isinstance(signature, basestring):
+                self.set(fpath, signature, st)
+        return signature
+
+
+def clear(appdir):
+    """ remove all caches of the couchapp in `appdir` """
+    cachedir = os.path.join(appdir, CACHE_DIR)
+    if os.path.isdir(cachedir):
+        util.deltree(cachedir)
@@ -5,9 +5,12 @@
 
 from __future__ import with_statement
 import base64
+import binascii
 import itertools
-import re
+import os
+import threading
 import types
+import uuid
 
 from couchapp import __version__
 from couchapp.errors import ResourceNotFound, ResourceConflict,\
@@ -16,6 +19,7 @@ InvalidAttachment
 from couchapp.restkit import Resource, HttpResponse, ResourceError, request
 from couchapp.restkit import util
 import couchapp.simplejson as json
+from couchapp.util import prefetch
 
 USER_AGENT = "couchapp/%s" % __version__
 
@@ -26,6 +30,17 @@ aliases = {
 
 UNKNOWN_VERSION = tuple()
 
+# size of the blocks read from attachments files when the document is
+# streamed. Must be a multiple of 3 so blocks can be base64-encoded
+# separately.
+STREAM_BLOCK_SIZE = 3 * 16 * 1024
+
+# first CouchDB version accepting documents sent as multipart/related 
+MULTIPART_MIN_VERSION = (1, 1)
+
+# number of documents sent in a _bulk_docs request by default
+BULK_BATCH_SIZE = 1000
+
 class CouchdbResponse(HttpResponse):
     
     @property
@@ -121,8 +136,8 @@ class CouchdbResource(Resource):
         except Exception, e:
             raise RequestFailed("unknown error [%s]" % str(e))
                
-def couchdb_version(server_uri):
-    res = CouchdbResource(server_uri)
+def couchdb_version(server_uri, **client_opts):
+    res = CouchdbResource(server_uri, **client_opts)
     
     try:
         resp = res.get()
@@ -139,6 +154,27 @@ def couchdb_version(server_uri):
     
     return tuple(t)   
 
+# versions of servers by uri, kept for the life of the process
+_server_versions = {}
+_server_versions_lock = threading.Lock()
+
+def server_version(server_uri, **client_opts):
+    """ like `couchdb_version` but the version of a server is only
+    fetched once. """
+    with _server_versions_lock:
+        version = _server_versions.get(server_uri)
+    if version is None:
+        version = couchdb_version(server_uri, **client_opts)
+        if version != UNKNOWN_VERSION:
+            with _server_versions_lock:
+                _server_versions[server_uri] = version
+    return version
+
+def all_dbs(server_uri, **client_opts):
+    """ return the list of database names of a server """
+    res = CouchdbResource(server_uri, **client_opts)
+    return res.get('/_all_dbs').json_body
+
 class Uuids(CouchdbResource):
     
     def __init__(self, uri, max_uuids=1000, **client_opts):
@@ -165,21 +201,77 @@ class Database(CouchdbResource):
     A Database object can act as a Dict object.
     """
     
-    def __init__(self, uri, **client_opts):
-        CouchdbResource.__init__(self, uri=uri, **client_opts)
-        self.server_uri, self.dbname = uri.rsplit('/', 1)
-        
-        self.uuids = Uuids(self.server_uri)
-        self.version = couchdb_version(self.server_uri)
+    def __init__(self, uri, create=True, version=None, **client_opts):
+        """ No request is made until the database is used.
         
+        @param uri: str, full uri of the database
+        @param create: boolean, create the database on the first write
+        if it doesn't exist
+        @param version: tuple, version of the server if already known
+        """
+        CouchdbResource.__init__(self, uri=uri, **client_opts)
         if self.uri.endswith("/"):
             self.uri = self.uri[:-1]
+        self.server_uri, self.dbname = self.uri.rsplit('/', 1)
         
-        # create the db
+        self.create = create
+        self._version = version
+        self._uuids = None
+        self._exists = False
+        self._lock = threading.Lock()
+        
+    @property
+    def version(self):
+        """ version of the server, fetched once per server """
+        if self._version is None:
+            self._version = server_version(self.server_uri, 
+                                           **self.client_opts)
+        return self._version
+        
+    @property
+    def uuids(self):
+        """ uuids of the server, fetched when a document without id is
+        saved """
+        if self._uuids is None:
+            self._uuids = Uuids(self.server_uri, **self.client_opts)
+        return self._uuids
+        
+    def ensure_db(self):
+        """ create the database if it doesn't exist. Only checked
+        once. """
+        with self._lock:
+            if self._exists:
+                return
+            try:
+                self.head()
+            except ResourceNotFound:
+                try:
+                    self.put()
+                except PreconditionFailed:
+                    # created in the meantime
+                    pass
+            self._exists = True
+            
+    def request(self, method, path=None, payload=None, headers=None, 
+            **params):
+        if self.create and not self._exists and path and \
+                method in ('PUT', 'POST', 'COPY'):
+            self.ensure_db()
         try:
-            self.head()
-        except ResourceNotFound:
-            self.put()
+            resp = CouchdbResource.request(self, method, path=path, 
+                    payload=payload, headers=headers, **params)
+        except ResourceNotFound, e:
+            # a missing document means the database exists
+            if path and str(e) in ('missing', 'deleted'):
+                self._exists = True
+            raise
+        self._exists = True
+        return resp
+        
+    def accepts_multipart(self):
+        """ return True if the server accepts documents sent with their
+        attachments as a multipart/related request. """
+        return self.version >= MULTIPART_MIN_VERSION
         
     def info(self):
         """
@@ -219,7 +311,8 @@ class Database(CouchdbResource):
             return wrapper(resp.json_body)
         return resp.json_body
         
-    def save_doc(self, doc, encode=False, force_update=False, **params):
+    def save_doc(self, doc, encode=False, force_update=False, 
+            attachments=None, multipart=False, **params):
         """ Save a document. It will use the `_id` member of the document
         or request a new uuid from CouchDB. IDs are attached to
         documents on the client side because POST has the curious property of
@@ -232,6 +325,13 @@ class Database(CouchdbResource):
         @param force_update: boolean, if there is conlict, try to update
         with latest revision
         @param encode: Encode attachments if needed (depends on couchdb version)
+        @param attachments: list of (name, filepath, content_type) tuples.
+        If set, files are read and base64-encoded while the document is
+        sent using chunked transfer encoding, so the document is never
+        fully serialized in memory.
+        @param multipart: boolean, if True `attachments` are sent raw
+        after the document in a multipart/related request (see 
+        `accepts_multipart`).
 
         @return: new doc with updated revision an id
         """  
@@ -239,26 +339,43 @@ class Database(CouchdbResource):
             doc['_attachments'] = encode_attachments(doc['_attachments'])
             
         headers = params.get('headers', {})
-        headers.setdefault('Content-Type', 'application/json')
+        if attachments is None:
+            headers.setdefault('Content-Type', 'application/json')
+        elif multipart:
+            boundary = uuid.uuid4().hex
+            headers['Content-Type'] = \
+                    'multipart/related; boundary="%s"' % boundary
+        else:
+            headers.setdefault('Content-Type', 'application/json')
+            headers['Transfer-Encoding'] = 'chunked'
         params['headers'] = headers
         
+        def payload():
+            if attachments is None:
+                return encode_doc(doc)
+            elif multipart:
+                body, length = multipart_doc(doc, attachments, boundary)
+                headers['Content-Length'] = str(length)
+                return body
+            return iter_json_doc(doc, attachments)
+        
         if '_id' in doc:
             docid = escape_docid(doc['_id'])
             try:
-                resp = self.put(docid, payload=json.dumps(doc), **params)
+                resp = self.put(docid, payload=payload(), **params)
             except ResourceConflict:
                 if not force_update:
                     raise
                 rev = self.last_rev(doc['_id'])
                 doc['_rev'] = rev
-                resp = self.put(docid, payload=json.dumps(doc), **params)
+                resp = self.put(docid, payload=payload(), **params)
         else:
-            json_doc = json.dumps(doc)
             try:
                 doc['_id'] = self.uuids.next()
-                resp = self.put(doc['_id'], payload=json_doc, **params)
+                resp = self.put(doc['_id'], payload=payload(), **params)
             except ResourceConflict:
-                resp = self.post(payload=json_doc, **params)
+                del doc['_id']
+                resp = self.post(payload=payload(), **params)
             
         json_res = resp.json_body
         doc1 = {}
@@ -277,6 +394,29 @@ class Database(CouchdbResource):
         r = self.get(escape_docid(docid))
         return r.json_body["_rev"].strip('"')
         
+    def last_revs(self, docids, batch_size=1000):
+        """ Get last revisions of many documents with `POST _all_docs`
+        requests of `batch_size` keys.
+        
+        @param docids: iterable of document ids
+        @param batch_size: int, number of ids sent in a request
+        
+        @return: dict, revision of each document by id. Missing and
+        deleted documents aren't included.
+        """
+        revs = {}
+        docids = list(docids)
+        for i in range(0, len(docids), batch_size):
+            keys = docids[i:i + batch_size]
+            resp = self.post('/_all_docs', payload=json.dumps({"keys": keys}),
+                        headers={'Content-Type': 'application/json'})
+            for row in resp.json_body.get('rows', []):
+                value = row.get('value')
+                if 'error' in row or not value or value.get('deleted'):
+                    continue
+                revs[row['id']] = value['rev']
+        return revs
+        
     def delete_doc(self, id_or_doc):
         """ Delete a document
         @param id_or_doc: docid string or document dict
@@ -294,19 +434,27 @@ class Database(CouchdbResource):
             resp = self.delete(escape_docid(docid), rev=rev)
         return resp.json_body
         
-    def save_docs(self, docs, all_or_nothing=False, use_uuids=True):
+    def save_docs(self, docs, all_or_nothing=False, use_uuids=True,
+            batch_size=BULK_BATCH_SIZE, compress=False):
         """ Bulk save. Modify Multiple Documents With a Single Request
 
         @param docs: list of docs
         @param use_uuids: add _id in doc who don't have it already set.
+        @param batch_size: int, number of docs sent in a request. The
+        next batch is serialized while the server handles the current
+        one. None or 0 send all docs in one request, otherwise
+        all_or_nothing applies to each batch.
+        @param compress: boolean, send requests compressed with gzip.
+        Compression is done with the serialization of the batch.
         @param all_or_nothing: In the case of a power failure, when the database 
         restarts either all the changes will have been saved or none of them.
         However, it does not do conflict checking, so the documents will
+        
 
 
         @return doc lists updated with new revision or raise BulkSaveError 
         exception. You can access to doc created and docs in error as properties
-        of this exception.
+        of this exception. Errors of all batches are collected.
         """
             
         def is_id(doc):
@@ -322,26 +470,45 @@ class Database(CouchdbResource):
                 nextid = self.uuids.next()
                 if nextid:
                     doc['_id'] = nextid
-                    
-        payload = { "docs": docs }
-        if all_or_nothing:
-            payload["all-or-nothing"] = True
-            
-        # update docs
-        res = self.post('/_bulk_docs', payload=json.dumps(payload),
-                    headers={'Content-Type': 'application/json'})
-            
-        json_res = res.json_body
+
+        if not batch_size:
+            batch_size = max(1, len(docs))
+
+        def payloads():
+            for i in range(0, len(docs), batch_size):
+                # documents are serialized one by one so the JSON cached
+                # by an `EncodedDoc` is used
+                payload = '{"docs": [%s]' % ', '.join([encode_doc(doc)
+                                for doc in docs[i:i + batch_size]])
+                if all_or_nothing:
+                    payload += ', "all-or-nothing": true'
+                payload += '}'
+                if compress:
+                    payload = util.gzip_compress(payload)
+                yield i, payload
+
+        if len(docs) > batch_size:
+            batches = prefetch(payloads())
+        else:
+            batches = payloads()
+
+        headers = {'Content-Type': 'application/json'}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+
         errors = []
-        for i, r in enumerate(json_res):
-            if 'error' in r:
-                doc1 = docs[i]
-                doc1.update({'_id': r['id'], 
-                                '_rev': r['rev']})
-                errors.append(doc1)
-            else:
-                docs[i].update({'_id': r['id'], 
-                                '_rev': r['rev']})
+        for i, payload in batches:
+            # update docs
+            res = self.post('/_bulk_docs', payload=payload,
+                        headers=headers.copy())
+
+            for j, r in enumerate(res.json_body):
+                doc = docs[i + j]
+                if 'error' in r:
+                    doc.update({'_id': r['id']})
+                    errors.append(doc)
+                else:
+                    doc.update({'_id': r['id'], '_rev': r['rev']})
                                 
         if errors:
             raise BulkSaveError(docs, errors)
@@ -353,12 +520,15 @@ class Database(CouchdbResource):
         return self.save_docs(docs, all_or_nothing=all_or_nothing, 
                             use_uuids=use_uuids)
 
-    def fetch_attachment(self, id_or_doc, name, headers=None):
+    def fetch_attachment(self, id_or_doc, name, headers=None, stream=False):
         """ get attachment in a document
 
         @param id_or_doc: str or dict, doc id or document dict
         @param name: name of attachment default: default result
         @param header: optionnal headers (like range)
+        @param stream: if True the attachment is read from the socket as
+        `body_file` is read, without being spooled to memory or disk.
+        The body can't be rewound.
         
         @return: `couchdbkit.resource.CouchDBResponse` object
         """
@@ -366,8 +536,12 @@ class Database(CouchdbResource):
             docid = id_or_doc
         else:
             docid = id_or_doc['_id']
-      
-        return self.get("%s/%s" % (escape_docid(docid), name), headers=headers)
+
+        res = self
+        if stream:
+            res = CouchdbResource(self.uri, **dict(self.client_opts,
+                                                   stream=True))
+        return res.get("%s/%s" % (escape_docid(docid), name), headers=headers)
         
     def put_attachment(self, doc, content=None, name=None, headers=None):
         """ Add attachement to a document. All attachments are streamed.
@@ -378,7 +552,8 @@ class Database(CouchdbResource):
         @param headers: optionnal headers like `Content-Length` 
         or `Content-Type`
 
-        @return: updated document object
+        @return: updated document object. Only its `_rev` member is
+        updated, `_attachments` isn't fetched again.
         """
         headers = {}
         content = content or ""
@@ -395,7 +570,8 @@ class Database(CouchdbResource):
         json_res = res.json_body
         
         if 'ok' in json_res:
-            return doc.update(self.open_doc(doc['_id']))
+            doc['_rev'] = json_res['rev']
+            return doc
         return False
         
     def delete_attachment(self, doc, name):
@@ -404,12 +580,14 @@ class Database(CouchdbResource):
         @param doc: dict, document object in python
         @param name: name of attachement
 
-        @return: updated document object
+        @return: updated document object. Only its `_rev` member is
+        updated.
         """
         name = util.url_quote(name, safe="")
-        self.delete("%s/%s" % (escape_docid(doc['_id']), name), 
+        json_res = self.delete("%s/%s" % (escape_docid(doc['_id']), name), 
                         rev=doc['_rev']).json_body
-        return doc.update(self.open_doc(doc['_id']))
+        doc['_rev'] = json_res['rev']
+        return doc
         
     def view(self, view_name, **params):
         try:
@@ -420,7 +598,9 @@ class Database(CouchdbResource):
 
         if "keys" in params:
             keys = params.pop("keys")
-            return self.post(path, json.dumps({"keys": keys}, **params)).json_body
+            return self.post(path, payload=json.dumps({"keys": keys}), 
+                        headers={'Content-Type': 'application/json'},
+                        **params).json_body
 
         return self.get(path, **params).json_body
 
@@ -446,11 +626,215 @@ def escape_docid(docid):
         docid = util.url_quote(docid, safe='')
     return docid
     
+class EncodedAttachment(object):
+    """ an entry of `_attachments` serialized in JSON once. The base64
+    data is only kept in the JSON, so it can be held for several
+    databases without keeping a second copy. """
+
+    def __init__(self, data, content_type):
+        """
+        @param data: str, content of the attachment encoded in base64
+        @param content_type: str
+        """
+        self.content_type = content_type
+        # base64 data doesn't need to be escaped
+        self.json = '{"content_type": %s, "data": "%s"}' % (
+                json.dumps(content_type), data)
+
+    def __eq__(self, other):
+        return isinstance(other, EncodedAttachment) and \
+                self.json == other.json
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s (%s, %s bytes)>" % (self.__class__.__name__, 
+                self.content_type, len(self.json))
+
+# members of an `EncodedDoc` serialized apart from its cached JSON
+ENCODED_MEMBERS = ('_rev', '_attachments')
+
+class EncodedDoc(dict):
+    """ a document serialized in JSON once, used to save the same
+    document in several databases. Only `_rev` and `_attachments`
+    are serialized when the document is encoded. Entries of 
+    `_attachments` can be `EncodedAttachment`s.
+
+    Setting or removing a member other than `_rev` and `_attachments`
+    drops the cached JSON. Members must not be modified in place.
+    """
+
+    def __init__(self, doc, body):
+        """
+        @param doc: dict, members of the document
+        @param body: str, JSON of `doc` without `_rev` and `_attachments`
+        """
+        dict.__init__(self, doc)
+        self._body = body
+
+    def __setitem__(self, key, value):
+        if key not in ENCODED_MEMBERS:
+            self._body = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in ENCODED_MEMBERS:
+            self._body = None
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key not in ENCODED_MEMBERS:
+            self._body = None
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self._body = None
+        return dict.popitem(self)
+
+    def clear(self):
+        self._body = None
+        dict.clear(self)
+
+    def encoded_size(self):
+        """ return about the length of the JSON of the document, without
+        encoding it when its members are already serialized. """
+        if self._body is None:
+            return len(self.encode())
+        size = len(self._body)
+        for name, attachment in (self.get('_attachments') or {}).items():
+            if isinstance(attachment, EncodedAttachment):
+                size += len(attachment.json)
+            else:
+                size += len(json.dumps(attachment))
+        return size
+
+    def encode(self):
+        """ return the document in JSON """
+        members = []
+        if self._body is None:
+            body = json.dumps(dict([(key, value) 
+                    for key, value in self.iteritems() 
+                    if key != '_attachments']))
+        else:
+            body = self._body
+            if '_rev' in self:
+                members.append('"_rev": %s' % json.dumps(self['_rev']))
+        if body != '{}':
+            members.append(body[1:-1])
+        if '_attachments' in self:
+            entries = []
+            for name, attachment in self['_attachments'].items():
+                if isinstance(attachment, EncodedAttachment):
+                    attachment = attachment.json
+                else:
+                    attachment = json.dumps(attachment)
+                entries.append('%s: %s' % (json.dumps(name), attachment))
+            members.append('"_attachments": {%s}' % ', '.join(entries))
+        return '{%s}' % ', '.join(members)
+
+def encode_doc(doc):
+    """ serialize a document in JSON, using the cached JSON of an
+    `EncodedDoc` """
+    if isinstance(doc, EncodedDoc):
+        return doc.encode()
+    return json.dumps(doc)
+
+def iter_json_doc(doc, attachments):
+    """ serialize a document in JSON, piece by piece. Attachments are
+    read from disk and base64-encoded on the fly.
+
+    @param doc: dict, the document. Entries of its `_attachments` member
+    (usually stubs) are kept.
+    @param attachments: list of (name, filepath, content_type) tuples
+
+    @return: iterator of strings
+    """
+    doc = doc.copy()
+    stubs = doc.pop('_attachments', None) or {}
+    body = json.dumps(doc)
+    if doc:
+        pending = '%s, "_attachments": {' % body[:-1]
+    else:
+        pending = '{"_attachments": {'
+    pending += json.dumps(stubs)[1:-1]
+        
+    for i, (name, filepath, content_type) in enumerate(attachments):
+        if i > 0 or stubs:
+            pending += ', '
+        pending += '%s: {"content_type": %s, "data": "' % (json.dumps(name), 
+                                                    json.dumps(content_type))
+        with open(filepath, 'rb') as f:
+            while True:
+                data = f.read(STREAM_BLOCK_SIZE)
+                if not data:
+                    break
+                # b2a_base64 only adds a newline at the end
+                yield pending + binascii.b2a_base64(data)[:-1]
+                pending = ''
+        pending += '"}'
+    yield pending + '}}'
+        
+def multipart_doc(doc, attachments, boundary):
+    """ build the body of a multipart/related request: the document
+    in JSON followed by the raw content of each attachment.
+
+    @param doc: dict, the document. Entries of its `_attachments` member
+    (usually stubs) are kept.
+    @param attachments: list of (name, filepath, content_type) tuples
+    @param boundary: str, boundary of the parts
+
+    @return: tuple (body, length). body is an iterator of strings and
+    file objects.
+    """
+    doc = doc.copy()
+    stubs = []
+    for name, stub in (doc.pop('_attachments', None) or {}).items():
+        stubs.append('%s: %s' % (json.dumps(name), json.dumps(stub)))
+    
+    # attachments parts must follow the order of the `_attachments`
+    # member, so it's serialized by hand.
+    sizes = [os.path.getsize(filepath) for name, filepath, ct in attachments]
+    for (name, filepath, content_type), size in zip(attachments, sizes):
+        stubs.append('%s: {"follows": true, "content_type": %s, '
+            '"length": %s}' % (json.dumps(name), json.dumps(content_type), 
+                                size))
+    body = json.dumps(doc)
+    if doc:
+        body = body[:-1] + ', '
+    else:
+        body = '{'
+    body += '"_attachments": {%s}}' % ', '.join(stubs)
+    
+    head = '--%s\r\nContent-Type: application/json\r\n\r\n%s' % (boundary, 
+                                                                body)
+    part_head = '\r\n--%s\r\n\r\n' % boundary
+    tail = '\r\n--%s--' % boundary
+    length = len(head) + len(part_head) * len(attachments) + sum(sizes) + \
+            len(tail)
+        
+    def iter_parts():
+        yield head
+        for name, filepath, content_type in attachments:
+            yield part_head
+            with open(filepath, 'rb') as f:
+                yield f
+        yield tail
+    return iter_parts(), length
+    
 def encode_attachments(attachments):
     for k, v in attachments.iteritems():
         if v.get('stub', False):
             continue
         else:
-            re_sp = re.compile('\s')
-            v['data'] = re_sp.sub('', base64.b64encode(v['data']))
+            v['data'] = base64.b64encode(v['data'])
     return attachments
@@ -16,9 +16,10 @@ try:
 except ImportError:
     import couchapp.simplejson as json
     
+from couchapp.cache import SignatureCache
 from couchapp.errors import AppError
 from couchapp import client
-from couchapp import util
+from couchapp import util, walker
 
 logger = logging.getLogger(__name__)
 
@@ -203,28 +204,54 @@ def clone(source, dest=None, rev=None):
     util.write_json(os.path.join(path, '.couchapprc'), {})
 
     if '_attachments' in doc:  # process attachments
+        signatures_cache = SignatureCache(path)
         attachdir = os.path.join(path, '_attachments')
         if not os.path.isdir(attachdir):
             os.makedirs(attachdir)
             
+        # attachments already on the disk, found in one walk
+        local = {}
+        for entry in walker.walk(path):
+            if entry.kind in walker.ATTACHMENT_KINDS:
+                local[entry.name] = entry
+            
         for filename in doc['_attachments'].iterkeys():
-            if filename.startswith('vendor'):
-                attach_parts = util.split_path(filename)
-                vendor_attachdir = os.path.join(path, attach_parts.pop(0),
-                        attach_parts.pop(0), '_attachments')
-                filepath = os.path.join(vendor_attachdir, *attach_parts)
+            entry = local.get(filename)
+            if entry is not None:
+                filepath = entry.path
+                signature = signatures_cache.sign(filepath, entry.stat())
             else:
-                filepath = os.path.join(attachdir, filename)
-            filepath = _replace_slash(filepath)
-            currentdir = os.path.dirname(filepath)
-            if not os.path.isdir(currentdir):
-                os.makedirs(currentdir)
+                if filename.startswith('vendor'):
+                    attach_parts = util.split_path(filename)
+                    vendor_attachdir = os.path.join(path, attach_parts.pop(0),
+                            attach_parts.pop(0), '_attachments')
+                    filepath = os.path.join(vendor_attachdir, *attach_parts)
+                else:
+                    filepath = os.path.join(attachdir, filename)
+                filepath = _replace_slash(filepath)
+                currentdir = os.path.dirname(filepath)
+                if not os.path.isdir(currentdir):
+                    os.makedirs(currentdir)
+                signature = ''
     
-            if signatures.get(filename) != util.sign(filepath):
-                resp = db.fetch_attachment(docid, filename)
-                with open(filepath, 'wb') as f:
-                    for chunk in resp.body_file:
-                        f.write(chunk)
+            if signatures.get(filename) != signature:
+                resp = db.fetch_attachment(docid, filename, stream=True)
+                m = md5()
+                try:
+                    with open(filepath, 'wb') as f:
+                        while True:
+                            chunk = resp.body_file.read(
+                                    client.STREAM_BLOCK_SIZE)
+                            if not chunk:
+                                break
+                            m.update(chunk)
+                            f.write(chunk)
+                finally:
+                    # release the connection, or close it if the body
+                    # wasn't read entirely
+                    resp.body_file.close()
+                signatures_cache.set(filepath, m.hexdigest())
                 logger.debug("clone attachment: %s" % filename)
+        signatures_cache.save()
                 
     logger.info("%s cloned in %s" % (source, dest))
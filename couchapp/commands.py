@@ -3,22 +3,30 @@
 # This file is part of couchapp released under the Apache 2 license. 
 # See the NOTICE for more information.
 
+import itertools
 import logging
 import os
-try:
-    import json
-except ImportError:
-    import couchapp.simplejson as json
+import sys
+import time
 
+from couchapp import builder
+from couchapp import cache
+from couchapp import client
 from couchapp import clone_app
-from couchapp.errors import ResourceNotFound, AppError, BulkSaveError
+from couchapp.errors import AppError, BulkSaveError
+from couchapp.fanout import fanout as fanout_push
 from couchapp import generator
-from couchapp.localdoc import document
+from couchapp.localdoc import document, upload_mode
+from couchapp.pushstate import PushState, doc_hash
 from couchapp import util
 from couchapp.vendors import vendor_install, vendor_update
+from couchapp import walker
 
 logger = logging.getLogger(__name__)
 
+# a bulk request of pushapps is sent once its apps, attachments
+# included, take about this many bytes in JSON
+APPS_BATCH_BYTES = 16 * 1024 * 1024
 
 def hook(conf, path, hook_type, *args, **kwargs):
     if hook_type in conf.hooks:
@@ -62,17 +70,18 @@ def push(conf, path, *args, **opts):
     conf.update(doc_path)
 
     doc = document(doc_path, create=False, 
-                        docid=opts.get('docid'))
+                        docid=opts.get('docid'), workers=opts.get('jobs', 1))
     if export:
         if opts.get('output'):
-            util.write_json(opts.get('output'), str(doc))
+            util.write(opts.get('output'), str(doc))
         else:
             print str(doc)
         return 0
     dbs = conf.get_dbs(dest)
     
     hook(conf, doc_path, "pre-push", dbs=dbs)    
-    doc.push(dbs, atomic, browse, force)
+    doc.push(dbs, atomic, browse, force, upload=opts.get('upload'),
+            resume=opts.get('resume', False))
     hook(conf, doc_path, "post-push", dbs=dbs)
     
     docspath = os.path.join(doc_path, '_docs')
@@ -84,115 +93,300 @@ def pushapps(conf, source, dest, *args, **opts):
     export = opts.get('export', False)
     noatomic = opts.get('no_atomic', False)
     browse = opts.get('browse', False)
+    force = opts.get('force', False)
+    jobs = opts.get('jobs', 1)
+    batch_size = opts.get('batch_size', client.BULK_BATCH_SIZE)
+    compress = opts.get('gzip', False)
+    upload = opts.get('upload')
     dbs = conf.get_dbs(dest)
-    apps = []
+    appdirs = []
     source = os.path.normpath(os.path.join(os.getcwd(), source))
-    for d in os.listdir(source):
+    for d in sorted(os.listdir(source)):
         appdir = os.path.join(source, d)
         if os.path.isdir(appdir) and os.path.isfile(os.path.join(appdir, 
                                         '.couchapprc')):
-            doc = document(appdir)
             hook(conf, appdir, "pre-push", dbs=dbs, pushapps=True)
-            if export or not noatomic:
-                apps.append(doc)
-            else:
-                doc.push(dbs, True, browse)
+            appdirs.append(appdir)
+            
+    if export:
+        # apps are built by a pool of `jobs` processes, in order
+        apps = builder.build(appdirs, workers=jobs)
+        export_docs((doc.doc() for doc in apps), opts.get('output'))
+        for appdir in appdirs:
             hook(conf, appdir, "post-push", dbs=dbs, pushapps=True)
-    if apps:
-        if export:
-            docs = []
-            docs.append([doc.doc() for doc in apps])
-            jsonobj = {'docs': docs}
-            if opts.get('output') is not None:
-                util.write_json(opts.get('output'), json.dumps(jsonobj))
-            else:
-                print json.dumps(jsonobj)
-            return 0
-        else:
-            for db in dbs:
-                docs = []
-                docs = [doc.doc(db) for doc in apps]
-                try:
-                    db.save_docs(docs)
-                except BulkSaveError, e:
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.last_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass 
-                    if docs1:
-                        db.save_docs(docs1)
+        return 0
+        
+    # documents with inline attachments are sent in _bulk_docs requests
+    # of `batch_size` apps and at most about APPS_BATCH_BYTES, other
+    # uploads are made app by app
+    bulk_dbs = []
+    if not noatomic:
+        bulk_dbs = [db for db in dbs if upload_mode(db, upload) == "inline"]
+    push_dbs = [db for db in dbs if db not in bulk_dbs]
+        
+    def serialize(doc):
+        # build stage: documents of the bulk requests get their changed
+        # attachments encoded and all their members in JSON (see 
+        # `EncodedDoc`), the upload stage only joins and sends them
+        return doc, [doc.doc(db, force=force) for db in bulk_dbs]
+        
+    def push(app):
+        doc, bulk_docs = app
+        if push_dbs:
+            doc.push(push_dbs, noatomic, browse, force, upload=upload,
+                    resume=opts.get('resume', False))
+        return app
+        
+    def save_batch(batch):
+        for i, db in enumerate(bulk_dbs):
+            docs = [bulk_docs[i] for doc, bulk_docs in batch]
+            try:
+                db.save_docs(docs, batch_size=0, compress=compress)
+            except BulkSaveError, e:
+                docs1 = resolve_conflicts(db, e.errors)
+                if docs1:
+                    db.save_docs(docs1, batch_size=0, compress=compress)
+        for doc, bulk_docs in batch:
+            hook(conf, doc.docdir, "post-push", dbs=dbs, pushapps=True)
+        
+    # apps are built and serialized by `jobs` processes, or a thread,
+    # while built apps are uploaded by `concurrency` threads. The queue
+    # between them is bounded so apps aren't built faster than they are
+    # sent.
+    start = time.time()
+    apps = util.prefetch(itertools.imap(serialize, builder.build(appdirs,
+                    workers=jobs, with_attachments=bool(bulk_dbs), 
+                    lazy=False)), size=max(2, jobs))
+    batch = []
+    batch_bytes = 0
+    try:
+        for app in util.parallel_imap(push, apps, 
+                        opts.get('concurrency', 1)):
+            batch.append(app)
+            batch_bytes += sum([doc.encoded_size() for doc in app[1]])
+            if not bulk_dbs or batch_bytes >= APPS_BATCH_BYTES or \
+                    (batch_size and len(batch) >= batch_size):
+                save_batch(batch)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            save_batch(batch)
+    finally:
+        # stop the build stage if an upload failed
+        apps.close()
+        
+    elapsed = time.time() - start
+    rate = 0
+    if elapsed > 0:
+        rate = len(appdirs) / elapsed
+    logger.info("%s apps pushed to %s databases in %.1fs (%.1f apps/s)" % (
+                len(appdirs), len(dbs), elapsed, rate))
     return 0
   
 def pushdocs(conf, source, dest, *args, **opts):
+    batch_size = opts.get('batch_size', client.BULK_BATCH_SIZE)
+    dbs = conf.get_dbs(dest)
+    jobs = opts.get('jobs', 1)
+    # documents are read and sent by batches of `batch_size`, so memory
+    # used doesn't depend on the number of documents
+    batches = util.batches(iter_docs(source), batch_size)
+    # folders of all batches are built by the same `jobs` processes
+    pool = builder.process_pool(jobs)
+    try:
+        return _pushdocs(conf, source, dbs, batches, pool, **opts)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        
+def _pushdocs(conf, source, dbs, batches, pool, **opts):
     export = opts.get('export', False)
     noatomic = opts.get('no_atomic', False)
     browse = opts.get('browse', False)
-    dbs = conf.get_dbs(dest)
-    docs = []
-    for d in os.listdir(source):
-        docdir = os.path.join(source, d)
-        if docdir.startswith('.'):
-            continue
-        elif os.path.isfile(docdir):
-            if d.endswith(".json"):
-                doc = util.read_json(docdir)
-                docid, ext = os.path.splitext(d)
-                doc.setdefault('_id', docid)
-                doc.setdefault('couchapp', {})
-                if export or not noatomic:
-                    docs.append(doc)
-                else:
-                    for db in dbs:
-                        db.save_doc(doc, force_update=True)
-        else:
-            doc = document(docdir)
-            if export or not noatomic:
-                docs.append(doc)
+    force = opts.get('force', False)
+    full = opts.get('full', False)
+    resume = opts.get('resume', False)
+    compress = opts.get('gzip', False)
+    jobs = opts.get('jobs', 1)
+        
+    if export:
+        export_docs((doc_of(doc) for batch in batches 
+                        for name, doc in load_batch(batch, jobs, pool=pool)),
+                    opts.get('output'))
+        return 0
+        
+    def hashed(batch):
+        # folders are built by `jobs` processes, attachments are only
+        # signed until we know the document changed
+        load_batch(batch, jobs, with_attachments=False, pool=pool)
+        hashes = {}
+        for name, doc in batch:
+            if hasattr(doc, 'doc'):
+                hashes[name] = doc.content_hash()
             else:
-                doc.push(dbs, True, browse)
-    if docs:
-        if export:
-            docs1 = []
-            for doc in docs:
+                hashes[name] = doc_hash(doc)
+        return batch, hashes
+        
+    def push_batch(db, batch, hashes):
+        # revisions of all documents of the batch in one request
+        revs = db.last_revs([docid_of(doc) for name, doc in batch])
+        skipped = 0
+        pushed = []
+        failed = set()
+        try:
+            for name, doc in batch:
+                if not full and state.unchanged(name, hashes[name], db.uri,
+                                                revs.get(docid_of(doc))):
+                    skipped += 1
+                    continue
                 if hasattr(doc, 'doc'):
-                    docs1.append(doc.doc())
-                else:
-                    docs1.append(doc)
-            jsonobj = {'docs': docs}
-            if opts.get('output') is not None:
-                util.write_json(opts.get('output'), json.dumps(jsonobj))
-            else:
-                print json.dumps(jsonobj)
-        else:
-            for db in dbs:
-                docs1 = []
-                for doc in docs:
-                    if hasattr(doc, 'doc'):
-                        docs1.append(doc.doc(db))
+                    if noatomic:
+                        newdoc = doc.push([db], True, browse, force,
+                                    resume=resume)[0]
                     else:
-                        newdoc = doc.copy()
-                        try:
-                            rev = db.last_rev(doc['_id'])
-                            newdoc.update({'_rev': rev})
-                        except ResourceNotFound:
-                            pass
-                        docs1.append(newdoc)
+                        newdoc = doc.doc(db, force=force)
+                else:
+                    newdoc = doc.copy()
+                    if doc['_id'] in revs:
+                        newdoc.update({'_rev': revs[doc['_id']]})
+                    if noatomic:
+                        db.save_doc(newdoc, force_update=True)
+                pushed.append((name, newdoc))
+                
+            if pushed and not noatomic:
                 try:
-                    db.save_docs(docs1)
+                    db.save_docs([d for _, d in pushed],
+                                batch_size=0, compress=compress)
                 except BulkSaveError, e:
-                    # resolve conflicts
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.last_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass 
-                if docs1:
-                    db.save_docs(docs1)
+                    failed = set([id(doc1) for doc1 in e.errors])
+                    docs1 = resolve_conflicts(db, e.errors)
+                    if docs1:
+                        db.save_docs(docs1, batch_size=0,
+                                    compress=compress)
+                    failed = set()
+        finally:
+            for name, newdoc in pushed:
+                if '_rev' in newdoc and id(newdoc) not in failed:
+                    state.set(name, hashes[name], db.uri, newdoc['_rev'])
+        return len(pushed), skipped
+        
+    # documents unchanged since they were pushed to a database are
+    # skipped, unless --full is given
+    state = PushState(source)
+    names = set()
+    counts = dict([(db.uri, [0, 0]) for db in dbs])
+    try:
+        # the next batch is read while the current one is sent
+        for batch, hashes in util.prefetch(itertools.imap(hashed, batches)):
+            names.update(hashes.keys())
+            for db in dbs:
+                sent, skipped = push_batch(db, batch, hashes)
+                counts[db.uri][0] += sent
+                counts[db.uri][1] += skipped
+        state.prune(names)
+    finally:
+        state.save()
+    for db in dbs:
+        logger.info("%s: %s documents sent, %s unchanged skipped" % (
+                    db.uri, counts[db.uri][0], counts[db.uri][1]))
+    return 0
+    
+def iter_docs(source):
+    """ yield (name, doc) for each document of the folder `source`, doc
+    is a dict for JSON files and the path of folders (see
+    `load_batch`). """
+    for entry in walker.listdir(source):
+        name = entry.name
+        if name.startswith('.'):
+            continue
+        elif entry.is_dir():
+            yield name, entry.path
+        elif name.endswith(".json"):
+            doc = util.read_json(entry.path)
+            doc.setdefault('_id', name[:-5])
+            doc.setdefault('couchapp', {})
+            yield name, doc
+            
+def load_batch(batch, workers=1, with_attachments=True, pool=None):
+    """ replace paths of folders in `batch`, a list of (name, doc), by
+    their `LocalDoc` built by `workers` processes, those of `pool` if
+    given (see `builder.process_pool`). """
+    folders = [i for i, (name, doc) in enumerate(batch)
+                if isinstance(doc, basestring)]
+    built = builder.build([batch[i][1] for i in folders], workers=workers,
+                    with_attachments=with_attachments, pool=pool)
+    for i, doc in itertools.izip(folders, built):
+        batch[i] = (batch[i][0], doc)
+    return batch
+    
+def doc_of(doc):
+    """ the document to export: built document of a `LocalDoc` """
+    if hasattr(doc, 'doc'):
+        return doc.doc()
+    return doc
+    
+def export_docs(docs, output=None):
+    """ write `{"docs": [...]}` to the file `output` or to stdout. 
+    Documents are serialized one at a time. """
+    if output:
+        f = open(output, 'wb')
+    else:
+        f = sys.stdout
+    try:
+        f.write('{"docs": [')
+        for i, doc in enumerate(docs):
+            if i:
+                f.write(', ')
+            f.write(client.encode_doc(doc))
+        f.write(']}')
+        if not output:
+            f.write('\n')
+    finally:
+        if output:
+            f.close()
+        else:
+            f.flush()
+    
+def docid_of(doc):
+    """ id of a document or of a `LocalDoc` """
+    if hasattr(doc, 'docid'):
+        return doc.docid
+    return doc['_id']
+    
+def resolve_conflicts(db, docs):
+    """ set the last revision of documents in conflict. Return the
+    documents still found in `db`. """
+    revs = db.last_revs([doc['_id'] for doc in docs])
+    docs1 = []
+    for doc in docs:
+        if doc['_id'] in revs:
+            doc['_rev'] = revs[doc['_id']]
+            docs1.append(doc)
+    return docs1
+    
+def fanout(conf, path, *args, **opts):
+    if len(args) == 3:
+        doc_path = os.path.normpath(os.path.join(os.getcwd(), args[0]))
+        args = args[1:]
+    else:
+        doc_path = path
+    if len(args) != 2:
+        raise AppError("SERVER and PATTERN are required")
+    if doc_path is None:
+        raise AppError("You aren't in a couchapp.")
+    server, pattern = args
+    
+    conf.update(doc_path)
+    doc = document(doc_path, create=False, 
+                        docid=opts.get('docid'), workers=opts.get('jobs', 1))
+    server_uri = conf.get_server_uri(server)
+    
+    hook(conf, doc_path, "pre-push", dbs=[], fanout=True)
+    errors = fanout_push(doc, server_uri, pattern, regex=opts.get('regex'),
+                    concurrency=opts.get('concurrency', 8),
+                    force=opts.get('force', False))
+    hook(conf, doc_path, "post-push", dbs=[], fanout=True)
+    if errors:
+        return 1
     return 0
     
 def clone(conf, source, *args, **opts):
@@ -205,6 +399,15 @@ def clone(conf, source, *args, **opts):
     hook(conf, dest, "post-clone", source=source)
     return 0
 
+def clearcache(conf, path, *args, **opts):
+    if args:
+        path = os.path.normpath(os.path.join(os.getcwd(), args[0]))
+    if path is None:
+        raise AppError("You aren't in a couchapp.")
+    cache.clear(path)
+    logger.info("cache of %s cleared" % path)
+    return 0
+
 def generate(conf, path, *args, **opts):
     dest = path
     if len(args) < 1:
@@ -330,7 +533,15 @@ pushopts = [
     ('', 'export', False, "don't do push, just export doc to stdout"),
     ('', 'output', '', "if export is selected, output to the file"),
     ('b', 'browse', False, "open the couchapp in the browser"),
-    ('', 'force', False, "force attachments sending")
+    ('', 'force', False, "force attachments sending"),
+    ('', 'resume', False, "resume an interrupted push (with --no-atomic)"),
+    ('j', 'jobs', 1, "number of workers used to build documents and process attachments")
+]
+
+bulkopts = [
+    ('', 'batch-size', client.BULK_BATCH_SIZE,
+        "number of documents sent in a bulk request (0: all at once)"),
+    ('', 'gzip', False, "compress bulk requests with gzip")
 ]
     
 table = {
@@ -340,19 +551,45 @@ table = {
         "[COUCHAPPDIR]"),
     "push":
         (push,
-        pushopts + [('', 'docid', '', "set docid")],
+        pushopts + [
+            ('', 'docid', '', "set docid"),
+            ('', 'upload', '', 
+                "how attachments are sent: auto (default), inline, stream " +
+                "or multipart")
+        ],
         "[OPTION]... [COUCHAPPDIR] DEST"),
+    "fanout":
+        (fanout,
+        [
+            ('', 'regex', False, "PATTERN is a regular expression"),
+            ('c', 'concurrency', 8, "number of databases updated at once"),
+            ('', 'force', False, "force attachments sending"),
+            ('j', 'jobs', 1, "number of workers used to process attachments"),
+            ('', 'docid', '', "set docid")
+        ],
+        "[OPTION]... [COUCHAPPDIR] SERVER PATTERN"),
     "clone":
         (clone,
         [('r', 'rev', '', "clone specific revision")],
         "[OPTION]...[-r REV] SOURCE [COUCHAPPDIR]"),
+    "clearcache":
+        (clearcache,
+        [],
+        "[COUCHAPPDIR]"),
     "pushapps":
         (pushapps,
-        pushopts,
+        pushopts + bulkopts + [
+            ('c', 'concurrency', 1, "number of apps uploaded at once"),
+            ('', 'upload', '', 
+                "how attachments are sent: auto (default), inline, stream " +
+                "or multipart")
+        ],
         "[OPTION]... SOURCE DEST"),
     "pushdocs":
         (pushdocs,
-        pushopts,
+        pushopts + bulkopts + [
+            ('', 'full', False, "push all documents, even unchanged ones")
+        ],
         "[OPTION]... SOURCE DEST"),
     "generate":
         (generate,
@@ -369,4 +606,4 @@ table = {
 }
 
 withcmd = ['generate', 'vendor']
-incouchapp = ['init', 'push', 'generate', 'vendor']
+incouchapp = ['init', 'push', 'generate', 'vendor', 'clearcache', 'fanout']
@@ -145,6 +145,25 @@ class Config(object):
 
         return [Database(dburl) for dburl in dburls]
         
+    def get_server_uri(self, server_string=None):
+        """ return the uri of a server given as an url or as the name of
+        an environment, in which case the server of its database is
+        used. """
+        if server_string is not None and \
+                server_string.startswith(("http://", "https://")):
+            return server_string.rstrip('/')
+        
+        env = self.conf.get('env', {})
+        name = server_string or 'default'
+        if name not in env:
+            if server_string:
+                raise AppError("unknown server: %s" % server_string)
+            return self.DEFAULT_SERVER_URI
+        dburls = env[name]['db']
+        if not isinstance(dburls, basestring):
+            dburls = dburls[0]
+        return dburls.rsplit('/', 1)[0]
+        
     def get_app_name(self, dbstring=None, default=None):
         env = self.conf.get('env', {})
         if not dbstring.startswith("http://"):
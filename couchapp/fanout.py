@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Push the same document to many databases of a server, like the
+databases of the per-user database pattern. The document is built and
+serialized once, then each database only costs a GET of its current
+document and a PUT. Databases are updated by a bounded pool of threads
+sharing their connections.
+"""
+
+import fnmatch
+import logging
+import Queue
+import re
+import threading
+import time
+
+from couchapp.client import Database, all_dbs
+from couchapp.errors import ResourceNotFound
+from couchapp.restkit import util as rutil
+from couchapp.restkit.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+def select_dbs(dbnames, pattern, regex=False):
+    """ return names of `dbnames` matching `pattern`, a glob or a
+    regexp if `regex` is True. System databases (starting with "_") only
+    match if the pattern starts with "_". """
+    if regex:
+        match = re.compile(pattern).match
+    else:
+        match = lambda name: fnmatch.fnmatchcase(name, pattern)
+    selected = []
+    for name in dbnames:
+        if name.startswith('_') and not pattern.startswith('_'):
+            continue
+        if match(name):
+            selected.append(name)
+    return selected
+
+
+class FanoutResult(object):
+    """ result of the push to one database """
+
+    def __init__(self, dbname, rev=None, error=None):
+        self.dbname = dbname
+        self.rev = rev
+        self.error = error
+
+    def __repr__(self):
+        return "<%s %s (%s)>" % (self.__class__.__name__, self.dbname,
+                                 self.error or self.rev)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Fanout(object):
+    """ push a `LocalDoc` to databases of the server `server_uri` using
+    `concurrency` threads. """
+
+    def __init__(self, localdoc, server_uri, concurrency=8, force=False):
+        self.localdoc = localdoc
+        self.server_uri = server_uri.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.force = force
+        self.pool = ConnectionPool(max_connections=self.concurrency)
+
+    def all_dbs(self):
+        return all_dbs(self.server_uri, pool_instance=self.pool)
+
+    def push_db(self, dbname):
+        """ push the document to the database `dbname`, return a
+        `FanoutResult`. """
+        try:
+            db = Database("%s/%s" % (self.server_uri,
+                                     rutil.url_quote(dbname, safe='')),
+                          create=False, pool_instance=self.pool)
+            try:
+                olddoc = db.open_doc(self.localdoc.docid)
+            except ResourceNotFound:
+                olddoc = {}
+            doc = self.localdoc.doc_for(olddoc, force=self.force)
+            db.save_doc(doc)
+            return FanoutResult(dbname, rev=doc['_rev'])
+        except Exception, e:
+            return FanoutResult(dbname, error=str(e) or e.__class__.__name__)
+
+    def run(self, dbnames):
+        """ push the document to each database of `dbnames` and yield
+        a `FanoutResult` for each one as soon as it's done. """
+        # build, encode and serialize the document once
+        self.localdoc.doc()
+
+        dbnames = list(dbnames)
+        queue = Queue.Queue()
+        for dbname in dbnames:
+            queue.put(dbname)
+        results = Queue.Queue()
+
+        def worker():
+            while True:
+                try:
+                    dbname = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results.put(self.push_db(dbname))
+
+        for i in range(min(self.concurrency, len(dbnames))):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+
+        for i in range(len(dbnames)):
+            yield results.get()
+
+
+def fanout(localdoc, server_uri, pattern, regex=False, concurrency=8,
+        force=False):
+    """ push `localdoc` to all databases of `server_uri` matching
+    `pattern`. Results are logged as databases are updated, followed by
+    a summary.
+
+    :return: list of `FanoutResult` of databases in error
+    """
+    f = Fanout(localdoc, server_uri, concurrency=concurrency, force=force)
+    dbnames = select_dbs(f.all_dbs(), pattern, regex=regex)
+    logger.info("pushing %s to %s databases" % (localdoc.docid,
+                                                len(dbnames)))
+    start = time.time()
+    errors = []
+    for result in f.run(dbnames):
+        if result.ok:
+            logger.info("%s: %s" % (result.dbname, result.rev))
+        else:
+            logger.error("%s: %s" % (result.dbname, result.error))
+            errors.append(result)
+    elapsed = time.time() - start
+    rate = 0
+    if elapsed > 0:
+        rate = len(dbnames) / elapsed
+    logger.info("%s databases updated, %s failed in %.1fs (%.1f db/s)" % (
+                len(dbnames) - len(errors), len(errors), elapsed, rate))
+    return errors
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Patterns of the `.couchappignore` file. Each entry of the list is one of:
+
+    - a regexp matched against the name of the file or folder, like
+      in previous versions of couchapp.
+    - "path:<regexp>", a regexp matched against the path relative to
+      the couchapp folder (with "/" as separator).
+    - "glob:<pattern>", a gitignore-style pattern. "*" and "?" don't
+      match "/", "**" matches any number of folders and a trailing "/"
+      only matches folders. A pattern without "/" matches the name at
+      any depth, otherwise it is anchored to the couchapp folder.
+
+All patterns of a kind are compiled in one regexp so a path is tested
+with at most a few matches whatever the number of patterns.
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def glob_to_re(pattern):
+    """ translate a gitignore-style glob to a regexp string matching
+    a whole path. """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i+1] == '*':
+                i += 1
+                if pattern[i:i+1] == '/' and (i == 2 or pattern[i-3] == '/'):
+                    # "**/" matches zero or more folders
+                    i += 1
+                    res.append('(?:.*/)?')
+                else:
+                    res.append('.*')
+            else:
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if pattern[j:j+1] in ('!', '^'):
+                j += 1
+            if pattern[j:j+1] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] in ('!', '^'):
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+    return ''.join(res) + '\\Z'
+
+
+class _AnyOf(object):
+    """ match with a list of regexps, used for patterns that can't be
+    combined. """
+
+    def __init__(self, regexps):
+        self.regexps = regexps
+
+    def match(self, s):
+        for regexp in self.regexps:
+            if regexp.match(s):
+                return True
+        return False
+
+
+def combine(regexps):
+    """ return an object with a `match` method true if any of the
+    strings in `regexps` matches. Regexps with groups are kept apart
+    since combining them would renumber their backreferences. """
+    if not regexps:
+        return None
+    simple = []
+    apart = []
+    for regexp in regexps:
+        if re.compile(regexp).groups:
+            apart.append(re.compile(regexp))
+        else:
+            simple.append(regexp)
+    if simple:
+        try:
+            apart.insert(0, re.compile('|'.join(['(?:%s)' % regexp
+                                                 for regexp in simple])))
+        except (re.error, OverflowError, AssertionError):
+            apart = [re.compile(regexp) for regexp in simple] + apart
+    if len(apart) == 1:
+        return apart[0]
+    return _AnyOf(apart)
+
+
+class IgnoreRules(object):
+    """ compiled patterns of a `.couchappignore` file """
+
+    def __init__(self, patterns=None):
+        self.patterns = list(patterns or [])
+        names = []
+        paths = []
+        dir_names = []
+        dir_paths = []
+        for pattern in self.patterns:
+            try:
+                if pattern.startswith('glob:'):
+                    glob = pattern[5:]
+                    dironly = glob.endswith('/')
+                    glob = glob.rstrip('/')
+                    if not glob:
+                        continue
+                    if '/' in glob:
+                        regexp = glob_to_re(glob.lstrip('/'))
+                        if dironly:
+                            target = dir_paths
+                        else:
+                            target = paths
+                    else:
+                        regexp = glob_to_re(glob)
+                        if dironly:
+                            target = dir_names
+                        else:
+                            target = names
+                elif pattern.startswith('path:'):
+                    regexp = pattern[5:]
+                    target = paths
+                else:
+                    regexp = pattern
+                    target = names
+                re.compile(regexp)
+            except (re.error, AttributeError), e:
+                logger.error("invalid ignore pattern %r: %s" % (pattern, e))
+                continue
+            target.append(regexp)
+        self.names = combine(names)
+        self.paths = combine(paths)
+        self.dir_names = combine(dir_names)
+        self.dir_paths = combine(dir_paths)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.patterns)
+
+    def __nonzero__(self):
+        return bool(self.patterns)
+
+    def match(self, path, isdir=False):
+        """ return True if `path`, relative to the couchapp folder with
+        "/" as separator, is ignored. """
+        name = path.rsplit('/', 1)[-1]
+        for regexp, s in ((self.names, name), (self.paths, path)):
+            if regexp is not None and regexp.match(s):
+                return True
+        if isdir:
+            for regexp, s in ((self.dir_names, name), (self.dir_paths, path)):
+                if regexp is not None and regexp.match(s):
+                    return True
+        return False
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Journal of a noatomic push, stored in the `.couchapp/journal` folder of
+a couchapp. The first line describes the push (database, document id,
+hash of the document and signatures of attachments), then a line is appended each time the server
+confirms an upload with the revision it created.
+"""
+
+from __future__ import with_statement
+
+from hashlib import md5
+import logging
+import os
+try:
+    import json
+except ImportError:
+    import couchapp.simplejson as json
+
+from couchapp import util
+
+JOURNAL_DIR = os.path.join('.couchapp', 'journal')
+
+logger = logging.getLogger(__name__)
+
+
+class PushJournal(object):
+
+    def __init__(self, appdir, dburi, docid):
+        self.dburi = dburi
+        self.docid = docid
+        key = md5(util.to_bytestring("%s/%s" % (dburi, docid))).hexdigest()
+        self.path = os.path.join(appdir, JOURNAL_DIR, "%s.json" % key)
+        self.signatures = None
+        self.content_hash = None
+        self.revs = []
+        self.done = {}
+        self.load()
+
+    def __repr__(self):
+        return "<%s (%s/%s)>" % (self.__class__.__name__, self.dburi,
+                                 self.docid)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('db') != self.dburi or \
+                        header.get('docid') != self.docid:
+                    return
+                self.signatures = header.get('signatures', {})
+                self.content_hash = header.get('hash')
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line was only partially written
+                        break
+                    self.revs.append(entry['rev'])
+                    if entry.get('name') is not None:
+                        self.done[entry['name']] = entry['rev']
+        except (IOError, ValueError), e:
+            logger.warning("can't read journal %s: %s" % (self.path, e))
+            self.signatures = None
+            self.content_hash = None
+            self.revs = []
+            self.done = {}
+
+    def matches(self, signatures, rev, content_hash=None):
+        """ return True if the journal was written for the same
+        document (`content_hash`, see `LocalDoc.content_hash`) and
+        attachments, and the document on the server is still at a
+        revision we created. """
+        return self.signatures == signatures and \
+                self.content_hash == content_hash and rev in self.revs
+
+    def start(self, signatures, content_hash=None):
+        """ start a new journal """
+        self.signatures = signatures
+        self.content_hash = content_hash
+        self.revs = []
+        self.done = {}
+        journaldir = os.path.dirname(self.path)
+        if not os.path.isdir(journaldir):
+            os.makedirs(journaldir)
+        with open(self.path, 'wb') as f:
+            f.write(json.dumps({
+                'db': self.dburi,
+                'docid': self.docid,
+                'hash': content_hash,
+                'signatures': signatures
+            }) + "\n")
+
+    def record(self, rev, name=None):
+        """ record a revision confirmed by the server. `name` is the name
+        of the attachment uploaded or None for the document itself. """
+        self.revs.append(rev)
+        if name is not None:
+            self.done[name] = rev
+        with open(self.path, 'ab') as f:
+            f.write(json.dumps({'name': name, 'rev': rev}) + "\n")
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.unlink(self.path)
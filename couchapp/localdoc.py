@@ -6,11 +6,11 @@
 
 from __future__ import with_statement
 import base64
+from hashlib import md5
 import logging
 import mimetypes
 import os
 import os.path
-import re
 import webbrowser
 # import json
 try:
@@ -18,29 +18,61 @@ try:
 except ImportError:
     import couchapp.simplejson as json
 
-from couchapp.errors import ResourceNotFound
+from couchapp.cache import FileCache, SignatureCache
+from couchapp.client import EncodedAttachment, EncodedDoc, encode_doc
+from couchapp.errors import ResourceNotFound, ResourceConflict, AppError
+from couchapp.ignores import IgnoreRules
+from couchapp.journal import PushJournal
 from couchapp.macros import package_shows, package_views
-from couchapp import util
+from couchapp import util, walker
 
-if os.name == 'nt':
-    def _replace_backslash(name):
-        return name.replace("\\", "/")
-else:
-    def _replace_backslash(name):
-        return name
-        
 logger = logging.getLogger(__name__)
 
+UPLOAD_MODES = ("auto", "inline", "stream", "multipart")
+
+# fields cache miss, cached values can be None (JSON null)
+_missing = object()
+
+def content_type(name):
+    """ guess the content type of an attachment from its name """
+    return ';'.join(filter(None, mimetypes.guess_type(name)))
+
+def upload_mode(db, upload=None):
+    """ return how attachments are sent to `db` by an atomic push (see
+    `LocalDoc.push`): `upload`, or with "auto" (default) "multipart" if
+    the server supports it, else "inline". """
+    upload = upload or "auto"
+    if upload not in UPLOAD_MODES:
+        raise AppError("unknown upload mode: %s" % upload)
+    if upload == "auto":
+        if db.accepts_multipart():
+            upload = "multipart"
+        else:
+            upload = "inline"
+        logger.debug("upload mode for %s: %s" % (db.uri, upload))
+    return upload
+
 class LocalDoc(object):
     
-    def __init__(self, path, create=False, docid=None):
+    def __init__(self, path, create=False, docid=None, workers=1):
         self.docdir = path
+        self.workers = workers
         self.ignores = []
         ignorefile = os.path.join(path, '.couchappignore')
         if os.path.exists(ignorefile):
             # A .couchappignore file is a json file containing a
             # list of regexps for things to skip
             self.ignores = json.load(open(ignorefile, 'r'))
+        self.ignore_rules = IgnoreRules(self.ignores)
+        self.fields_cache = FileCache(path, 'fields')
+        self.signatures_cache = SignatureCache(path)
+        self._entries = None
+        self._built = None
+        self._body = None
+        # signatures and encoded attachments (`EncodedAttachment`) by
+        # name. Kept between calls to `doc`.
+        self._signatures = {}
+        self._attachments = {}
         if not docid:
             docid = self.get_id()
         self.docid = docid
@@ -48,6 +80,21 @@ class LocalDoc(object):
         if create: 
             self.create()
         
+    def __getstate__(self):
+        # a document built in another process (see `couchapp.builder`)
+        # keeps what it built but not its caches or folder entries
+        state = self.__dict__.copy()
+        for name in ('fields_cache', 'signatures_cache', 'olddoc'):
+            state.pop(name, None)
+        state['_entries'] = None
+        state['_doc'] = {'_id': self.docid}
+        return state
+        
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fields_cache = FileCache(self.docdir, 'fields')
+        self.signatures_cache = SignatureCache(self.docdir)
+        
     def get_id(self):
         """
         if there is an _id file, docid is extracted from it,
@@ -63,7 +110,7 @@ class LocalDoc(object):
         return "<%s (%s/%s)>" % (self.__class__.__name__, self.docdir, self.docid)
         
     def __str__(self):
-        return json.dumps(self.doc())
+        return encode_doc(self.doc())
         
     def create(self):
         if not os.path.isdir(self.docdir):
@@ -75,88 +122,163 @@ class LocalDoc(object):
         else:
             logger.info("CouchApp already initialized in %s." % self.docdir)
 
-    def push(self, dbs, noatomic=False, browser=False, force=False):
+    def push(self, dbs, noatomic=False, browser=False, force=False,
+            upload=None, resume=False):
         """Push a doc to a list of database `dburls`. If noatomic is true
-        each attachments will be sent one by one."""
+        each attachments will be sent one by one. If `resume` is true
+        a noatomic push interrupted before skips what the server already
+        confirmed (see `push_noatomic`).
+        
+        `upload` is the way attachments are sent with an atomic push:
+        
+        - "auto" (default): "multipart" if the server supports it, else
+        "inline".
+        - "inline": the document is built in memory with attachments 
+        encoded in base64.
+        - "stream": attachments are read from disk and encoded while the
+        document is sent, so memory used doesn't depend on the size of
+        attachments.
+        - "multipart": the document is sent in a multipart/related 
+        request, followed by the raw attachments streamed from disk.
+        
+        Return the list of documents saved, one per database.
+        """
+        if upload and upload not in UPLOAD_MODES:
+            raise AppError("unknown upload mode: %s" % upload)
+            
+        saved_docs = []
         for db in dbs:
+            if not noatomic:
+                db_upload = upload_mode(db, upload)
+                    
             if noatomic:
+                doc = self.push_noatomic(db, force=force, resume=resume)
+            elif db_upload in ("stream", "multipart"):
                 doc = self.doc(db, with_attachments=False)
-                try:
-                    self.olddoc = db.open_doc(doc['_id'])
-                    doc['_attachments'] = self.olddoc.get('_attachments')
-                except ResourceNotFound:
-                    self.olddoc = {}
-                
-                db.save_doc(doc, force_update=True)
-                if 'couchapp' in self.olddoc:
-                    old_signatures = self.olddoc['couchapp'].get('signatures', 
-                                                                {})
-                else:
-                    old_signatures = {}
-                
-                signatures = doc['couchapp'].get('signatures', {})
-
-                if old_signatures:
-                    for name, signature in old_signatures.items():
-                        cursign = signatures.get(name)
-                        if not cursign:
-                            db.delete_attachment(doc, name)
-                        elif cursign != signature:
-                            db.delete_attachment(doc, name)
-                        else:
-                            continue
-                            
-                for name, filepath in self.attachments():
-                    if old_signatures.get(name) != signatures.get(name) or force:
-                        logger.debug("attach %s " % name)
-                        db.put_attachment(doc, open(filepath, "r"), 
-                                            name=name)
+                remote = {}
+                if not force:
+                    remote = self.remote_signatures()
+                signatures = doc['couchapp']['signatures']
+                stubs = {}
+                attachments = []
+                saved = 0
+                for entry in self.attachment_entries():
+                    name = entry.name
+                    if name in remote and remote[name] == signatures[name]:
+                        stubs[name] = {'stub': True}
+                        saved += entry.stat().st_size
+                    else:
+                        attachments.append((name, entry.path,
+                                            content_type(name)))
+                if stubs:
+                    self._log_stubs(len(stubs), saved)
+                doc['_attachments'] = stubs
+                db.save_doc(doc, force_update=True, attachments=attachments,
+                        multipart=(db_upload == "multipart"))
             else:
-                doc = self.doc()
+                doc = self.doc(db, force=force)
                 db.save_doc(doc, force_update=True)
+            saved_docs.append(doc)
             indexurl = self.index(db.uri, doc['couchapp'].get('index'))
             if indexurl:
                 logger.info("Visit your CouchApp here:\n%s" % indexurl)
                 if browser:
                     webbrowser.open_new_tab(indexurl)            
+        return saved_docs
                         
-    def doc(self, db=None, with_attachments=True):
-        """ Function to reetrieve document object from
-        document directory. If `with_attachments` is True
-        attachments will be included and encoded"""
+    def push_noatomic(self, db, force=False, resume=False):
+        """ save the document then send changed attachments one by one.
+        
+        Removed and changed attachments are dropped from `_attachments`
+        when the document is saved, so there is no delete request.
+        Each attachment is sent with the revision returned by the 
+        previous request, the document is never fetched again.
+        Attachments of a document can't be sent in parallel since each
+        upload creates a new revision.
         
+        Revisions confirmed by the server are written in a journal. If
+        `resume` is true, the journal matches the document on the
+        server and no field changed since the interrupted push, the
+        document isn't saved again and attachments already uploaded are
+        skipped.
+        """
+        doc = self.doc(db, with_attachments=False)
+        old_attachments = self.olddoc.get('_attachments') or {}
+        old_signatures = self.olddoc.get('couchapp', {}).get('signatures', {})
+        signatures = doc['couchapp']['signatures']
+        journal = PushJournal(self.docdir, db.uri, doc['_id'])
+        content_hash = self.content_hash()
+        
+        resumed = False
+        if resume:
+            if journal.matches(signatures, self.olddoc.get('_rev'), 
+                               content_hash):
+                resumed = True
+                logger.info("resume push of %s, %s attachments already sent"
+                                % (doc['_id'], len(journal.done)))
+            else:
+                logger.info("nothing to resume for %s" % doc['_id'])
+        
+        def changed(name):
+            return force or old_signatures.get(name) != signatures.get(name)
+        
+        if not resumed:
+            # keep attachments we didn't push and unchanged ones
+            stubs = {}
+            for name in old_attachments:
+                if name not in old_signatures or \
+                        (name in signatures and not changed(name)):
+                    stubs[name] = {'stub': True}
+            doc['_attachments'] = stubs
+            journal.start(signatures, content_hash)
+            db.save_doc(doc, force_update=True)
+            journal.record(doc['_rev'])
+        
+        for name, filepath in self.attachments():
+            if resumed:
+                # the interrupted push saved the document without changed
+                # attachments, those on the server are sent or unchanged
+                if name in old_attachments:
+                    continue
+            elif name in stubs and not changed(name):
+                continue
+            logger.debug("attach %s " % name)
+            with open(filepath, "rb") as f:
+                try:
+                    db.put_attachment(doc, f, name=name)
+                except ResourceConflict:
+                    # someone else updated the doc, retry with its revision
+                    doc['_rev'] = db.last_rev(doc['_id'])
+                    db.put_attachment(doc, f, name=name)
+            journal.record(doc['_rev'], name)
+        journal.clear()
+        return doc
+        
+    def build(self):
+        """ build the document from the files of the couchapp: fields,
+        manifest and macros. Attachments aren't processed. The result is
+        kept, the document is only built once per `LocalDoc`. """
+        if self._built is not None:
+            return self._built
+            
         manifest = []
         objects = {}
         self._doc = {'_id': self.docid}
         
-        # get designdoc
-        self._doc.update(self.dir_to_fields(self.docdir, manifest=manifest))
+        # get designdoc, fields and attachments are found in one walk
+        entries = self.walk()
+        self._doc.update(self.dir_to_fields(self.docdir, manifest=manifest,
+                                            entries=entries))
+        self.fields_cache.prune()
+        self.fields_cache.save()
         
        
         if not 'couchapp' in self._doc:
              self._doc['couchapp'] = {}
             
-        signatures = {}
-        attachments = {}
-        for name, filepath in self.attachments():
-            signatures[name] = util.sign(filepath)
-            if with_attachments:
-                logger.debug("attach %s " % name)
-                attachments[name] = {}
-                with open(filepath, "rb") as f:
-                    re_sp = re.compile('\s')
-                    attachments[name]['data'] = re_sp.sub('', 
-                                        base64.b64encode(f.read()))
-                attachments[name]['content_type'] = ';'.join(filter(None, 
-                                            mimetypes.guess_type(name)))
-        
-        if with_attachments: 
-            self._doc['_attachments'] = attachments
-            
         self._doc['couchapp'].update({
             'manifest': manifest,
-            'objects': objects,
-            'signatures': signatures
+            'objects': objects
         })
         
         
@@ -196,133 +318,283 @@ class LocalDoc(object):
                 package_views(self._doc,self._doc["views"], self.docdir, 
                         objects)
         
+        self._built = self._doc
+        return self._built
+        
+    def doc(self, db=None, with_attachments=True, force=False):
+        """ Function to reetrieve document object from
+        document directory. If `with_attachments` is True
+        attachments will be included and encoded. If `db` is
+        given, attachments with the same signature in the
+        document saved in `db` are included as stubs, unless
+        `force` is True. 
+        
+        The document is built once (see `build`) and attachments are
+        hashed and encoded at most once, so pushing to several
+        databases only costs the `_rev` and the stubs of each database.
+        The result is an `EncodedDoc` whose members must not be
+        modified in place, its cached JSON wouldn't be updated.
+        """
         self.olddoc = {}
         if db is not None:
             try:
-                self.olddoc = db.open_doc(self._doc['_id'])
-                self._doc.update({'_rev': self.olddoc['_rev']})
+                self.olddoc = db.open_doc(self.docid)
             except ResourceNotFound:
                 pass
+        
+        remote = {}
+        if with_attachments and not force:
+            remote = self.remote_signatures()
+            
+        built = self.build()
+        
+        signatures = {}
+        attachments = {}
+        
+        def process_attachment(entry):
+            name, filepath = entry.name, entry.path
+            signature = self._signatures.get(name)
+            if signature is None and (not with_attachments or name in remote):
+                signature = self.signatures_cache.sign(filepath, entry.stat())
+                self._signatures[name] = signature
+            if not with_attachments:
+                return name, signature, None
+            elif name in remote and remote[name] == signature:
+                # unchanged, send a stub
+                return name, signature, None
+            elif name in self._attachments:
+                return name, signature, self._attachments[name]
+            
+            logger.debug("attach %s " % name)
+            signature, data = util.read_attachment(filepath)
+            self.signatures_cache.set(filepath, signature, entry.stat())
+            self._signatures[name] = signature
+            self._attachments[name] = EncodedAttachment(data, 
+                                                        content_type(name))
+            return name, signature, self._attachments[name]
+        
+        # attachments are hashed and encoded in a pool of `self.workers`
+        # threads. Results come back in the order of the walk.
+        nstubs = saved = 0
+        for name, signature, attachment in util.parallel_map(
+                process_attachment, self.attachment_entries(), self.workers):
+            signatures[name] = signature
+            if not with_attachments:
+                continue
+            elif attachment is None:
+                attachments[name] = {'stub': True}
+                nstubs += 1
+                saved += self.olddoc['_attachments'][name].get('length', 0)
+            else:
+                attachments[name] = attachment
+        if nstubs:
+            self._log_stubs(nstubs, saved)
+        
+        if self._body is None:
+            # all attachments were signed, forget the others
+            self.signatures_cache.prune()
+        self.signatures_cache.save()
+        
+        if self._body is None:
+            # signatures don't depend on the database, the body is
+            # serialized once.
+            built['couchapp']['signatures'] = signatures
+            self._body = json.dumps(built)
             
+        if not with_attachments:
+            attachments = None
+        self._doc = self._encoded(self.olddoc, attachments)
         return self._doc
+        
+    def content_hash(self):
+        """ return a hash of the document, attachments included, which
+        changes whenever a field or an attachment changes. Attachments
+        are only signed, using the signatures cache. """
+        if self._body is None:
+            self.doc(with_attachments=False)
+        return md5(self._body).hexdigest()
+        
+    def doc_for(self, olddoc, force=False):
+        """ return the document to save in a database where `olddoc`
+        is the current document ({} if there is none). Attachments with
+        the same signature in `olddoc` are stubs, unless `force` is 
+        True. 
+        
+        `doc` must have been called without database first, so all
+        attachments are encoded. Unlike `doc`, this function only reads
+        what `doc` kept and can be called from several threads.
+        """
+        remote = {}
+        if not force:
+            remote = self.remote_signatures(olddoc)
+        attachments = {}
+        for name, signature in self._built['couchapp']['signatures'].items():
+            if name in remote and remote[name] == signature:
+                attachments[name] = {'stub': True}
+            else:
+                attachments[name] = self._attachments[name]
+        return self._encoded(olddoc, attachments)
+        
+    def _encoded(self, olddoc, attachments=None):
+        # only `_rev` and `_attachments` differ between databases: each
+        # document gets its own top-level members, the others are shared
+        # and, like its cached JSON, must not be modified in place
+        doc = EncodedDoc(self._built, self._body)
+        if attachments is not None: 
+            doc['_attachments'] = attachments
+        if '_rev' in olddoc:
+            doc['_rev'] = olddoc['_rev']
+        return doc
     
-    def check_ignore(self, item):
-        for i in self.ignores:
-            match = re.match(i, item)
-            if match:
-                logger.debug("ignoring %s" % item)
-                return True
+    def remote_signatures(self, olddoc=None):
+        """ return signatures of attachments found in the document
+        saved on the server (`olddoc`, `self.olddoc` by default). """
+        if olddoc is None:
+            olddoc = self.olddoc
+        old_attachments = olddoc.get('_attachments') or {}
+        old_signatures = olddoc.get('couchapp', {}).get('signatures', {})
+        signatures = {}
+        for name, signature in old_signatures.items():
+            if name in old_attachments and signature:
+                signatures[name] = signature
+        return signatures
+        
+    def _log_stubs(self, nstubs, saved):
+        logger.info("%s unchanged attachments sent as stubs, %s bytes saved" %
+                        (nstubs, saved))
+    
+    def check_ignore(self, item, isdir=False):
+        """ return True if `item`, a path relative to the couchapp
+        folder, should be skipped. Ignored folders aren't walked. """
+        if self.ignore_rules.match(item, isdir):
+            logger.debug("ignoring %s" % item)
+            return True
         return False
     
+    def walk(self):
+        """ walk the couchapp folder once and return the list of its
+        entries (see `couchapp.walker`). The list is kept for
+        `attachments`. """
+        self._entries = list(walker.walk(self.docdir,
+                                         ignore=self.check_ignore))
+        return self._entries
+        
     def dir_to_fields(self, current_dir='', depth=0,
-                manifest=[]):
+                manifest=[], entries=None):
         """ process a directory and get all members """        
         
-        fields={}
-        if not current_dir:
-            current_dir = self.docdir
-        for name in os.listdir(current_dir):
-            current_path = os.path.join(current_dir, name)
-            rel_path = _replace_backslash(util.relpath(current_path, self.docdir))
-            if name.startswith("."):
-                continue
-            elif self.check_ignore(name):
-                continue
-            elif depth == 0 and name.startswith('_'):
-                # files starting with "_" are always "special"
-                continue
-            elif name == '_attachments':
+        if entries is None:
+            if not current_dir or current_dir == self.docdir:
+                relpath = ''
+            else:
+                relpath = util.relpath(current_dir, self.docdir).replace(
+                                                                os.sep, '/')
+            entries = walker.walk(current_dir or self.docdir, relpath,
+                                  depth, ignore=self.check_ignore)
+        
+        fields = {}
+        folders = {}
+        metas = []
+        for entry in entries:
+            if entry.kind in walker.ATTACHMENT_KINDS:
                 continue
-            elif depth == 0 and (name == 'couchapp' or name == 'couchapp.json'):
+            parent = entry.relpath.rpartition('/')[0]
+            container = folders.get(parent, fields)
+            name = entry.name
+            if entry.depth == 0 and name == 'couchapp':
                 # we are in app_meta
-                if name == "couchapp":
-                    manifest.append('%s/' % rel_path)
-                    content = self.dir_to_fields(current_path,
-                        depth=depth+1, manifest=manifest)
+                manifest.append('%s/' % entry.relpath)
+                if entry.kind == walker.DIR:
+                    content = folders[entry.relpath] = {}
                 else:
-                    manifest.append(rel_path)
-                    content = util.read_json(current_path)
-                    if not isinstance(content, dict):
-                        content = { "meta": content }
-                if 'signatures' in content:
-                    del content['signatures']
-
-                if 'manifest' in content:
-                    del content['manifest']
-
-                if 'objects' in content:
-                    del content['objects']
-                
-                if 'length' in content:
-                    del content['length']
-
-                if 'couchapp' in fields:
-                    fields['couchapp'].update(content)
-                else:
-                    fields['couchapp'] = content
-            elif os.path.isdir(current_path):
-                manifest.append('%s/' % rel_path)
-                fields[name] = self.dir_to_fields(current_path,
-                        depth=depth+1, manifest=manifest)
+                    content = self._read_field(entry.path, entry.stat())
+                metas.append(content)
+            elif entry.depth == 0 and name == 'couchapp.json':
+                manifest.append(entry.relpath)
+                content = self._read_field(entry.path, entry.stat(),
+                                           strict=True)
+                if not isinstance(content, dict):
+                    content = { "meta": content }
+                metas.append(content)
+            elif entry.kind == walker.DIR:
+                manifest.append('%s/' % entry.relpath)
+                container[name] = folders[entry.relpath] = {}
             else:
-                logger.debug("push %s" % rel_path)
-                  
-                content = ''  
-                if name.endswith('.json'):
-                    try:
-                        content = util.read_json(current_path)
-                    except ValueError:
-                        logger.error("Json invalid in %s" % current_path)           
-                else:
-                    try:
-                        content = util.read(current_path)
-                    except UnicodeDecodeError, e:
-                        logger.warning("%s isn't encoded in utf8" % current_path)
-                        content = util.read(current_path, utf8=False)
-                        try:
-                            content.encode('utf-8')
-                        except UnicodeError, e:
-                            logger.warning(
-                            "plan B didn't work, %s is a binary" % current_path)
-                            logger.warning("use plan C: encode to base64")   
-                            content = "base64-encoded;%s" % base64.b64encode(
-                                                                        content)
-
+                logger.debug("push %s" % entry.relpath)
+                content = self._read_field(entry.path, entry.stat())
                 
                 # remove extension
                 name, ext = os.path.splitext(name)
-                if name in fields and ext in ('.txt'):
+                if name in container and ext in ('.txt'):
                     logger.warning(
         "%(name)s is already in properties. Can't add (%(name)s%(ext)s)" % {
                             "name": name, "ext": ext })
                 else:
-                    manifest.append(rel_path)
-                    fields[name] = content
+                    manifest.append(entry.relpath)
+                    container[name] = content
+        
+        # folders are only complete once all entries are processed
+        for content in metas:
+            if not isinstance(content, dict):
+                continue
+            for key in ('signatures', 'manifest', 'objects', 'length'):
+                if key in content:
+                    del content[key]
+            if 'couchapp' in fields:
+                fields['couchapp'].update(content)
+            else:
+                fields['couchapp'] = content
         return fields
         
-    def _process_attachments(self, path, vendor=None):
-        """ the function processing directory to yeld
-        attachments. """
-        if os.path.isdir(path):
-            for root, dirs, files in os.walk(path):
-                for dirname in dirs:
-                    if dirname.startswith('.'):
-                        dirs.remove(dirname)
-                    elif self.check_ignore(dirname):
-                        dirs.remove(dirname)
-                if files:
-                    for filename in files:
-                        if filename.startswith('.'):
-                            continue
-                        elif self.check_ignore(filename):
-                            continue
-                        else:
-                            filepath = os.path.join(root, filename)
-                            name = util.relpath(filepath, path)
-                            if vendor is not None:
-                                name = os.path.join('vendor', vendor, name)
-                            name = _replace_backslash(name)
-                            yield (name, filepath)
+    def _read_field(self, path, st=None, strict=False):
+        """ read the content of a field file. Content is taken from
+        the fields cache when the file didn't change since last build.
+        If `strict` is True an invalid JSON file raises `AppError`
+        instead of being pushed empty. """
+        if st is None:
+            st = os.stat(path)
+        content = self.fields_cache.get(path, st, _missing)
+        if content is not _missing:
+            return content
+        
+        content = ''  
+        if path.endswith('.json') and strict:
+            try:
+                content = json.loads(util.read(path, force_read=True))
+            except ValueError, e:
+                raise AppError("invalid JSON in %s: %s" % (path, e))
+        elif path.endswith('.json'):
+            try:
+                content = json.loads(util.read(path, force_read=True))
+            except ValueError:
+                # not cached, the error is logged by each build until
+                # the file is fixed
+                logger.error("Json is invalid, can't load %s" % path)
+                return {}
+        else:
+            try:
+                content = util.read(path)
+            except UnicodeDecodeError, e:
+                logger.warning("%s isn't encoded in utf8" % path)
+                content = util.read(path, utf8=False)
+                try:
+                    content.encode('utf-8')
+                except UnicodeError, e:
+                    logger.warning(
+                    "plan B didn't work, %s is a binary" % path)
+                    logger.warning("use plan C: encode to base64")   
+                    content = "base64-encoded;%s" % base64.b64encode(
+                                                                content)
+        self.fields_cache.set(path, content, st)
+        return content
+        
+    def attachment_entries(self):
+        """ return the entries of attachments (vendor included) found
+        by the last walk of the couchapp folder. """
+        if self._entries is None:
+            self.walk()
+        return [entry for entry in self._entries
+                if entry.kind in walker.ATTACHMENT_KINDS]
                 
     def attachments(self):
         """ This function yield a tuple (name, filepath) corresponding
@@ -333,23 +605,8 @@ class LocalDoc(object):
         attachments are processed later to allow us to send attachments inline
         or one by one.
         """
-        # process main attachments
-        attachdir = os.path.join(self.docdir, "_attachments")
-        for attachment in self._process_attachments(attachdir):
-            yield attachment
-        vendordir = os.path.join(self.docdir, 'vendor')
-        if not os.path.isdir(vendordir):
-            logger.debug("%s don't exist" % vendordir)
-            return
-            
-        for name in os.listdir(vendordir):
-            current_path = os.path.join(vendordir, name)
-            if os.path.isdir(current_path):
-                attachdir = os.path.join(current_path, '_attachments')
-                if os.path.isdir(attachdir):
-                    for attachment in self._process_attachments(attachdir, 
-                                                        vendor=name):
-                        yield attachment
+        for entry in self.attachment_entries():
+            yield (entry.name, entry.path)
     
     def index(self, dburl, index):
         if index is not None:
@@ -358,5 +615,5 @@ class LocalDoc(object):
             return  "%s/%s/index.html" % (dburl, self.docid)
         return False
         
-def document(path, create=False, docid=None):
-    return LocalDoc(path, create=create, docid=docid)
+def document(path, create=False, docid=None, workers=1):
+    return LocalDoc(path, create=create, docid=docid, workers=workers)
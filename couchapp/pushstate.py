@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+State of `pushdocs`, stored in the `.couchapp` folder of the folder of
+documents. For each file or folder it keeps the hash of the document
+and the revision saved in each database, so documents unchanged since
+the last push can be skipped.
+"""
+
+from __future__ import with_statement
+
+from hashlib import md5
+import logging
+import os
+try:
+    import json
+except ImportError:
+    import couchapp.simplejson as json
+
+from couchapp import util
+
+STATE_FILE = os.path.join('.couchapp', 'pushdocs.json')
+
+logger = logging.getLogger(__name__)
+
+
+def doc_hash(doc):
+    """ return the hash of the content of a JSON document """
+    return md5(json.dumps(doc, sort_keys=True)).hexdigest()
+
+
+class PushState(object):
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = os.path.join(path, STATE_FILE)
+        self.docs = {}
+        self._dirty = False
+        self.load()
+
+    def __repr__(self):
+        return "<%s (%s)>" % (self.__class__.__name__, self.path)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        data = util.read_json(self.path)
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.docs = data.get('docs', {})
+
+    def unchanged(self, name, content_hash, dburi, rev):
+        """ return True if the document of the file or folder `name` has
+        the hash of its last push to `dburi` and is still at the
+        revision this push created. """
+        entry = self.docs.get(name)
+        if entry is None or rev is None:
+            return False
+        return entry['hash'] == content_hash and \
+                entry['revs'].get(dburi) == rev
+
+    def set(self, name, content_hash, dburi, rev):
+        """ record the revision saved in `dburi` """
+        entry = self.docs.get(name)
+        if entry is None or entry['hash'] != content_hash:
+            entry = self.docs[name] = {'hash': content_hash, 'revs': {}}
+        entry['revs'][dburi] = rev
+        self._dirty = True
+
+    def prune(self, names):
+        """ forget files and folders not in `names` """
+        for name in list(self.docs.keys()):
+            if name not in names:
+                del self.docs[name]
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        statedir = os.path.dirname(self.path)
+        tmpfile = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(statedir):
+                os.makedirs(statedir)
+            util.write_json(tmpfile, {
+                'version': self.version,
+                'docs': self.docs
+            })
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(tmpfile, self.path)
+            self._dirty = False
+        except (IOError, OSError), e:
+            logger.warning("can't save pushdocs state: %s" % e)
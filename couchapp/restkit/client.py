@@ -4,7 +4,6 @@
 # See the NOTICE for more information.
 
 import errno
-import gzip
 import logging
 import os
 import socket
@@ -17,7 +16,8 @@ import types
 import urlparse
 
 from couchapp.restkit import __version__
-from couchapp.restkit.errors import RequestError, InvalidUrl, RedirectLimit
+from couchapp.restkit.errors import RequestError, InvalidUrl, RedirectLimit, \
+BadStatusLine
 from couchapp.restkit.parser import Parser
 from couchapp.restkit import sock
 from couchapp.restkit import tee
@@ -42,6 +42,7 @@ class HttpResponse(object):
         self.version = self.http_client.parser.version
         self.headerslist = self.http_client.parser.headers
         self.final_url = self.http_client.final_url
+        self.stream = self.http_client.stream
         
         headers = {}
         for key, value in self.http_client.parser.headers:
@@ -49,8 +50,10 @@ class HttpResponse(object):
         self.headers = headers
         
         encoding = headers.get('content-encoding', None)
-        if encoding in ('gzip', 'deflate'):
-            self._body = gzip.GzipFile(fileobj=self.http_client.response_body)
+        if encoding in ('gzip', 'x-gzip', 'deflate') and \
+                self.http_client.decompress:
+            self._body = tee.DecompressInput(
+                    self.http_client.response_body, encoding)
         else:
             self._body = self.http_client.response_body
         self._body_eof = False
@@ -71,12 +74,13 @@ class HttpResponse(object):
           
     @property
     def body(self):
-        """ body in bytestring """
+        """ body in bytestring. A streamed body can only be read once. """
         if self._body_eof:
             self._body.seek(0)
         self._body_eof = True
         ret = self._body.read()
-        self._body.seek(0)
+        if not self.stream:
+            self._body.seek(0)
         return ret
         
     @property
@@ -102,7 +106,8 @@ class HttpConnection(object):
     def __init__(self, timeout=sock._GLOBAL_DEFAULT_TIMEOUT, 
             filters=None, follow_redirect=False, force_follow_redirect=False, 
             max_follow_redirect=MAX_FOLLOW_REDIRECTS, key_file=None, 
-            cert_file=None, pool_instance=None, response_class=None):
+            cert_file=None, pool_instance=None, response_class=None,
+            stream=False, max_body=sock.MAX_BODY, decompress=True):
             
         """ HttpConnection constructor
         
@@ -118,6 +123,15 @@ class HttpConnection(object):
         :param cert_file: the cert file to use with ssl
         :param pool_instance: a pool instance inherited from 
         `restkit.pool.PoolInterface`
+        :param stream: boolean, if True the body of responses is read from
+        the socket as it's read and can't be rewound. By default it's
+        kept in memory or in a temporary file.
+        :param max_body: int, size under which a body is kept in memory
+        rather than in a temporary file.
+        :param decompress: boolean, by default gzip and deflate encodings are
+        accepted and the body is decoded as it's read. An Accept-Encoding
+        header given to a request is sent as is. If False, the identity
+        encoding is asked by default and the body is never decoded.
         """
         self._sock = None
         self.timeout = timeout
@@ -140,6 +154,9 @@ class HttpConnection(object):
         self.response_filters = []
         self.cert_file = cert_file
         self.key_file = key_file
+        self.stream = stream
+        self.max_body = max_body
+        self.decompress = decompress
 
         for f in self.filters:
             self._add_filter(f)
@@ -200,10 +217,13 @@ class HttpConnection(object):
             self.connections.clean((self.host, self.port))
         
     def release_connection(self, address, socket):
-        if not self.connections:
+        """ give the socket back to the pool once the response has been
+        read entirely, unless the server closes the connection. """
+        if not self.connections or self.parser.should_close or \
+                not self.parser.body_eof():
             sock.close(socket)
         else:
-            self.connections.put(address, self._sock)
+            self.connections.put(address, socket)
         
     def parse_url(self, url):
         """ parse url and get host/port"""
@@ -257,7 +277,10 @@ class HttpConnection(object):
         ua = USER_AGENT
         normalized_headers = []
         content_len = None
-        accept_encoding = 'identity'
+        if self.decompress:
+            accept_encoding = 'gzip, deflate'
+        else:
+            accept_encoding = 'identity'
         chunked = False
         
         # default host
@@ -274,7 +297,7 @@ class HttpConnection(object):
             elif name == "Content-Length":
                 content_len = str(value)
             elif name == "Accept-Encoding":
-                accept_encoding = 'identity'
+                accept_encoding = value
             elif name == "Host":
                 host = value
             elif name == "Transfer-Encoding":
@@ -346,8 +369,15 @@ class HttpConnection(object):
         req_headers.append('\r\n')
         return req_headers
                
+    def can_resend(self):
+        """ a body given as an iterator can only be sent once """
+        body = self.body
+        return body is None or hasattr(body, 'seek') or \
+                isinstance(body, (types.StringTypes, list, tuple))
+        
     def do_send(self):
         tries = 2
+        body_sent = False
         while True:
             try:
                 # get socket
@@ -364,16 +394,21 @@ class HttpConnection(object):
                 log.debug('Start request: %s %s' % (self.method, self.url))
                 log.debug("Request headers: [%s]" % str(req_headers))
                 
-                self._sock.sendall("".join(req_headers))
-                
-                if self.body is not None:
+                # headers are sent with the body when it's small
+                headers = "".join(req_headers)
+                if self.body is None:
+                    self._sock.sendall(headers)
+                else:
+                    body_sent = True
                     if hasattr(self.body, 'read'):
                         if hasattr(self.body, 'seek'): self.body.seek(0)
-                        sock.sendfile(self._sock, self.body, self.chunked)
+                        sock.sendfile(self._sock, self.body, self.chunked,
+                                    headers)
                     elif isinstance(self.body, types.StringTypes):
-                        sock.send(self._sock, self.body, self.chunked)
+                        sock.send(self._sock, self.body, self.chunked, headers)
                     else:
-                        sock.sendlines(self._sock, self.body, self.chunked)
+                        sock.sendlines(self._sock, self.body, self.chunked,
+                                    headers)
                         
                     if self.chunked: # final chunk
                         sock.send_chunk(self._sock, "")
@@ -384,14 +419,17 @@ class HttpConnection(object):
                 raise
             except socket.error, e:
                 if e[0] not in (errno.EAGAIN, errno.ECONNABORTED, errno.EPIPE,
-                            errno.ECONNREFUSED) or tries <= 0:
+                            errno.ECONNREFUSED, errno.ECONNRESET) or \
+                            tries <= 0 or \
+                            (body_sent and not self.can_resend()):
                     self.clean_connections()
                     raise
-                if e[0] == errno.EPIPE:
-                    log.debug("Got EPIPE")
+                if e[0] in (errno.EPIPE, errno.ECONNRESET):
+                    log.debug("Got %s" % errno.errorcode[e[0]])
                     self.clean_connections()
             except:
-                if tries <= 0:
+                if tries <= 0 or (body_sent and not self.can_resend()):
+                    self.clean_connections()
                     raise
                 # we don't know what happend. 
                 self.clean_connections()
@@ -426,29 +464,31 @@ class HttpConnection(object):
         Get headers, set Body object and return HttpResponse
         """
         # read headers
-        headers = []
-        buf = StringIO()
-        data = self._sock.recv(sock.CHUNK_SIZE)
-        buf.write(data)
-        buf2 = self.parser.filter_headers(headers, buf)
-        if not buf2:
-            while True:
-                data = self._sock.recv(sock.CHUNK_SIZE)
-                if not data:
-                    break
-                buf.write(data)
-                buf2 = self.parser.filter_headers(headers, buf)
-                if buf2: 
-                    break
+        while True:
+            data = self._sock.recv(sock.CHUNK_SIZE)
+            self.parser.feed(data)
+            if self.parser.parse_headers() or not data:
+                break
+        if not self.parser.headers_done:
+            raise BadStatusLine("connection closed before the headers")
             
         log.debug("Start response: %s" % str(self.parser.status_line))
         log.debug("Response headers: [%s]" % str(self.parser.headers))
         
-        if (not self.parser.content_len and not self.parser.is_chunked):
+        address = (self.host, self.port)
+        if self.method == "HEAD":
+            # no body whatever the Content-Length
+            self.response_body = StringIO()
+            if self.connections and not self.parser.should_close:
+                self.connections.put(address, self._sock)
+            else:
+                sock.close(self._sock)
+        elif (not self.parser.content_len and not self.parser.is_chunked):
             if self.parser.should_close:
                 # http 1.0 or something like it. 
                 # we try to get missing body
                 log.debug("No content len an not chunked transfer, get body")
+                body = [self.parser.read_body()]
                 while True:
                     try:
                         chunk = self._sock.recv(sock.CHUNK_SIZE)
@@ -456,18 +496,22 @@ class HttpConnection(object):
                         break
                     if not chunk: 
                         break
-                    buf2.write(chunk)
+                    self.parser.feed(chunk)
+                    body.append(self.parser.read_body())
                 sock.close(self._sock)
-            buf2.seek(0)
-            self.response_body = buf2
-            
-        elif self.method == "HEAD":
-            self.response_body = StringIO()
-            sock.close(self._sock)
+                self.response_body = StringIO("".join(body))
+            else:
+                self.release_connection(address, self._sock)
+                self.response_body = StringIO()
         else:
-            self.response_body = tee.TeeInput(self._sock, self.parser, buf2, 
-                        maybe_close=lambda: self.release_connection(
-                                                    self.uri.netloc, self._sock))
+            skt = self._sock
+            maybe_close = lambda: self.release_connection(address, skt)
+            if self.stream:
+                self.response_body = tee.StreamInput(self._sock, self.parser,
+                        maybe_close=maybe_close)
+            else:
+                self.response_body = tee.TeeInput(self._sock, self.parser,
+                        maybe_close=maybe_close, max_body=self.max_body)
         
         # apply on response filters
         for af in self.response_filters:
@@ -81,5 +81,5 @@ class ParserError(Exception):
     """ Generic exception returned by the parser """
     pass
     
-class UnexpectedEOF(object):
+class UnexpectedEOF(Exception):
     """ exception raised when remote closed the connection """
\ No newline at end of file
@@ -33,7 +33,6 @@ import urlparse
 from couchapp.restkit.errors import InvalidUrl
 from couchapp.restkit.parser import Parser
 from couchapp.restkit import sock
-from couchapp.restkit import util
 from couchapp.restkit import __version__
 
 class BasicAuth(object):
@@ -94,17 +93,10 @@ class SimpleProxy(object):
             
                 # wait header
                 p = Parser.parse_response()
-                headers = []
-                buf = ""
-                buf = sock.recv(p_sock, util.CHUNK_SIZE)
-                i = self.parser.filter_headers(headers, buf)
-                if i == -1 and buf:
-                    while True:
-                        data = sock.recv(p_sock, util.CHUNK_SIZE)
-                        if not data: break
-                        buf += data
-                        i = self.parser.filter_headers(headers, buf)
-                        if i != -1: break
+                while True:
+                    data = p_sock.recv(sock.CHUNK_SIZE)
+                    p.feed(data)
+                    if p.parse_headers() or not data: break
                         
                 if p.status_int != 200:
                     raise ProxyError('Error status=%s' % p.status)
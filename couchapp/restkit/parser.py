@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -
 #
-# This file is part of restkit released under the MIT license. 
+# This file is part of restkit released under the MIT license.
 # See the NOTICE for more information.
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+"""
+Incremental HTTP parser. Data received from the socket is appended to a
+growable buffer and the parser only moves an offset over it: headers
+are searched from where the previous search stopped and body bytes are
+sliced out of the buffer with a memoryview, so each byte received is
+copied once whatever the number of calls. Consumed data is dropped
+from the buffer when it's more than half of it.
+"""
+
 import urlparse
 
 from couchapp.restkit.errors import BadStatusLine, ParserError
 
+# states of the chunked decoder
+CHUNK_SIZE, CHUNK_DATA, CHUNK_END, CHUNK_TRAILER, CHUNK_EOF = range(5)
+
+# consumed bytes kept in the buffer before compacting it
+COMPACT_SIZE = 64 * 1024
+
 class Parser(object):
     """ HTTP Parser compatible 1.0 & 1.1
     This parser can parse HTTP requests and response.
@@ -30,71 +41,101 @@ class Parser(object):
         self.path = ""
         self.query_string = ""
         self.fragment = ""
-        self._content_len = None
-        self.start_offset = 0
-        self.chunk_size = 0
-        self._chunk_eof = False
         self.type = ptype
         self._should_close = should_close
-        
+
+        self._buf = bytearray()
+        self._pos = 0
+        self._searched = 0
+        self._headers_done = False
+        # bytes of body or of the current chunk left to read, None
+        # until the connection is closed
+        self._remaining = 0
+        self._chunk_state = CHUNK_SIZE
+
     @classmethod
     def parse_response(cls, should_close=False):
         """ Return parser object for response"""
         return cls(should_close=should_close)
-        
+
     @classmethod
     def parse_request(cls):
         """ return parser object for requests """
         return cls(ptype='request')
-        
-    def filter_headers(self, headers, buf):
-        """ take a string as buffer and an header dict 
-        (empty or not). It return new position or -1 
-        if parsing isn't done. headers dict is updated
-        with new headers.
-        """
-        line = buf.getvalue()
-        i = line.find("\r\n\r\n")
-        if i != -1:
-            r = line[:i]
-            pos = i+4
-            buf2 = StringIO()
-            buf2.write(line[pos:])
-            return self.finalize_headers(headers, r, buf2)
-        return False
-        
-    def finalize_headers(self, headers, headers_str, buf2):
+
+    def feed(self, data):
+        """ append data received to the buffer """
+        if data:
+            self._buf.extend(data)
+
+    @property
+    def buffered(self):
+        """ number of bytes received and not parsed yet """
+        return len(self._buf) - self._pos
+
+    @property
+    def headers_done(self):
+        return self._headers_done
+
+    def parse_headers(self):
+        """ parse headers once they are all in the buffer. Return True
+        when they are parsed, False if more data is needed. """
+        if self._headers_done:
+            return True
+        i = self._buf.find("\r\n\r\n", self._searched)
+        if i == -1:
+            # the end of headers could start in the last 3 bytes
+            self._searched = max(self._pos, len(self._buf) - 3)
+            return False
+        self.finalize_headers(str(self._buf[self._pos:i]))
+        self._pos = i + 4
+        self._compact()
+        return True
+
+    def finalize_headers(self, headers_str):
         """ parse the headers """
         lines = headers_str.split("\r\n")
-                
+
         # parse first line of headers
         self._first_line(lines.pop(0))
-        
-        # parse headers. We silently ignore 
+
+        # parse headers. We silently ignore
         # bad headers' lines
-        
+
         _headers = {}
         hname = ""
         for line in lines:
             if line.startswith('\t') or line.startswith(' '):
-                headers[hname] += line.strip()
+                if hname:
+                    _headers[hname] += line.strip()
             else:
                 try:
                     hname =self._parse_headerl(_headers, line)
-                except ValueError: 
+                except ValueError:
                     # bad headers
                     pass
         self.headers_dict = _headers
-        headers.extend(list(_headers.items()))
-        self.headers = headers
-        self._content_len = int(_headers.get('Content-Length',0))
-        
+        self.headers = list(_headers.items())
+        self._headers_done = True
+
+        if self.is_chunked:
+            self._chunk_state = CHUNK_SIZE
+        elif 'Content-Length' in _headers:
+            try:
+                self._remaining = int(_headers['Content-Length'])
+            except ValueError:
+                raise ParserError("invalid Content-Length [%s]" %
+                        _headers['Content-Length'])
+        elif self.type == 'response' and self.should_close and \
+                self.status_int not in (204, 304) and \
+                not 100 <= self.status_int < 200:
+            # the body ends when the connection is closed
+            self._remaining = None
+
         if self.type == 'request':
             (_, _, self.path, self.query_string, self.fragment) = \
                 urlparse.urlsplit(self.raw_path)
-        
-        return buf2
-    
+
     def _parse_version(self, version):
         self.raw_version = version.strip()
         try:
@@ -102,10 +143,10 @@ class Parser(object):
             self.version = (int(major), int(minor))
         except IndexError:
             self.version = (1, 0)
-    
+
     def _first_line(self, line):
         """ parse first line """
-        self.status_line = status_line = line.strip()  
+        self.status_line = status_line = line.strip()
         try:
             if self.type == 'response':
                 version, self.status = status_line.split(None, 1)
@@ -122,7 +163,7 @@ class Parser(object):
                 self.raw_path = path
         except ValueError:
             raise BadStatusLine(line)
-        
+
     def _parse_headerl(self, hdrs, line):
         """ parse header line"""
         name, value = line.split(":", 1)
@@ -133,7 +174,7 @@ class Parser(object):
         else:
             hdrs[name] = value
         return name
-      
+
     @property
     def should_close(self):
         if self._should_close:
@@ -145,12 +186,12 @@ class Parser(object):
         elif self.version <= (1, 0):
             return True
         return False
-        
+
     @property
     def is_chunked(self):
         """ is TE: chunked ?"""
         return (self.headers_dict.get('Transfer-Encoding') == "chunked")
-        
+
     @property
     def content_len(self):
         """ return content length as integer or
@@ -163,72 +204,97 @@ class Parser(object):
             return int(content_length)
         else:
             return None
-            
+
     def body_eof(self):
-        """do we have all the body ?"""
+        """do we have all the body ? For a chunked body the trailers
+        must have been read too, so the connection can be reused."""
         if self.is_chunked:
-            if self._chunk_eof:
-                return True
-        elif self._content_len == 0:
-            return True
-        return False
-        
-    def read_chunk(self, buf):
-        line = buf.getvalue()
-        buf2 = StringIO()
-        
-        if not self.start_offset:
-            i = line.find("\r\n")
-            if i != -1:
-                chunk = line[:i].strip().split(";", 1)
-                chunk_size = int(chunk.pop(0), 16)
-                self.start_offset = i+2
-                self.chunk_size = chunk_size
-                
-        if self.start_offset:
-            if self.chunk_size == 0:
-                self._chunk_eof = True
-                buf2.write(line[:self.start_offset])
-                return '', buf2
-            else:
-                chunk = line[self.start_offset:self.start_offset+self.chunk_size]
-                end_offset = self.start_offset + self.chunk_size + 2
-                # we wait CRLF else return None
-                if len(buf.getvalue()) >= end_offset:
-                    buf2.write(line[end_offset:])
-                    self.chunk_size = 0
-                    return chunk, buf2
-        return '', buf
-        
-    def trailing_header(self, buf):
-        line = buf.getvalue()
-        i = line.find("\r\n\r\n")
-        return (i != -1)
-        
-    def filter_body(self, buf):
-        """\
-        Filter body and return a tuple: (body_chunk, new_buffer)
-        Both can be None, and new_buffer is always None if its empty.
-        """
-        dlen = len(buf.getvalue())
-        chunk = ''
+            return self._chunk_state == CHUNK_EOF
+        return self._remaining == 0
 
+    def read_body(self):
+        """ return the body decoded from the data in the buffer, '' if
+        more data is needed or if the body is read. """
+        if not self._headers_done or self.body_eof():
+            return ''
         if self.is_chunked:
             try:
-                chunk, buf2 = self.read_chunk(buf)
-            except Exception, e:
+                chunk = self._read_chunked()
+            except ValueError, e:
                 raise ParserError("chunked decoding error [%s]" % str(e))
-            
-            if not chunk:
-                return '', buf
         else:
-            buf2 = StringIO()
-            if self._content_len > 0:
-                nr = min(dlen, self._content_len)
-                chunk = buf.getvalue()[:nr]
-                self._content_len -= nr
-                
-        self.start_offset = 0
-        buf2.seek(0, 2)
-        return (chunk, buf2)
-    
+            end = len(self._buf)
+            if self._remaining is not None:
+                end = min(end, self._pos + self._remaining)
+                self._remaining -= end - self._pos
+            chunk = self._slice(self._pos, end)
+            self._pos = end
+        self._compact()
+        return chunk
+
+    def _read_chunked(self):
+        buf = self._buf
+        chunks = []
+        while True:
+            if self._chunk_state == CHUNK_SIZE:
+                i = buf.find("\r\n", self._pos)
+                if i == -1:
+                    break
+                line = str(buf[self._pos:i])
+                self._remaining = int(line.split(";", 1)[0].strip(), 16)
+                self._pos = i + 2
+                if self._remaining == 0:
+                    self._chunk_state = CHUNK_TRAILER
+                else:
+                    self._chunk_state = CHUNK_DATA
+            elif self._chunk_state == CHUNK_DATA:
+                end = min(len(buf), self._pos + self._remaining)
+                if end == self._pos:
+                    break
+                chunks.append(self._slice(self._pos, end))
+                self._remaining -= end - self._pos
+                self._pos = end
+                if self._remaining == 0:
+                    self._chunk_state = CHUNK_END
+            elif self._chunk_state == CHUNK_END:
+                if len(buf) - self._pos < 2:
+                    break
+                if buf[self._pos:self._pos + 2] != "\r\n":
+                    raise ValueError("missing CRLF after chunk")
+                self._pos += 2
+                self._chunk_state = CHUNK_SIZE
+            elif self._chunk_state == CHUNK_TRAILER:
+                # trailers are ignored, the empty line ends the body
+                i = buf.find("\r\n", self._pos)
+                if i == -1:
+                    break
+                empty = (i == self._pos)
+                self._pos = i + 2
+                if empty:
+                    self._chunk_state = CHUNK_EOF
+                    break
+            else:
+                break
+        return "".join(chunks)
+
+    def _slice(self, start, end):
+        if start == end:
+            return ''
+        view = memoryview(self._buf)
+        try:
+            return view[start:end].tobytes()
+        finally:
+            # the buffer can't be resized while a view exists
+            del view
+
+    def _compact(self):
+        """ drop consumed data when it's more than half of the buffer,
+        moving bytes only once in a while keeps the decoding linear """
+        if self._pos == len(self._buf):
+            del self._buf[:]
+        elif self._pos > COMPACT_SIZE and self._pos * 2 > len(self._buf):
+            del self._buf[:self._pos]
+        else:
+            return
+        self._searched = max(0, self._searched - self._pos)
+        self._pos = 0
@@ -9,6 +9,7 @@ Threadsafe Pool class
 
 import collections
 import threading
+import time
 
 from couchapp.restkit import sock
 
@@ -36,29 +37,43 @@ class _Host(object):
     def __init__(self, addr):
         object.__init__(self)
         self._addr = addr
+        # idle sockets and the time they were released, the last 
+        # released is reused first
         self.pool = collections.deque()    
 
 class ConnectionPool(PoolInterface):
-    def __init__(self, max_connections=4):
+    def __init__(self, max_connections=4, timeout=300):
         """ Initialize ConnectionPool
         :attr max_connections: int, the number of maximum connectioons 
         per _host_port
+        :attr timeout: int, number of seconds an idle connection is kept
         """
         self.max_connections = max_connections
+        self.timeout = timeout
         self.hosts = {}
+        self.hits = 0
+        self.misses = 0
         self._lock = threading.Lock()
         
+    def __repr__(self):
+        return "<%s %s hits, %s misses>" % (self.__class__.__name__,
+                                            self.hits, self.misses)
         
     def get(self, address):
+        """ return an idle connection to `address` or None. Connections
+        idle for too long or closed by the server are dropped. """
         self._lock.acquire()
         try:
             host = self.hosts.get(address)
-            if not host:
-                return None
-                
-            if host.pool:
-                return host.pool.popleft()
-                
+            while host and host.pool:
+                socket, released = host.pool.pop()
+                if time.time() - released > self.timeout or \
+                        not sock.is_connected(socket):
+                    sock.close(socket)
+                    continue
+                self.hits += 1
+                return socket
+            self.misses += 1
             return None
         finally:
             self._lock.release()
@@ -68,12 +83,12 @@ class ConnectionPool(PoolInterface):
         try:
             host = self.hosts.get(address)
             if not host:
-                host = _Host(address)
+                host = self.hosts[address] = _Host(address)
                 
-            if len(host.pool) > self.max_connections:
+            if len(host.pool) >= self.max_connections:
                 sock.close(socket)
                 return
-            host.pool.append(socket) 
+            host.pool.append((socket, time.time()))
         finally:
             self._lock.release()
 
@@ -83,7 +98,28 @@ class ConnectionPool(PoolInterface):
             host = self.hosts.get(address)
             if not host: return
             while host.pool:
-                socket = host.pool.popleft()
+                socket, released = host.pool.popleft()
                 sock.close(socket)
         finally:
-            self._lock.release()
\ No newline at end of file
+            self._lock.release()
+            
+    def clear(self):
+        for address in list(self.hosts.keys()):
+            self.clean(address)
+            
+            
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(pool_class=ConnectionPool, max_connections=4):
+    """ return the pool of `pool_class` shared by all resources using
+    it, so connections to a host are reused whatever the resource
+    doing the request. """
+    _pools_lock.acquire()
+    try:
+        key = (pool_class, max_connections)
+        if key not in _pools:
+            _pools[key] = pool_class(max_connections=max_connections)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
@@ -57,8 +57,9 @@ class Resource(object):
 
         pool_instance = client_opts.get('pool_instance')
         if not pool_instance and self.keepalive:
-            pool = self.pool_class(max_connections=self.max_connections)
-            client_opts['pool_instance'] = pool
+            # connections are shared by all resources
+            client_opts['pool_instance'] = pool.get_pool(self.pool_class,
+                                                    self.max_connections)
             
         if self.basic_auth_url:
             # detect credentials from url
@@ -3,7 +3,13 @@
 # This file is part of restkit released under the MIT license. 
 # See the NOTICE for more information.
 
+import errno
+import logging
+import os
+import select
 import socket
+import stat
+import sys
 
 CHUNK_SIZE = (16 * 1024)
 MAX_BODY = 1024 * 112
@@ -11,10 +17,48 @@ MAX_BODY = 1024 * 112
 try:
     import ssl # python 2.6
     _ssl_wrap_socket = ssl.wrap_socket
+    _SSLSocket = ssl.SSLSocket
 except ImportError:
     def _ssl_wrap_socket(sock, key_file, cert_file):
         ssl_sock = socket.ssl(sock, key_file, cert_file)
         return ssl_sock
+    _SSLSocket = None
+
+log = logging.getLogger(__name__)
+
+def _libc_sendfile():
+    """ sendfile(2) of the linux libc called with ctypes, with the
+    signature of os.sendfile. None on other platforms. """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        c_sendfile = ctypes.CDLL(None, use_errno=True).sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, nbytes):
+        sent = c_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                          nbytes)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+try:
+    from os import sendfile as _sendfile # python 3.3
+    _SENDFILE_IMPL = "os.sendfile"
+except ImportError:
+    try:
+        from sendfile import sendfile as _sendfile # pysendfile
+        _SENDFILE_IMPL = "pysendfile"
+    except ImportError:
+        _sendfile = _libc_sendfile()
+        _SENDFILE_IMPL = "libc"
         
 if not hasattr(socket, '_GLOBAL_DEFAULT_TIMEOUT'): # python < 2.6
     _GLOBAL_DEFAULT_TIMEOUT = object()
@@ -33,6 +77,9 @@ def connect(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, ssl=False,
             if timeout is not _GLOBAL_DEFAULT_TIMEOUT:
                 sock.settimeout(timeout)
             sock.connect(sa)
+            # large bodies are sent after the headers, don't let
+            # Nagle's algorithm delay them on kept-alive connections
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             if ssl:
                 sock = _ssl_wrap_socket(sock, key_file, cert_file)
             return sock
@@ -41,6 +88,16 @@ def connect(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, ssl=False,
                 sock.close()
     raise socket.error, msg
     
+def is_connected(skt):
+    """ return False if the idle socket `skt` was closed by the other
+    end. An idle connection has nothing to read: if select says it's
+    readable, the server closed it or sent garbage. """
+    try:
+        r, w, e = select.select([skt], [], [], 0.0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not r
+    
 def close(skt):
     if not skt: return
     try:
@@ -52,9 +109,16 @@ def send_chunk(sock, data):
     chunk = "".join(("%X\r\n" % len(data), data, "\r\n"))
     sock.sendall(chunk)
 
-def send(sock, data, chunked=False):
+def send(sock, data, chunked=False, prefix=""):
+    """ send `data`. `prefix`, the headers of the request, is sent
+    in the same write when `data` is small. """
     if chunked:
-        return send_chunk(sock, data)
+        data = "".join(("%X\r\n" % len(data), data, "\r\n"))
+    if prefix:
+        if len(data) <= CHUNK_SIZE:
+            sock.sendall(prefix + data)
+            return
+        sock.sendall(prefix)
     sock.sendall(data)
         
 def send_nonblock(sock, data, chunked=False):
@@ -68,15 +132,116 @@ def send_nonblock(sock, data, chunked=False):
     else:
         return send(sock, data, chunked)
     
-def sendlines(sock, lines, chunked=False):
-    for line in list(lines):
-        send(sock, line, chunked)
+def sendlines(sock, lines, chunked=False, prefix=""):
+    """ send the strings and files of `lines`. Consecutive small
+    strings are sent in one write. """
+    pending = []
+    size = 0
+    for line in lines:
+        if hasattr(line, 'read') or len(line) >= CHUNK_SIZE:
+            if pending:
+                send(sock, "".join(pending), chunked, prefix)
+                prefix = ""
+                pending = []
+                size = 0
+            if hasattr(line, 'read'):
+                sendfile(sock, line, chunked, prefix)
+            else:
+                send(sock, line, chunked, prefix)
+            prefix = ""
+        elif line:
+            pending.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                send(sock, "".join(pending), chunked, prefix)
+                prefix = ""
+                pending = []
+                size = 0
+    if pending:
+        send(sock, "".join(pending), chunked, prefix)
+    elif prefix:
+        sock.sendall(prefix)
         
-def sendfile(sock, data, chunked=False):
+def sendfile(sock, data, chunked=False, prefix=""):
+    """ send the file `data`. A regular file sent over a plain
+    connection without chunked encoding is sent by the kernel with
+    sendfile(2) when available (python 3.3, the pysendfile package or
+    the libc on linux), otherwise it's read by blocks. """
     if hasattr(data, 'seek'):
         data.seek(0)
-        
+
+    fileno = _sendfile_fileno(sock, data, chunked)
+    if fileno is not None:
+        offset = data.tell()
+        nbytes = os.fstat(fileno).st_size - offset
+        if nbytes > CHUNK_SIZE:
+            # headers and the start of the file in the same packet
+            _cork(sock, True)
+            try:
+                if prefix:
+                    sock.sendall(prefix)
+                log.debug("send %s bytes with sendfile(2) (%s)" % (nbytes,
+                        _SENDFILE_IMPL))
+                offset = _sendfile_all(sock, fileno, offset, nbytes)
+            finally:
+                _cork(sock, False)
+            data.seek(offset)
+            return
+
+    log.debug("send file by blocks of %s bytes" % CHUNK_SIZE)
     while True:
         binarydata = data.read(CHUNK_SIZE)
-        if binarydata == '': break
-        send(sock, binarydata, chunked)
\ No newline at end of file
+        if binarydata == '':
+            break
+        send(sock, binarydata, chunked, prefix)
+        prefix = ""
+    if prefix:
+        sock.sendall(prefix)
+
+def _sendfile_fileno(sock, data, chunked):
+    """ return the file descriptor of `data` if it can be sent with
+    sendfile(2): not with TLS or chunked encoding, which need the data
+    in user space. """
+    if _sendfile is None or chunked or not hasattr(data, 'fileno'):
+        return None
+    if _SSLSocket is not None and isinstance(sock, _SSLSocket):
+        return None
+    if not hasattr(sock, 'fileno'):
+        return None
+    try:
+        fileno = data.fileno()
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return None
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return fileno
+
+def _sendfile_all(sock, fileno, offset, nbytes):
+    """ send `nbytes` of the file from `offset`, return the new
+    offset """
+    timeout = sock.gettimeout()
+    while nbytes > 0:
+        try:
+            sent = _sendfile(sock.fileno(), fileno, offset, nbytes)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EAGAIN:
+                # sockets with a timeout are non-blocking
+                r, w, x = select.select([], [sock], [], timeout)
+                if not w:
+                    raise socket.timeout("timed out")
+                continue
+            raise socket.error(e.errno, e.strerror)
+        if not sent:
+            raise IOError("file truncated while it was sent")
+        offset += sent
+        nbytes -= sent
+    return offset
+
+def _cork(sock, cork):
+    if hasattr(socket, 'TCP_CORK'):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(cork))
+        except socket.error:
+            pass
@@ -9,6 +9,9 @@ TeeInput replace old FileInput. It use a file
 if size > MAX_BODY or memory. It's now possible to rewind
 read or restart etc ... It's based on TeeInput from Gunicorn.
 
+StreamInput reads the body straight from the socket, without keeping
+it. It can't be rewound. DecompressInput decodes a gzip or deflate body
+read from one of them.
 """
 import os
 try:
@@ -16,35 +19,35 @@ try:
 except ImportError:
     from StringIO import StringIO
 import tempfile
+import zlib
 
 from couchapp.restkit import sock
-from couchapp.restkit.errors import UnexpectedEOF
+from couchapp.restkit.errors import UnexpectedEOF, ParserError
 
 class TeeInput(object):
     
     CHUNK_SIZE = sock.CHUNK_SIZE
     
-    def __init__(self, socket, parser, buf, maybe_close=None):
-        self.buf = StringIO()
+    def __init__(self, socket, parser, maybe_close=None, max_body=sock.MAX_BODY):
         self.parser = parser
         self._sock = socket
         self.maybe_close = maybe_close
         self._is_socket = True
         self._len = parser.content_len
         
-        if self._len and self._len < sock.MAX_BODY:
+        if self._len and self._len < max_body:
             self.tmp = StringIO()
         else:
             self.tmp = tempfile.TemporaryFile()
         
-        if len(buf.getvalue()) > 0:
-            chunk, self.buf = parser.filter_body(buf)
+        if parser.buffered:
+            # body received with the headers
+            chunk = parser.read_body()
             if chunk:
                 self.tmp.write(chunk)
                 self.tmp.flush()
             self._finalize()
             self.tmp.seek(0)
-            del buf
                     
     @property
     def len(self):
@@ -139,9 +142,10 @@ class TeeInput(object):
     
     def close(self):
         if callable(self.maybe_close):
-            self.maybe_close()
+            # the socket is released only once
+            maybe_close, self.maybe_close = self.maybe_close, None
+            maybe_close()
         
-        self.buf = StringIO()
         self._is_socket = False
     
     def next(self):
@@ -156,32 +160,24 @@ class TeeInput(object):
 
     def _tee(self, length):
         """ fetch partial body"""
-        buf2 = self.buf
-        buf2.seek(0, 2) 
         while True:
-            chunk, buf2 = self.parser.filter_body(buf2)
+            chunk = self.parser.read_body()
             if chunk:
                 self.tmp.write(chunk)
                 self.tmp.flush()
                 self.tmp.seek(0, 2)
-                self.buf = StringIO()
-                self.buf.write(buf2.getvalue())
                 return chunk
 
             if self.parser.body_eof():
                 break
                 
             if not self._is_socket:
-                if self.parser.is_chunked:
-                    data = buf2.getvalue()
-                    if data.find("\r\n") >= 0:
-                        continue
                 raise UnexpectedEOF("remote closed the connection")
 
             data = self._sock.recv(length)
             if not data:
                 self._is_socket = False
-            buf2.write(data)
+            self.parser.feed(data)
         
         self._finalize()
         return ""
@@ -203,10 +199,193 @@ class TeeInput(object):
         if not len(dest.getvalue()) or not self._len:
             return dest.getvalue()
         while True:
-            if dest.len >= length: 
+            if dest.tell() >= length:
                 break
             data = self._tee(length - len(dest.getvalue()))
             if not data: 
                 break
             dest.write(data)
         return dest.getvalue()
+
+
+class BufferedStream(object):
+    """ file-like reading methods over `_fetch`, which returns the next
+    part of the body or '' at its end """
+
+    CHUNK_SIZE = sock.CHUNK_SIZE
+
+    _buf = ""
+
+    def read(self, length=-1):
+        chunks = [self._buf]
+        size = len(self._buf)
+        while length < 0 or size < length:
+            chunk = self._fetch(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        data = "".join(chunks)
+        if length < 0 or size <= length:
+            self._buf = ""
+            return data
+        self._buf = data[length:]
+        return data[:length]
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self._buf.find("\n", start) + 1
+            if end or 0 <= size <= len(self._buf):
+                break
+            start = len(self._buf)
+            chunk = self._fetch(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            self._buf += chunk
+        if not end:
+            end = len(self._buf)
+        if 0 <= size < end:
+            end = size
+        line, self._buf = self._buf[:end], self._buf[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        total = 0
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+            line = self.readline()
+        return lines
+
+    def next(self):
+        r = self.readline()
+        if not r:
+            raise StopIteration
+        return r
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def _fetch(self, length):
+        raise NotImplementedError
+
+
+class StreamInput(BufferedStream):
+    """ file-like object reading the body from the socket as it's
+    read. Nothing is kept, so the body can only be read once. """
+
+    def __init__(self, socket, parser, maybe_close=None):
+        self.parser = parser
+        self._sock = socket
+        self.maybe_close = maybe_close
+        self._is_socket = True
+        # body decoded and not read yet
+        self._buf = parser.read_body()
+        self._finalize()
+
+    @property
+    def len(self):
+        """ length of the body if known, else None """
+        return self.parser.content_len
+
+    def seek(self, offset, whence=0):
+        raise IOError("a streamed response can't be rewound")
+
+    def close(self):
+        if callable(self.maybe_close):
+            # the socket is released only once
+            maybe_close, self.maybe_close = self.maybe_close, None
+            maybe_close()
+        self._is_socket = False
+
+    def _fetch(self, length):
+        """ return the next part of the body, '' at its end """
+        while self._is_socket:
+            chunk = self.parser.read_body()
+            if chunk:
+                self._finalize()
+                return chunk
+
+            if self.parser.body_eof():
+                break
+
+            data = self._sock.recv(length)
+            if not data:
+                self.close()
+                raise UnexpectedEOF("remote closed the connection")
+            self.parser.feed(data)
+
+        self._finalize()
+        return ""
+
+    def _finalize(self):
+        if self.parser.body_eof():
+            self.close()
+
+
+class DecompressInput(BufferedStream):
+    """ file-like object decoding a body sent with the gzip or deflate
+    Content-Encoding as it's read. It can be rewound if `body` can. """
+
+    def __init__(self, body, encoding):
+        self.body = body
+        self.encoding = encoding
+        self._reset()
+
+    def _reset(self):
+        if self.encoding in ('gzip', 'x-gzip'):
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        self._decompressor = zlib.decompressobj(wbits)
+        self._started = False
+        self._eof = False
+        self._buf = ""
+
+    @property
+    def len(self):
+        """ the decoded length isn't known """
+        return None
+
+    def seek(self, offset, whence=0):
+        if whence != 0:
+            raise IOError("a compressed response can only be rewound")
+        self.body.seek(0)
+        self._reset()
+        if offset:
+            self.read(offset)
+
+    def close(self):
+        self.body.close()
+
+    def _fetch(self, length):
+        while not self._eof:
+            data = self.body.read(length)
+            if not data:
+                self._eof = True
+                return self._decompressor.flush()
+            try:
+                chunk = self._decompress(data)
+            except zlib.error, e:
+                raise ParserError("%s decoding error [%s]" % (self.encoding,
+                                                             str(e)))
+            if chunk:
+                return chunk
+        return ""
+
+    def _decompress(self, data):
+        if self._started or self.encoding != 'deflate':
+            return self._decompressor.decompress(data)
+        self._started = True
+        try:
+            return self._decompressor.decompress(data)
+        except zlib.error:
+            # some servers send raw deflate data, without the zlib header
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(data)
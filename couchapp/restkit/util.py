@@ -7,6 +7,7 @@ import os
 import time
 import urllib
 import warnings
+import zlib
 
 weekdayname = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 monthname = [None,
@@ -32,6 +33,12 @@ def to_bytestring(s):
         return s.encode('utf-8')
     return s
     
+def gzip_compress(data, level=6):
+    """ return `data` compressed in the gzip format, to be sent with a
+    `Content-Encoding: gzip` header """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(to_bytestring(data)) + compressor.flush()
+    
 def url_quote(s, charset='utf-8', safe='/:'):
     """URL encode a single string with a given encoding."""
     if isinstance(s, unicode):
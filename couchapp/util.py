@@ -5,13 +5,18 @@
 
 from __future__ import with_statement
 
+import binascii
 import codecs
+import collections
 from hashlib import md5
 import logging
+import mmap
 import os
 import pkg_resources
+import Queue
 import string
 import sys
+import threading
 
 try:
     import simplejson as json
@@ -22,6 +27,11 @@ from couchapp.errors import ScriptError
         
 logger = logging.getLogger(__name__)
 
+# files bigger than this size are memory mapped when loaded as attachment
+MMAP_THRESHOLD = 1024 * 1024
+# a multiple of 3 so blocks are encoded in base64 without padding
+ENCODE_BLOCK_SIZE = 3 * 64 * 1024
+
 try:#python 2.6, use subprocess
     import subprocess
     subprocess.Popen  # trigger ImportError early
@@ -280,6 +290,184 @@ def sign(fpath):
             return m.hexdigest()
     return ''
     
+def read_attachment(fpath):
+    """ read a file once and return its md5 signature and its content
+    encoded in base64. The file is hashed and encoded by blocks, big
+    files from a memory map, so the only full size copy held is the
+    encoded content.
+
+    :attr fpath: string, path of file
+
+    :return: tuple (md5 hexdigest, base64 data)
+    """
+    m = md5()
+    encoded = []
+    with open(fpath, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = fp
+        try:
+            while True:
+                block = data.read(ENCODE_BLOCK_SIZE)
+                if not block:
+                    break
+                m.update(block)
+                # b2a_base64 only adds a newline at the end
+                encoded.append(binascii.b2a_base64(block)[:-1])
+        finally:
+            if size >= MMAP_THRESHOLD:
+                data.close()
+    return m.hexdigest(), "".join(encoded)
+
+def parallel_map(func, items, workers=1):
+    """ apply `func` to each item of `items` using a pool of `workers`
+    threads.
+
+    :attr func: callable taking one item
+    :attr items: iterable
+    :attr workers: int, number of threads. 1 means no thread.
+
+    :return: list, results in the same order as `items`. If a call
+    raised, the error of the first item in error is raised again.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append((i, sys.exc_info()))
+
+    threads = []
+    for i in range(min(workers, len(items))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    if errors:
+        errors.sort()
+        exc_type, exc_value, tb = errors[0][1]
+        raise exc_type, exc_value, tb
+    return results
+
+def parallel_imap(func, iterable, workers=1):
+    """ like `itertools.imap` with up to `workers` calls of `func`
+    running at once in threads. Results are returned in the order of
+    `iterable`, an error is raised when the result of the item in error
+    would have been returned. Items are taken from `iterable` only when
+    a thread is free. """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    def call(item, result):
+        try:
+            result.append((True, func(item)))
+        except Exception:
+            result.append((False, sys.exc_info()))
+
+    def pop():
+        t, result = pending.popleft()
+        t.join()
+        ok, value = result[0]
+        if not ok:
+            exc_type, exc_value, tb = value
+            raise exc_type, exc_value, tb
+        return value
+
+    pending = collections.deque()
+    for item in iterable:
+        result = []
+        t = threading.Thread(target=call, args=(item, result))
+        t.setDaemon(True)
+        t.start()
+        pending.append((t, result))
+        if len(pending) >= workers:
+            yield pop()
+    while pending:
+        yield pop()
+
+def batches(iterable, size):
+    """ yield lists of `size` items of `iterable`, the last one may be
+    shorter. With a `size` of 0 or None, all items are in one list. """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if size and len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def prefetch(iterable, size=1):
+    """ iterate over `iterable` in a thread, computing up to `size` items
+    ahead of the consumer. Errors are raised when the item in error
+    would have been returned.
+
+    :attr iterable: iterable
+    :attr size: int, number of items computed in advance
+
+    :return: iterator
+    """
+    queue = Queue.Queue(max(1, size))
+    stop = threading.Event()
+
+    def put(item):
+        # give up when the consumer is gone
+        while not stop.isSet():
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception:
+            put((False, sys.exc_info()))
+            return
+        put((False, None))
+
+    t = threading.Thread(target=producer)
+    t.setDaemon(True)
+    t.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                exc_type, exc_value, tb = item
+                raise exc_type, exc_value, tb
+    finally:
+        # let the producer exit if the consumer stopped early
+        stop.set()
+    
 def read(fname, utf8=True, force_read=False):
     """ read file content"""
     if utf8:
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Walk the folder of a couchapp in one pass and yield typed entries:
+fields, JSON fields and folders of the document, attachments and vendor
+attachments.
+
+Folders are listed with `os.scandir` (or the `scandir` package) so the
+type of an entry usually comes with the listing. Each entry keeps its
+stat result, so a file is stat'ed at most once per walk whatever the
+number of caches looking at it.
+"""
+
+import os
+import stat as _stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+FIELD = "field"
+JSON_FIELD = "json_field"
+DIR = "dir"
+ATTACHMENT = "attachment"
+VENDOR_ATTACHMENT = "vendor_attachment"
+
+ATTACHMENT_KINDS = (ATTACHMENT, VENDOR_ATTACHMENT)
+
+
+class _DirEntry(object):
+    """ minimal `os.DirEntry` used when scandir isn't available """
+
+    __slots__ = ('name', 'path', '_stat', '_lstat')
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return _stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        if self._lstat is None:
+            try:
+                self._lstat = os.lstat(self.path)
+            except OSError:
+                return False
+        return _stat.S_ISLNK(self._lstat.st_mode)
+
+
+def listdir(path):
+    """ return the entries of the folder `path` """
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+class Entry(object):
+    """ a file or folder of a couchapp.
+
+    :attr kind: FIELD, JSON_FIELD, DIR, ATTACHMENT or VENDOR_ATTACHMENT
+    :attr name: name of the entry, for attachments the name in
+    `_attachments`
+    :attr path: path on the disk
+    :attr relpath: path relative to the couchapp folder, "/" separated
+    :attr depth: depth of the entry in the document fields
+    """
+
+    __slots__ = ('kind', 'name', 'path', 'relpath', 'depth', '_direntry')
+
+    def __init__(self, kind, name, relpath, depth, direntry):
+        self.kind = kind
+        self.name = name
+        self.path = direntry.path
+        self.relpath = relpath
+        self.depth = depth
+        self._direntry = direntry
+
+    def __repr__(self):
+        return "<%s %s (%s)>" % (self.__class__.__name__, self.kind,
+                                 self.relpath)
+
+    def stat(self):
+        """ stat result of the entry, symlinks are followed. Cached. """
+        return self._direntry.stat()
+
+
+def walk(path, relpath='', depth=0, ignore=None):
+    """ walk the fields folder `path` of a couchapp and yield an `Entry`
+    for each field, folder and attachment found.
+
+    :attr path: folder to walk, the couchapp folder by default
+    :attr relpath: path of `path` relative to the couchapp folder
+    :attr depth: depth of `path` in the document
+    :attr ignore: function called with the relative path of each file
+    and folder and True for folders. Entries for which it returns True
+    are skipped and ignored folders are not walked.
+
+    Folders are yielded before their content. Attachments of
+    `_attachments` and `vendor/<name>/_attachments` are yielded while
+    walking the fields, other folders starting with "_" at the top of
+    the couchapp are skipped.
+    """
+    if relpath:
+        prefix = relpath + '/'
+    else:
+        prefix = ''
+    for direntry in listdir(path):
+        name = direntry.name
+        if name.startswith('.'):
+            continue
+        rel = prefix + name
+        isdir = direntry.is_dir()
+        if ignore is not None and ignore(rel, isdir):
+            continue
+        if name == '_attachments':
+            if not isdir:
+                continue
+            if depth == 0:
+                for entry in walk_attachments(direntry.path, rel, '', ignore):
+                    yield entry
+            elif depth == 2 and rel.startswith('vendor/'):
+                vendor = rel.split('/')[1]
+                for entry in walk_attachments(direntry.path, rel,
+                        'vendor/%s/' % vendor, ignore, VENDOR_ATTACHMENT):
+                    yield entry
+        elif depth == 0 and name.startswith('_'):
+            # files starting with "_" are always "special"
+            continue
+        elif isdir:
+            yield Entry(DIR, name, rel, depth, direntry)
+            for entry in walk(direntry.path, rel, depth + 1, ignore):
+                yield entry
+        elif name.endswith('.json'):
+            yield Entry(JSON_FIELD, name, rel, depth, direntry)
+        else:
+            yield Entry(FIELD, name, rel, depth, direntry)
+
+
+def walk_attachments(path, relpath, prefix='', ignore=None,
+        kind=ATTACHMENT):
+    """ yield an `Entry` for each file in the attachments folder `path`.
+    The name of an entry is its path relative to `path` with `prefix`
+    prepended. Like `os.walk`, links to folders are not followed. """
+    for direntry in listdir(path):
+        name = direntry.name
+        if name.startswith('.'):
+            continue
+        rel = relpath + '/' + name
+        isdir = direntry.is_dir()
+        if ignore is not None and ignore(rel, isdir):
+            continue
+        if isdir:
+            if not direntry.is_symlink():
+                for entry in walk_attachments(direntry.path, rel,
+                        prefix + name + '/', ignore, kind):
+                    yield entry
+        else:
+            yield Entry(kind, prefix + name, rel, 0, direntry)
@@ -90,6 +90,11 @@ setup(
     install_requires = [
         'setuptools>=0.6b1'
     ],
+
+    extras_require = {
+        # sendfile(2) on other platforms than linux
+        'sendfile': ['pysendfile']
+    },
     
     options = dict(py2exe={},
                    bdist_mpkg=dict(zipdist=True,
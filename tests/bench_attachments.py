@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Benchmark of attachments loading: two reads (util.sign then base64 and
+whitespace removal) against the single pass of util.read_attachment.
+
+usage: python tests/bench_attachments.py [SIZE_MB] [NB_FILES]
+
+A tree of SIZE_MB (default 500) split in NB_FILES (default 50) files is
+created in a temporary folder. Each mode runs in its own process so the
+peak memory (ru_maxrss) of the modes can be compared.
+"""
+
+from __future__ import with_statement
+
+import base64
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchapp import util
+
+
+def load_two_pass(fpath):
+    signature = util.sign(fpath)
+    with open(fpath, 'rb') as f:
+        re_sp = re.compile('\s')
+        data = re_sp.sub('', base64.b64encode(f.read()))
+    return signature, data
+
+def load_single_pass(fpath):
+    return util.read_attachment(fpath)
+
+MODES = {
+    'two-pass': load_two_pass,
+    'single-pass': load_single_pass
+}
+
+def make_tree(path, size_mb, nb_files):
+    block = os.urandom(1024 * 1024)
+    per_file = max(1, size_mb / nb_files)
+    for i in range(nb_files):
+        with open(os.path.join(path, 'asset%s.bin' % i), 'wb') as f:
+            for j in range(per_file):
+                f.write(block)
+
+def run_mode(mode, path):
+    load = MODES[mode]
+    total = 0
+    for fname in sorted(os.listdir(path)):
+        signature, data = load(os.path.join(path, fname))
+        total += len(data)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print "%s %s %s %s" % (usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                           total)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        return run_mode(sys.argv[2], sys.argv[3])
+
+    size_mb = 500
+    nb_files = 50
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        nb_files = int(sys.argv[2])
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, size_mb, nb_files)
+        print "%s MB in %s files" % (size_mb, nb_files)
+        print "%-12s %10s %10s %14s" % ("mode", "user (s)", "sys (s)",
+                                        "peak rss (MB)")
+        for mode in ('two-pass', 'single-pass'):
+            p = subprocess.Popen([sys.executable, __file__, '--run', mode,
+                                  path], stdout=subprocess.PIPE)
+            utime, stime, maxrss, total = p.communicate()[0].split()
+            print "%-12s %10.2f %10.2f %14.1f" % (mode, float(utime),
+                    float(stime), int(maxrss) / 1024.0)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
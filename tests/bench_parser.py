@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Benchmark of the decoding of a large chunked response: the incremental
+parser of couchapp.restkit against the StringIO buffers it replaced,
+which copied the whole pending buffer on each call and again in
+TeeInput for each chunk.
+
+usage: python tests/bench_parser.py [SIZE_MB] [CHUNK_KB...]
+
+A chunked response of SIZE_MB (default 100) megabytes is decoded for
+each chunk size (default 4, 64 and 1024 KB), received 16KB at a time
+like restkit reads its socket. Time is the decoding only.
+"""
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchapp.restkit.parser import Parser
+from couchapp.restkit.sock import CHUNK_SIZE
+
+HEADERS = "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+
+def make_response(size, chunk_size):
+    chunk = "%x\r\n%s\r\n" % (chunk_size, "x" * chunk_size)
+    nb_chunks, rest = divmod(size, chunk_size)
+    data = [HEADERS, chunk * nb_chunks]
+    if rest:
+        data.append("%x\r\n%s\r\n" % (rest, "x" * rest))
+    data.append("0\r\n\r\n")
+    return "".join(data)
+
+def recv(data):
+    for i in xrange(0, len(data), CHUNK_SIZE):
+        yield data[i:i + CHUNK_SIZE]
+
+def decode_legacy(data):
+    """ filter_body and TeeInput._tee of the previous parser, without
+    the headers """
+    buf = StringIO()
+    start_offset = chunk_size = 0
+    received = 0
+    stream = recv(data[len(HEADERS):])
+    while True:
+        line = buf.getvalue()
+        buf2 = StringIO()
+        chunk = ''
+        if not start_offset:
+            i = line.find("\r\n")
+            if i != -1:
+                chunk_size = int(line[:i].strip().split(";", 1)[0], 16)
+                start_offset = i + 2
+        if start_offset:
+            if chunk_size == 0:
+                return received
+            end_offset = start_offset + chunk_size + 2
+            if len(buf.getvalue()) >= end_offset:
+                chunk = line[start_offset:start_offset + chunk_size]
+                buf2.write(line[end_offset:])
+        if chunk:
+            received += len(chunk)
+            start_offset = 0
+            buf = StringIO()
+            buf.write(buf2.getvalue())
+            continue
+        buf.seek(0, 2)
+        buf.write(stream.next())
+
+def decode_incremental(data):
+    p = Parser.parse_response()
+    received = 0
+    for data in recv(data):
+        p.feed(data)
+        if p.parse_headers():
+            received += len(p.read_body())
+    assert p.body_eof()
+    return received
+
+MODES = (
+    ('legacy', decode_legacy),
+    ('incremental', decode_incremental)
+)
+
+def main():
+    size = 100
+    chunk_sizes = [4, 64, 1024]
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        chunk_sizes = [int(arg) for arg in sys.argv[2:]]
+    size = size * 1024 * 1024
+
+    print "%s MB chunked response, received %s bytes at a time" % (
+            size / (1024 * 1024), CHUNK_SIZE)
+    print "%-12s %10s %10s %10s" % ("mode", "chunk (KB)", "time (s)",
+                                    "MB/s")
+    for chunk_size in chunk_sizes:
+        data = make_response(size, chunk_size * 1024)
+        for mode, func in MODES:
+            start = time.time()
+            received = func(data)
+            elapsed = time.time() - start
+            assert received == size
+            print "%-12s %10s %10.3f %10.1f" % (mode, chunk_size, elapsed,
+                    size / elapsed / (1024 * 1024))
+        del data
+
+if __name__ == '__main__':
+    main()
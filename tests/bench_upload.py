@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Benchmark of attachment uploads: PUT of a large file read by blocks
+and sent with sendall, against sendfile(2) which lets the kernel copy
+the file to the socket. The CPU time is the one of the client process,
+the server reading the requests runs in another process.
+
+usage: python tests/bench_upload.py [SIZE_MB] [NB_PUTS]
+
+NB_PUTS (default 5) files of SIZE_MB (default 100) megabytes are sent
+over a kept-alive connection to localhost. The sendfile mode needs
+python 3.3, the pysendfile package or linux.
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import time
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchapp.restkit import sock
+from couchapp.restkit.client import HttpConnection
+from couchapp.restkit.pool import ConnectionPool
+
+RESPONSE = "HTTP/1.1 201 Created\r\nContent-Length: 0\r\n\r\n"
+
+def handle(conn):
+    buf = bytearray(1024 * 1024)
+    view = memoryview(buf)
+    while True:
+        head = ""
+        while "\r\n\r\n" not in head:
+            data = conn.recv(4096)
+            if not data:
+                return
+            head += data
+        head, body = head.split("\r\n\r\n", 1)
+        length = 0
+        for line in head.split("\r\n")[1:]:
+            name, value = line.split(":", 1)
+            if name.lower() == "content-length":
+                length = int(value)
+        length -= len(body)
+        while length > 0:
+            n = conn.recv_into(view, min(length, len(buf)))
+            if not n:
+                return
+            length -= n
+        conn.sendall(RESPONSE)
+
+def serve(listener):
+    while True:
+        conn, addr = listener.accept()
+        try:
+            handle(conn)
+        finally:
+            conn.close()
+
+def put_files(url, path, nb_puts):
+    c = HttpConnection(pool_instance=ConnectionPool())
+    for i in range(nb_puts):
+        f = open(path, 'rb')
+        try:
+            resp = c.request(url, 'PUT', body=f,
+                    headers={'Content-Type': 'application/octet-stream'})
+            resp.body
+            assert resp.status_int == 201
+        finally:
+            f.close()
+
+def upload(url, path, nb_puts, use_sendfile):
+    saved = sock._sendfile
+    if not use_sendfile:
+        sock._sendfile = None
+    try:
+        start = time.time()
+        cpu = sum(os.times()[:2])
+        put_files(url, path, nb_puts)
+        return time.time() - start, sum(os.times()[:2]) - cpu
+    finally:
+        sock._sendfile = saved
+
+def main():
+    size = 100
+    nb_puts = 5
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        nb_puts = int(sys.argv[2])
+    if multiprocessing is None:
+        print "multiprocessing is needed to run the server"
+        return
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    url = "http://127.0.0.1:%s/db/doc/att" % listener.getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(listener,))
+    server.daemon = True
+    server.start()
+    listener.close()
+
+    fd, path = tempfile.mkstemp()
+    try:
+        block = os.urandom(1024 * 1024)
+        f = os.fdopen(fd, 'wb')
+        for i in range(size):
+            f.write(block)
+        f.close()
+
+        print "%s PUT of %s MB" % (nb_puts, size)
+        print "%-10s %10s %10s %10s" % ("mode", "time (s)", "MB/s",
+                                        "cpu (s)")
+        modes = [('read', False)]
+        if sock._sendfile is not None:
+            modes.append(('sendfile', True))
+        else:
+            print "sendfile(2) isn't available, install pysendfile"
+        print "sendfile(2) from %s" % sock._SENDFILE_IMPL
+        for mode, use_sendfile in modes:
+            elapsed, cpu = upload(url, path, nb_puts, use_sendfile)
+            print "%-10s %10.3f %10.1f %10.3f" % (mode, elapsed,
+                    size * nb_puts / elapsed, cpu)
+    finally:
+        os.unlink(path)
+        server.terminate()
+
+if __name__ == '__main__':
+    main()
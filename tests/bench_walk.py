@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Benchmark of the walk of a couchapp folder: listdir, isdir and relpath
+for each field then os.walk for attachments, against the single pass of
+couchapp.walker. Calls to listdir, stat and lstat are counted, as well
+as abspath calls made by relpath.
+
+usage: python tests/bench_walk.py [NB_DIRS] [NB_FILES]
+
+A couchapp with NB_DIRS (default 50) folders of NB_FILES (default 40)
+files in its fields and in its attachments is created in a temporary
+folder. Counts are for the listdir + stat fallback used when scandir
+isn't available; os.scandir also saves the stat of folders.
+"""
+
+from __future__ import with_statement
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from couchapp import util, walker
+
+COUNTED = (
+    (os, 'listdir'),
+    (os, 'stat'),
+    (os, 'lstat'),
+    (os.path, 'abspath')
+)
+
+def counter(counts, name, func):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+def count_calls():
+    counts = {}
+    originals = []
+    for mod, name in COUNTED:
+        func = getattr(mod, name)
+        originals.append((mod, name, func))
+        counts[name] = 0
+        setattr(mod, name, counter(counts, name, func))
+    def restore():
+        for mod, name, func in originals:
+            setattr(mod, name, func)
+    return counts, restore
+
+def walk_legacy(appdir):
+    def fields(current_dir, depth):
+        for name in os.listdir(current_dir):
+            current_path = os.path.join(current_dir, name)
+            util.relpath(current_path, appdir)
+            if name.startswith('.'):
+                continue
+            elif depth == 0 and name.startswith('_'):
+                continue
+            elif os.path.isdir(current_path):
+                fields(current_path, depth + 1)
+            else:
+                # stat of the fields cache
+                os.stat(current_path)
+    fields(appdir, 0)
+
+    attachdir = os.path.join(appdir, '_attachments')
+    for root, dirs, files in os.walk(attachdir):
+        util.relpath(root, appdir)
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            util.relpath(filepath, attachdir)
+            # stat of the signatures cache
+            os.stat(filepath)
+
+def walk_single_pass(appdir):
+    for entry in walker.walk(appdir):
+        if entry.kind != walker.DIR:
+            entry.stat()
+
+MODES = (
+    ('legacy', walk_legacy),
+    ('single-pass', walk_single_pass)
+)
+
+def make_tree(path, nb_dirs, nb_files):
+    for root in ('lib', '_attachments'):
+        for i in range(nb_dirs):
+            dirpath = os.path.join(path, root, 'dir%s' % i)
+            os.makedirs(dirpath)
+            for j in range(nb_files):
+                util.write(os.path.join(dirpath, 'file%s.js' % j), '')
+
+def main():
+    nb_dirs = 50
+    nb_files = 40
+    if len(sys.argv) > 1:
+        nb_dirs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        nb_files = int(sys.argv[2])
+
+    path = tempfile.mkdtemp()
+    try:
+        make_tree(path, nb_dirs, nb_files)
+        print "%s folders of %s files in fields and attachments" % (nb_dirs,
+                                                                  nb_files)
+        print "%-12s %8s %8s %8s %8s %10s" % ("mode", "listdir", "stat",
+                                             "lstat", "abspath", "time (s)")
+        for mode, func in MODES:
+            counts, restore = count_calls()
+            start = time.time()
+            try:
+                func(path)
+            finally:
+                restore()
+            print "%-12s %8s %8s %8s %8s %10.3f" % (mode, counts['listdir'],
+                    counts['stat'], counts['lstat'], counts['abspath'],
+                    time.time() - start)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
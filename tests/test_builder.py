@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from couchapp import builder
+from couchapp.errors import MacroError
+from couchapp.localdoc import LocalDoc
+
+class BuilderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dirs = []
+        for i in range(3):
+            app_dir = os.path.join(self.tmp_dir, 'app%s' % i)
+            shutil.copytree(os.path.join(os.path.dirname(__file__), 
+                            'testapp'), app_dir)
+            self.app_dirs.append(app_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testOrder(self):
+        docs = list(builder.build(self.app_dirs, workers=2))
+        self.assert_([doc.docid for doc in docs] == ["_design/app0", 
+                        "_design/app1", "_design/app2"])
+        for doc in docs:
+            expected = LocalDoc(doc.docdir).doc()
+            self.assert_(doc.doc() == expected)
+
+    def testError(self):
+        f = open(os.path.join(self.app_dirs[1], 'shows', 'broken.js'), 'w')
+        f.write("function(doc, req) {\n  // !code lib/missing.js\n}")
+        f.close()
+        docs = builder.build(self.app_dirs, workers=2)
+        self.assert_(docs.next().docid == "_design/app0")
+        self.assertRaises(MacroError, docs.next)
+
+if __name__ == '__main__':
+    unittest.main()
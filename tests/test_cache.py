@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from couchapp.cache import FileCache, SignatureCache, clear
+from couchapp.localdoc import LocalDoc, logger as localdoc_logger
+from couchapp import util
+
+class FieldsCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dir = os.path.join(self.tmp_dir, 'my-app')
+        os.makedirs(os.path.join(self.app_dir, 'views', 'example'))
+        util.write(os.path.join(self.app_dir, 'views', 'example', 'map.js'),
+                "function(doc) { emit(doc._id, null); }")
+        util.write_json(os.path.join(self.app_dir, 'settings.json'),
+                {"title": "test"})
+        util.write(os.path.join(self.app_dir, 'language'), "javascript")
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def _fields_cache(self):
+        return FileCache(self.app_dir, 'fields')
+
+    def testCacheIsSaved(self):
+        doc = LocalDoc(self.app_dir).doc()
+        cache = self._fields_cache()
+        self.assert_('language' in cache.entries)
+        self.assert_('settings.json' in cache.entries)
+        self.assert_('views/example/map.js' in cache.entries)
+        self.assert_(doc['settings'] == {"title": "test"})
+
+    def testCacheHit(self):
+        doc1 = LocalDoc(self.app_dir).doc()
+        localdoc = LocalDoc(self.app_dir)
+        localdoc.fields_cache.save = lambda: None
+        doc2 = localdoc.doc()
+        self.assert_(localdoc.fields_cache.hits == 3)
+        self.assert_(localdoc.fields_cache.misses == 0)
+        self.assert_(doc1['views'] == doc2['views'])
+        self.assert_(doc1['couchapp']['manifest'] == \
+                doc2['couchapp']['manifest'])
+
+    def testCacheInvalidation(self):
+        LocalDoc(self.app_dir).doc()
+        fpath = os.path.join(self.app_dir, 'language')
+        util.write(fpath, "erlang")
+        st = os.stat(fpath)
+        os.utime(fpath, (st.st_atime, st.st_mtime + 1))
+        localdoc = LocalDoc(self.app_dir)
+        localdoc.fields_cache.save = lambda: None
+        doc = localdoc.doc()
+        self.assert_(doc['language'] == "erlang")
+        self.assert_(localdoc.fields_cache.misses == 1)
+
+    def testInvalidJsonNotCached(self):
+        util.write(os.path.join(self.app_dir, 'settings.json'), '{"title": ')
+        for i in range(2):
+            localdoc = LocalDoc(self.app_dir)
+            errors = []
+            localdoc_logger.error = errors.append
+            try:
+                doc = localdoc.doc()
+            finally:
+                del localdoc_logger.error
+            self.assert_(doc['settings'] == {})
+            self.assert_(len(errors) == 1)
+            self.assertFalse('settings.json' in self._fields_cache().entries)
+
+    def testNullCached(self):
+        util.write(os.path.join(self.app_dir, 'settings.json'), 'null')
+        LocalDoc(self.app_dir).doc()
+        localdoc = LocalDoc(self.app_dir)
+        cached = []
+        localdoc.fields_cache.set = lambda *args: cached.append(args)
+        doc = localdoc.doc()
+        self.assert_(doc['settings'] is None)
+        # the file isn't read again
+        self.assert_(cached == [])
+
+    def testCachePruned(self):
+        LocalDoc(self.app_dir).doc()
+        os.unlink(os.path.join(self.app_dir, 'language'))
+        LocalDoc(self.app_dir).doc()
+        self.assertFalse('language' in self._fields_cache().entries)
+
+class SignatureCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        attachdir = os.path.join(self.tmp_dir, '_attachments')
+        os.makedirs(attachdir)
+        self.fpath = os.path.join(attachdir, 'index.html')
+        util.write(self.fpath, "<html></html>")
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def testSign(self):
+        cache = SignatureCache(self.tmp_dir)
+        self.assert_(cache.sign(self.fpath) == util.sign(self.fpath))
+        cache.save()
+
+        cache = SignatureCache(self.tmp_dir)
+        self.assert_(cache.sign(self.fpath) == util.sign(self.fpath))
+        self.assert_(cache.hits == 1)
+
+    def testSignMissingFile(self):
+        cache = SignatureCache(self.tmp_dir)
+        self.assert_(cache.sign(os.path.join(self.tmp_dir, 'nofile')) == '')
+
+    def testClear(self):
+        cache = SignatureCache(self.tmp_dir)
+        cache.sign(self.fpath)
+        cache.save()
+        self.assert_(os.path.isfile(cache.path))
+        clear(self.tmp_dir)
+        self.assertFalse(os.path.exists(cache.path))
+
+if __name__ == '__main__':
+    unittest.main()
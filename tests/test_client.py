@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+import couchapp.simplejson as json
+from couchapp import client
+from couchapp.client import Database, EncodedAttachment, EncodedDoc, \
+        encode_doc
+from couchapp.errors import BulkSaveError, ResourceNotFound
+from couchapp.localdoc import LocalDoc
+
+class EncodedDocTests(unittest.TestCase):
+
+    def setUp(self):
+        self.members = {
+            "_id": "_design/test",
+            "views": {"all": {"map": "function(doc) {}"}}
+        }
+        self.body = json.dumps(self.members)
+
+    def testEncode(self):
+        doc = EncodedDoc(self.members, self.body)
+        doc['_rev'] = "1-abc"
+        doc1 = json.loads(encode_doc(doc))
+        self.assert_(doc1 == dict(self.members, _rev="1-abc"))
+
+    def testAttachments(self):
+        members = dict(self.members, _attachments={
+            "a.txt": EncodedAttachment("aGVsbG8=", "text/plain"),
+            "b.txt": {"stub": True}
+        })
+        doc = EncodedDoc(members, self.body)
+        self.assertEqual(json.loads(encode_doc(doc)), dict(self.members, 
+                _attachments={
+                    "a.txt": {"data": "aGVsbG8=", "content_type": "text/plain"},
+                    "b.txt": {"stub": True}
+                }))
+
+        # without cached body
+        doc['language'] = "javascript"
+        doc1 = json.loads(encode_doc(doc))
+        self.assertEqual(doc1['language'], "javascript")
+        self.assertEqual(doc1['_attachments']['a.txt']['data'], "aGVsbG8=")
+
+    def testInvalidation(self):
+        doc = EncodedDoc(self.members, self.body)
+        doc['language'] = "javascript"
+        self.assert_(json.loads(encode_doc(doc))['language'] == "javascript")
+
+    def testAttachmentsKeepBody(self):
+        doc = EncodedDoc(self.members, self.body)
+        doc['_attachments'] = {"b.txt": {"stub": True}}
+        self.assert_(doc._body is self.body)
+        self.assertEqual(json.loads(encode_doc(doc)), dict(self.members,
+                _attachments={"b.txt": {"stub": True}}))
+
+class LazyDatabaseTests(unittest.TestCase):
+
+    def testNoRequest(self):
+        # nothing listens on port 1, any request would fail
+        db = Database("http://127.0.0.1:1/couchapp-test/")
+        self.assert_(db.dbname == "couchapp-test")
+        self.assert_(db.server_uri == "http://127.0.0.1:1")
+
+    def testVersionCached(self):
+        client._server_versions["http://127.0.0.1:1"] = (1, 0, 2)
+        try:
+            db = Database("http://127.0.0.1:1/couchapp-test")
+            self.assert_(db.version == (1, 0, 2))
+            self.assertFalse(db.accepts_multipart())
+        finally:
+            del client._server_versions["http://127.0.0.1:1"]
+
+class Response(object):
+
+    def __init__(self, json_body):
+        self.json_body = json_body
+
+def read_payload(payload):
+    """ the bytes sent for `payload`: a string or an iterator of strings
+    and files """
+    if isinstance(payload, basestring):
+        return payload
+    parts = []
+    for part in payload:
+        if hasattr(part, 'read'):
+            part = part.read()
+        parts.append(part)
+    return "".join(parts)
+
+class StubDatabase(Database):
+    """ database answering requests with `handler(method, path, body)`
+    instead of sending them. JSON bodies are decoded. Requests are 
+    recorded, as well as the headers and bytes of each body sent. """
+
+    def __init__(self, handler, version=None):
+        Database.__init__(self, "http://127.0.0.1:1/couchapp-test",
+                          version=version)
+        self.handler = handler
+        self.requests = []
+        self.sent = []
+
+    def request(self, method, path=None, payload=None, headers=None, 
+            **params):
+        body = None
+        if payload is not None:
+            body = read_payload(payload)
+            self.sent.append((headers or {}, body))
+            if (headers or {}).get('Content-Type', 'application/json') == \
+                    'application/json':
+                body = json.loads(body)
+        self.requests.append((method, path, body))
+        return Response(self.handler(method, path, body))
+
+def all_docs(method, path, body):
+    """ _all_docs of a database where "missing" doesn't exist and
+    "deleted" was deleted """
+    rows = []
+    for key in body['keys']:
+        if key == 'missing':
+            rows.append({"key": key, "error": "not_found"})
+        elif key == 'deleted':
+            rows.append({"id": key, "key": key, 
+                         "value": {"rev": "2-d", "deleted": True}})
+        else:
+            rows.append({"id": key, "key": key, 
+                         "value": {"rev": "1-%s" % key}})
+    return {"rows": rows}
+
+class LastRevsTests(unittest.TestCase):
+
+    def testBatches(self):
+        db = StubDatabase(all_docs)
+        revs = db.last_revs(['a', 'missing', 'b', 'deleted', 'c'], 
+                            batch_size=2)
+        self.assertEqual(revs, {'a': '1-a', 'b': '1-b', 'c': '1-c'})
+        self.assertEqual(db.requests, [
+            ('POST', '/_all_docs', {"keys": ['a', 'missing']}),
+            ('POST', '/_all_docs', {"keys": ['b', 'deleted']}),
+            ('POST', '/_all_docs', {"keys": ['c']})
+        ])
+
+    def testNoIds(self):
+        db = StubDatabase(all_docs)
+        self.assertEqual(db.last_revs([]), {})
+        self.assertEqual(db.requests, [])
+
+class SaveDocsTests(unittest.TestCase):
+
+    def testBulkSaveError(self):
+        def bulk_docs(method, path, body):
+            rows = []
+            for doc in body['docs']:
+                if doc['_id'] == 'b':
+                    rows.append({"id": "b", "error": "conflict", 
+                                 "reason": "Document update conflict."})
+                else:
+                    rows.append({"id": doc['_id'], "rev": "1-x"})
+            return rows
+        db = StubDatabase(bulk_docs)
+        docs = [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'c'}]
+        try:
+            db.save_docs(docs, batch_size=2)
+        except BulkSaveError, e:
+            self.assert_(e.docs is docs)
+            self.assertEqual(e.errors, [{'_id': 'b'}])
+        else:
+            self.fail("BulkSaveError not raised")
+        self.assertEqual(docs[0], {'_id': 'a', '_rev': '1-x'})
+        self.assertEqual(docs[2], {'_id': 'c', '_rev': '1-x'})
+        self.assertEqual(len(db.requests), 2)
+
+class ViewTests(unittest.TestCase):
+
+    def testKeys(self):
+        db = StubDatabase(lambda method, path, body: {"rows": []})
+        self.assertEqual(db.view('d/v', keys=[1, "a"]), {"rows": []})
+        db.view('d/v')
+        self.assertEqual(db.requests, [
+            ('POST', '/_design/d/_view/v', {"keys": [1, "a"]}),
+            ('GET', '/_design/d/_view/v', None)
+        ])
+
+def saved(method, path, body):
+    return {"ok": True, "id": path.lstrip('/'), "rev": "1-x"}
+
+class FilesTestCase(unittest.TestCase):
+    """ attachments written in a temporary folder """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _attachments(self, sizes):
+        attachments = []
+        for size in sizes:
+            name = "att-%s.bin" % size
+            filepath = os.path.join(self.tmp_dir, name)
+            with open(filepath, 'wb') as f:
+                f.write("".join([chr(i % 256) for i in range(size)]))
+            attachments.append((name, filepath, "application/octet-stream"))
+        return attachments
+
+    def _expected(self, doc, attachments):
+        expected = dict(doc, _attachments=dict(doc.get('_attachments', {})))
+        for name, filepath, content_type in attachments:
+            with open(filepath, 'rb') as f:
+                expected['_attachments'][name] = {
+                    "content_type": content_type,
+                    "data": base64.b64encode(f.read())
+                }
+        return expected
+
+class StreamTests(FilesTestCase):
+
+    def testNoMembers(self):
+        self.assertEqual(json.loads("".join(client.iter_json_doc({}, []))),
+                         {"_attachments": {}})
+
+    def testStubsOnly(self):
+        doc = {"_id": "_design/test", "_attachments": {
+                    "a.txt": {"stub": True}, "b.txt": {"stub": True}}}
+        self.assertEqual(json.loads("".join(client.iter_json_doc(doc, []))),
+                         doc)
+
+    def testAttachments(self):
+        size = client.STREAM_BLOCK_SIZE
+        attachments = self._attachments([0, 1, 2, size, size + 1, 
+                                         3 * size + 2])
+        doc = {"_id": "_design/test", "views": {}, 
+               "_attachments": {"stub.txt": {"stub": True}}}
+        parts = list(client.iter_json_doc(doc, attachments))
+        self.assertEqual(json.loads("".join(parts)), 
+                         self._expected(doc, attachments))
+        # files are read by blocks
+        self.assert_(max([len(part) for part in parts]) < 2 * size)
+        # the document isn't changed
+        self.assertEqual(doc["_attachments"], {"stub.txt": {"stub": True}})
+
+    def testSaveDoc(self):
+        # --upload stream
+        attachments = self._attachments([10, client.STREAM_BLOCK_SIZE + 7])
+        db = StubDatabase(saved)
+        doc = {"_id": "_design/test", "_rev": "1-a"}
+        db.save_doc(doc, attachments=attachments)
+        headers, body = db.sent[0]
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(json.loads(body), self._expected(
+                    {"_id": "_design/test", "_rev": "1-a"}, attachments))
+        self.assertEqual(doc['_rev'], "1-x")
+
+    def testPushStream(self):
+        app_dir = os.path.join(self.tmp_dir, 'my-app')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'testapp'),
+                        app_dir)
+        def handler(method, path, body):
+            if method == 'GET':
+                raise ResourceNotFound("missing")
+            return saved(method, path, body)
+        db = StubDatabase(handler)
+        localdoc = LocalDoc(app_dir)
+        localdoc.push([db], upload="stream")
+        headers, body = db.sent[0]
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        doc = json.loads(body)
+        self.assertEqual(doc, json.loads(encode_doc(LocalDoc(app_dir).doc())))
+        self.assertEqual(sorted(doc['_attachments'].keys()), 
+                         ['index.html', 'style/main.css'])
+
+def parse_multipart(body, boundary):
+    """ return the headers and content of each part of a multipart
+    body """
+    parts = body.split('--%s' % boundary)
+    assert parts[0] == '' and parts[-1] == '--'
+    result = []
+    for part in parts[1:-1]:
+        headers, content = part.split('\r\n\r\n', 1)
+        assert content.endswith('\r\n')
+        result.append((headers.strip(), content[:-2]))
+    return result
+
+class MultipartTests(FilesTestCase):
+
+    def _check(self, headers, body, doc, attachments):
+        content_type, boundary = headers['Content-Type'].split('; ')
+        self.assertEqual(content_type, 'multipart/related')
+        boundary = boundary[len('boundary="'):-1]
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        
+        parts = parse_multipart(body, boundary)
+        self.assertEqual(parts[0][0], 'Content-Type: application/json')
+        sent = json.loads(parts[0][1])
+        expected = dict(doc, _attachments=dict(doc.get('_attachments', {})))
+        for name, filepath, content_type in attachments:
+            expected['_attachments'][name] = {"follows": True, 
+                    "content_type": content_type, 
+                    "length": os.path.getsize(filepath)}
+        self.assertEqual(sent, expected)
+        
+        # parts follow the order of the entries in `_attachments`
+        follows = [name for name, entry in sent['_attachments'].items()
+                   if entry.get('follows')]
+        follows.sort(key=lambda name: parts[0][1].index(json.dumps(name)))
+        self.assertEqual(len(parts), len(follows) + 1)
+        for name, (part_headers, content) in zip(follows, parts[1:]):
+            filepath = os.path.join(self.tmp_dir, name)
+            with open(filepath, 'rb') as f:
+                self.assertEqual(content, f.read())
+                
+    def testBody(self):
+        size = client.STREAM_BLOCK_SIZE
+        attachments = self._attachments([0, 5, size + 1, 3 * size])
+        doc = {"_id": "_design/test", "_rev": "1-a", 
+               "_attachments": {"stub.txt": {"stub": True}}}
+        body, length = client.multipart_doc(doc, attachments, "b0undary")
+        body = read_payload(body)
+        self._check({'Content-Type': 'multipart/related; boundary="b0undary"',
+                     'Content-Length': str(length)}, body, doc, attachments)
+        
+    def testSaveDoc(self):
+        attachments = self._attachments([10, 20])
+        db = StubDatabase(saved)
+        doc = {"_id": "_design/test"}
+        db.save_doc(doc, attachments=attachments, multipart=True)
+        headers, body = db.sent[0]
+        self._check(headers, body, {"_id": "_design/test"}, attachments)
+        self.assertEqual(doc['_rev'], "1-x")
+        
+    def testAcceptsMultipart(self):
+        for version, accepts in (((0, 0, 0), False), ((1, 0, 2), False),
+                                 ((1, 1, 0), True), ((1, 2, 1), True), 
+                                 ((2, 0, 0), True)):
+            db = Database("http://127.0.0.1:1/couchapp-test", 
+                          version=version)
+            self.assertEqual(db.accepts_multipart(), accepts)
+            
+    def _push(self, version, upload=None):
+        app_dir = os.path.join(self.tmp_dir, 'my-app')
+        if not os.path.isdir(app_dir):
+            shutil.copytree(os.path.join(os.path.dirname(__file__), 
+                            'testapp'), app_dir)
+        def handler(method, path, body):
+            if method == 'GET':
+                raise ResourceNotFound("missing")
+            return saved(method, path, body)
+        db = StubDatabase(handler, version=version)
+        LocalDoc(app_dir).push([db], upload=upload)
+        return db.sent[0]
+        
+    def testAutoUpload(self):
+        # unknown versions and 1.0 get inline attachments
+        for version in (client.UNKNOWN_VERSION, (1, 0, 2)):
+            headers, body = self._push(version)
+            self.assertEqual(headers['Content-Type'], 'application/json')
+            self.assert_('Transfer-Encoding' not in headers)
+            attachments = json.loads(body)['_attachments']
+            self.assert_(attachments['index.html']['data'])
+        headers, body = self._push((1, 1, 0))
+        self.assert_(headers['Content-Type'].startswith('multipart/related'))
+        # the upload mode asked for is used whatever the version
+        headers, body = self._push((1, 1, 0), "inline")
+        self.assertEqual(headers['Content-Type'], 'application/json')
+
+class BuildOnceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dir = os.path.join(self.tmp_dir, 'my-app')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'testapp'),
+                        self.app_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testBuildOnce(self):
+        localdoc = LocalDoc(self.app_dir)
+        doc1 = localdoc.doc()
+        def fail():
+            raise AssertionError("the couchapp folder is walked again")
+        localdoc.walk = fail
+        doc2 = localdoc.doc()
+        self.assert_(doc1 == doc2)
+        self.assert_(encode_doc(doc2) == encode_doc(doc1))
+        self.assert_(json.loads(str(localdoc)) == json.loads(
+                                                        encode_doc(doc1)))
+
+if __name__ == '__main__':
+    unittest.main()
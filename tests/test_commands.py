@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import couchapp.simplejson as json
+from couchapp import builder, commands, util
+from couchapp.client import Database, encode_doc
+from couchapp.errors import ResourceNotFound
+from couchapp.localdoc import LocalDoc
+
+TESTAPP = os.path.join(os.path.dirname(__file__), 'testapp')
+
+class Response(object):
+
+    def __init__(self, json_body):
+        self.json_body = json_body
+
+class BulkDatabase(Database):
+    """ database answering _all_docs and _bulk_docs requests with the
+    revisions of `revs`. Documents of `conflicts` are in conflict the
+    first time they are saved. """
+
+    def __init__(self, revs=None, conflicts=()):
+        Database.__init__(self, "http://127.0.0.1:1/couchapp-test")
+        self.revs = revs or {}
+        self.conflicts = list(conflicts)
+        self.requests = []
+
+    def request(self, method, path=None, payload=None, headers=None, 
+            **params):
+        if method == 'GET':
+            raise ResourceNotFound("missing")
+        body = json.loads(payload)
+        self.requests.append((path, body))
+        if path == '/_all_docs':
+            rows = []
+            for key in body['keys']:
+                if key in self.revs:
+                    rows.append({"id": key, "key": key, 
+                                 "value": {"rev": self.revs[key]}})
+                else:
+                    rows.append({"key": key, "error": "not_found"})
+            return Response({"rows": rows})
+        rows = []
+        for doc in body['docs']:
+            docid = doc['_id']
+            if docid in self.conflicts or \
+                    doc.get('_rev') != self.revs.get(docid):
+                if docid in self.conflicts:
+                    self.conflicts.remove(docid)
+                rows.append({"id": docid, "error": "conflict"})
+                continue
+            self.revs[docid] = "%s-x" % (int(
+                    self.revs.get(docid, "0").split('-')[0]) + 1)
+            rows.append({"id": docid, "rev": self.revs[docid]})
+        return Response(rows)
+
+class AppsDatabase(Database):
+    """ database of a server of version `version` recording the ids of
+    the documents saved by each request. `before_save` is called with
+    these ids before they are saved. """
+
+    def __init__(self, version, before_save=None):
+        Database.__init__(self, "http://127.0.0.1:1/couchapp-test",
+                          version=version)
+        self.before_save = before_save
+        self.opened = []
+        self.saves = []
+
+    def request(self, method, path=None, payload=None, headers=None, 
+            **params):
+        if method == 'GET':
+            self.opened.append(path)
+            raise ResourceNotFound("missing")
+        if path == '/_bulk_docs':
+            docids = [doc['_id'] for doc in json.loads(payload)['docs']]
+        else:
+            # the body is read as it would be sent
+            if not isinstance(payload, basestring):
+                for part in payload:
+                    if hasattr(part, 'read'):
+                        part.read()
+            docids = [path]
+        if self.before_save is not None:
+            self.before_save(docids)
+        self.saves.append(docids)
+        if path == '/_bulk_docs':
+            return Response([{"id": docid, "rev": "1-x"} 
+                             for docid in docids])
+        return Response({"ok": True, "id": path, "rev": "1-x"})
+
+class Conf(object):
+
+    def __init__(self, dbs):
+        self.dbs = dbs
+        self.pushed = []
+        self.hooks = {'post-push': [self.post_push]}
+
+    def post_push(self, path, hook_type, **kwargs):
+        self.pushed.append(os.path.basename(path))
+
+    def get_dbs(self, dest):
+        return self.dbs
+
+class ResolveConflictsTests(unittest.TestCase):
+
+    def testResolve(self):
+        db = BulkDatabase({'a': '2-a', 'b': '3-b'})
+        docs = [{'_id': 'a', '_rev': '1-a'}, {'_id': 'b'}, {'_id': 'gone'}]
+        self.assertEqual(commands.resolve_conflicts(db, docs), 
+                         [{'_id': 'a', '_rev': '2-a'}, 
+                          {'_id': 'b', '_rev': '3-b'}])
+        # one request for all documents
+        self.assertEqual(db.requests, [
+            ('/_all_docs', {"keys": ['a', 'b', 'gone']})])
+
+class PushdocsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for docid in ('a', 'b', 'c'):
+            util.write_json(os.path.join(self.tmp_dir, '%s.json' % docid),
+                            {"title": docid})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _bulk_docs(self, db):
+        return [sorted([doc['_id'] for doc in body['docs']])
+                for path, body in db.requests if path == '/_bulk_docs']
+
+    def testSavedOnce(self):
+        db = BulkDatabase({'b': '1-x'})
+        commands.pushdocs(Conf([db]), self.tmp_dir, None)
+        self.assertEqual([path for path, body in db.requests], 
+                         ['/_all_docs', '/_bulk_docs'])
+        self.assertEqual(self._bulk_docs(db), [['a', 'b', 'c']])
+        self.assertEqual(db.revs, {'a': '1-x', 'b': '2-x', 'c': '1-x'})
+
+        # nothing changed, nothing is sent
+        db.requests = []
+        commands.pushdocs(Conf([db]), self.tmp_dir, None)
+        self.assertEqual(self._bulk_docs(db), [])
+
+    def testConflict(self):
+        db = BulkDatabase({'b': '1-x'}, conflicts=['b'])
+        commands.pushdocs(Conf([db]), self.tmp_dir, None)
+        # only the document in conflict is saved again, with its revision
+        self.assertEqual(self._bulk_docs(db), [['a', 'b', 'c'], ['b']])
+        self.assertEqual(db.requests[-2], ('/_all_docs', {"keys": ['b']}))
+        self.assertEqual(db.revs, {'a': '1-x', 'b': '2-x', 'c': '1-x'})
+
+    def testOnePool(self):
+        # folders of all batches are built by the same processes
+        folders = ['d%s' % i for i in range(6)]
+        for name in folders:
+            shutil.copytree(TESTAPP, os.path.join(self.tmp_dir, name))
+        docids = sorted(['_design/%s' % name for name in folders] + 
+                        ['a', 'b', 'c'])
+        pools = []
+        def Pool(*args):
+            pools.append(Pool_(*args))
+            return pools[-1]
+        Pool_ = builder.multiprocessing.Pool
+        builder.multiprocessing.Pool = Pool
+        try:
+            db = BulkDatabase()
+            commands.pushdocs(Conf([db]), self.tmp_dir, None, batch_size=3,
+                              jobs=2)
+            output = os.path.join(self.tmp_dir, '.export.json')
+            commands.pushdocs(Conf([db]), self.tmp_dir, None, batch_size=3,
+                              jobs=2, export=True, output=output)
+        finally:
+            builder.multiprocessing.Pool = Pool_
+        self.assertEqual(len(pools), 2)
+        bulk_docs = self._bulk_docs(db)
+        self.assertEqual([len(docs) for docs in bulk_docs], [3, 3, 3])
+        self.assertEqual(sorted(sum(bulk_docs, [])), docids)
+        docs = json.loads(util.read(output))['docs']
+        self.assertEqual(sorted([doc['_id'] for doc in docs]), docids)
+
+class PushappsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.apps = ['app%s' % i for i in range(5)]
+        for app in self.apps:
+            shutil.copytree(TESTAPP, os.path.join(self.tmp_dir, app))
+        self.docids = ['_design/%s' % app for app in self.apps]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testBulkBatches(self):
+        # inline uploads are saved by batches
+        for jobs in (1, 2):
+            db = AppsDatabase((1, 0, 2))
+            conf = Conf([db])
+            commands.pushapps(conf, self.tmp_dir, None, batch_size=2, 
+                              jobs=jobs)
+            self.assertEqual(db.saves, [self.docids[:2], self.docids[2:4],
+                                        self.docids[4:]])
+            self.assertEqual(conf.pushed, self.apps)
+
+    def testBatchBytes(self):
+        # apps are saved once their documents reach APPS_BATCH_BYTES
+        doc = LocalDoc(os.path.join(self.tmp_dir, 'app0')).doc()
+        size = doc.encoded_size()
+        self.assert_(size > len(encode_doc(doc)) * 0.9)
+        saved = commands.APPS_BATCH_BYTES
+        commands.APPS_BATCH_BYTES = 2 * size
+        try:
+            db = AppsDatabase((1, 0, 2))
+            conf = Conf([db])
+            commands.pushapps(conf, self.tmp_dir, None, batch_size=0)
+        finally:
+            commands.APPS_BATCH_BYTES = saved
+        self.assertEqual(db.saves, [self.docids[:2], self.docids[2:4],
+                                    self.docids[4:]])
+        self.assertEqual(conf.pushed, self.apps)
+
+    def testOrder(self):
+        # uploads end in any order, post-push hooks run in folder order
+        def before_save(docids):
+            time.sleep(0.02 * (5 - self.docids.index(docids[0])))
+        db = AppsDatabase((1, 1, 0), before_save)
+        conf = Conf([db])
+        commands.pushapps(conf, self.tmp_dir, None, concurrency=3)
+        self.assertEqual(sorted(db.saves), [[docid] for docid in self.docids])
+        self.assertNotEqual(db.saves, [[docid] for docid in self.docids])
+        self.assertEqual(conf.pushed, self.apps)
+
+    def testMixed(self):
+        bulk_db = AppsDatabase((1, 0, 2))
+        db = AppsDatabase((1, 1, 0))
+        conf = Conf([bulk_db, db])
+        commands.pushapps(conf, self.tmp_dir, None, concurrency=2, 
+                          batch_size=0)
+        self.assertEqual(bulk_db.saves, [self.docids])
+        self.assertEqual(db.saves, [[docid] for docid in self.docids])
+        self.assertEqual(conf.pushed, self.apps)
+
+    def testBackPressure(self):
+        blocked = threading.Event()
+        release = threading.Event()
+        def before_save(docids):
+            blocked.set()
+            release.wait(10)
+        db = AppsDatabase((1, 0, 2), before_save)
+        conf = Conf([db])
+        t = threading.Thread(target=commands.pushapps, 
+                args=(conf, self.tmp_dir, None), kwargs={'batch_size': 1})
+        t.start()
+        try:
+            blocked.wait(10)
+            time.sleep(0.3)
+            # the first app is being saved, 2 are queued and one is
+            # waiting for the queue
+            self.assertEqual(len(db.opened), 4)
+        finally:
+            release.set()
+            t.join()
+        self.assertEqual(db.saves, [[docid] for docid in self.docids])
+        self.assertEqual(conf.pushed, self.apps)
+
+    def testUploadError(self):
+        for jobs in (1, 2):
+            def before_save(docids):
+                if docids == ['_design/app1']:
+                    raise ValueError("upload failed")
+            db = AppsDatabase((1, 1, 0), before_save)
+            conf = Conf([db])
+            self.assertRaises(ValueError, commands.pushapps, conf, 
+                              self.tmp_dir, None, concurrency=2, jobs=jobs)
+            self.assertEqual(conf.pushed, ['app0'])
+            # the build stage stopped
+            time.sleep(0.3)
+            opened = len(db.opened)
+            time.sleep(0.3)
+            self.assertEqual(len(db.opened), opened)
+            self.assert_(opened < len(self.apps))
+
+if __name__ == '__main__':
+    unittest.main()
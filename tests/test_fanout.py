@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import unittest
+
+from couchapp.fanout import select_dbs
+
+DBNAMES = ["_users", "_replicator", "userdb-6a6f", "userdb-626f62", 
+           "userdb-626f62/archive", "blog"]
+
+class SelectDbsTests(unittest.TestCase):
+
+    def testGlob(self):
+        assert select_dbs(DBNAMES, "userdb-*") == ["userdb-6a6f",
+                "userdb-626f62", "userdb-626f62/archive"]
+        assert select_dbs(DBNAMES, "userdb-6?6f") == ["userdb-6a6f"]
+        assert select_dbs(DBNAMES, "*") == ["userdb-6a6f", "userdb-626f62",
+                "userdb-626f62/archive", "blog"]
+
+    def testRegex(self):
+        assert select_dbs(DBNAMES, "userdb-[0-9a-f]+$", 
+                regex=True) == ["userdb-6a6f", "userdb-626f62"]
+
+    def testSystemDbs(self):
+        assert select_dbs(DBNAMES, "_*") == ["_users", "_replicator"]
+
+if __name__ == '__main__':
+    unittest.main()
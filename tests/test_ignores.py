@@ -20,6 +20,7 @@ import tempfile
 import json
 import os
 from shutil import rmtree
+from couchapp.ignores import IgnoreRules
 from couchapp.localdoc import LocalDoc as doc
 
 class IgnoresTests(unittest.TestCase):
@@ -66,6 +67,72 @@ class IgnoresTests(unittest.TestCase):
         """
         for i in self.testdata.keys():
             assert self.doc.check_ignore(i) == self.testdata[i]
-        
+
+class IgnoreRulesTests(unittest.TestCase):
+
+    def testNames(self):
+        rules = IgnoreRules(["^CVS", "glob:*.swp", "glob:build/"])
+        assert rules.match("CVS")
+        assert rules.match("_attachments/CVS", True)
+        assert rules.match("views/test/map.js.swp")
+        assert not rules.match("views/test/map.js")
+        assert rules.match("_attachments/build", True)
+        assert not rules.match("_attachments/build")
+
+    def testPaths(self):
+        rules = IgnoreRules(["glob:/_attachments/node_modules/",
+                "glob:vendor/**/test", "path:^lists/.*\\.bak$"])
+        assert rules.match("_attachments/node_modules", True)
+        assert not rules.match("_attachments/js/node_modules", True)
+        assert rules.match("vendor/test")
+        assert rules.match("vendor/couchapp/_attachments/test")
+        assert not rules.match("_attachments/vendor/test")
+        assert rules.match("lists/feed.js.bak")
+        assert not rules.match("shows/feed.js.bak")
+
+    def testInvalidPattern(self):
+        rules = IgnoreRules(["(unbalanced", "glob:*.tmp"])
+        assert rules.match("a.tmp")
+        assert not rules.match("(unbalanced")
+
+class IgnoresWalkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for path in ("_attachments/index.html",
+                     "_attachments/node_modules/lib/index.js",
+                     "_attachments/js/app.js",
+                     "views/test/map.js",
+                     "views/test/node_modules/lib.js"):
+            fpath = os.path.join(self.tmp_dir, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(fpath)):
+                os.makedirs(os.path.dirname(fpath))
+            open(fpath, 'w').close()
+        f = open(os.path.join(self.tmp_dir, '.couchappignore'), 'w')
+        json.dump(["glob:node_modules/"], f)
+        f.close()
+        self.doc = doc(self.tmp_dir)
+        self.walked = []
+        check_ignore = self.doc.check_ignore
+        def record(item, isdir=False):
+            self.walked.append(item)
+            return check_ignore(item, isdir)
+        self.doc.check_ignore = record
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def testAttachments(self):
+        names = sorted([name for name, path in self.doc.attachments()])
+        assert names == ["index.html", "js/app.js"]
+        assert "_attachments/node_modules" in self.walked
+        assert "_attachments/node_modules/lib" not in self.walked
+
+    def testFields(self):
+        fields = self.doc.dir_to_fields(manifest=[])
+        assert fields['views'] == {'test': {'map': ''}}
+        assert "views/test/node_modules" in self.walked
+        assert "views/test/node_modules/lib.js" not in self.walked
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from couchapp.journal import PushJournal
+
+DBURI = "http://127.0.0.1:5984/couchapp-test"
+DOCID = "_design/my-app"
+
+class PushJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.signatures = {"index.html": "abc", "style/main.css": "def"}
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def _journal(self):
+        return PushJournal(self.tmp_dir, DBURI, DOCID)
+
+    def testRecord(self):
+        journal = self._journal()
+        journal.start(self.signatures)
+        journal.record("1-a")
+        journal.record("2-b", "index.html")
+
+        journal = self._journal()
+        self.assert_(journal.matches(self.signatures, "2-b"))
+        self.assert_(journal.done == {"index.html": "2-b"})
+
+    def testNoMatch(self):
+        journal = self._journal()
+        journal.start(self.signatures)
+        journal.record("1-a")
+
+        journal = self._journal()
+        self.assertFalse(journal.matches(self.signatures, "2-c"))
+        self.assertFalse(journal.matches(self.signatures, "1-a", "abc"))
+        self.assertFalse(journal.matches({"index.html": "abc"}, "1-a"))
+        self.assertFalse(PushJournal(self.tmp_dir, DBURI,
+                "_design/other").matches(self.signatures, "1-a"))
+
+    def testPartialLine(self):
+        journal = self._journal()
+        journal.start(self.signatures)
+        journal.record("1-a")
+        f = open(journal.path, 'ab')
+        f.write('{"name": "index.h')
+        f.close()
+
+        journal = self._journal()
+        self.assert_(journal.matches(self.signatures, "1-a"))
+        self.assert_(journal.done == {})
+
+    def testClear(self):
+        journal = self._journal()
+        journal.start(self.signatures)
+        journal.clear()
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertFalse(self._journal().matches(self.signatures, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+import couchapp.simplejson as json
+from couchapp.client import EncodedAttachment, encode_doc
+from couchapp.errors import AppError, ResourceConflict, ResourceNotFound
+from couchapp.localdoc import LocalDoc
+from couchapp import util, walker
+
+TESTAPP = os.path.join(os.path.dirname(__file__), 'testapp')
+
+# fields of tests/testapp with the file of each value, the manifest and
+# the attachments, as built before the walk of the folder was rewritten
+TESTAPP_FIELDS = {
+    'foo': {'bar': 'foo/bar.txt'},
+    'lib': {
+        'helpers': {
+            'foo': 'lib/helpers/foo.js',
+            'foo_rec': 'lib/helpers/foo_rec.js',
+            'math': 'lib/helpers/math.js',
+            'template': 'lib/helpers/template.js'
+        },
+        'templates': {'example': 'lib/templates/example.html'}
+    },
+    'lists': {'feed': 'lists/feed.js'},
+    'shows': {'example-show': 'shows/example-show.js'},
+    'views': {
+        'example': {
+            'map': 'views/example/map.js',
+            'reduce': 'views/example/reduce.js'
+        },
+        'wrong': 'views/wrong.js'
+    }
+}
+TESTAPP_MANIFEST = ['foo/', 'foo/bar.txt', 'lib/', 'lib/helpers/',
+    'lib/helpers/foo.js', 'lib/helpers/foo_rec.js', 'lib/helpers/math.js',
+    'lib/helpers/template.js', 'lib/templates/',
+    'lib/templates/example.html', 'lists/', 'lists/feed.js', 'shows/',
+    'shows/example-show.js', 'views/', 'views/example/',
+    'views/example/map.js', 'views/example/reduce.js', 'views/wrong.js']
+TESTAPP_ATTACHMENTS = ['index.html', 'style/main.css']
+
+class FakeDatabase(object):
+    """ database holding one document `olddoc` """
+
+    uri = "http://127.0.0.1:5984/couchapp-test"
+
+    def __init__(self, olddoc=None):
+        self.olddoc = olddoc
+
+    def open_doc(self, docid):
+        if self.olddoc is None:
+            raise ResourceNotFound(docid)
+        return self.olddoc
+
+class AppTestCase(unittest.TestCase):
+    """ copy tests/testapp in a temporary folder """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dir = os.path.join(self.tmp_dir, 'my-app')
+        shutil.copytree(TESTAPP, self.app_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+class AppMetaTests(AppTestCase):
+
+    def testCouchappJson(self):
+        util.write_json(os.path.join(self.app_dir, 'couchapp.json'),
+                        {"name": "test", "signatures": {"a": "b"}})
+        doc = LocalDoc(self.app_dir).doc(with_attachments=False)
+        self.assert_(doc['couchapp']['name'] == "test")
+        self.assert_('a' not in doc['couchapp']['signatures'])
+
+    def testInvalidCouchappJson(self):
+        util.write(os.path.join(self.app_dir, 'couchapp.json'), '{"name": ')
+        localdoc = LocalDoc(self.app_dir)
+        self.assertRaises(AppError, localdoc.doc)
+        # the invalid content isn't cached either
+        self.assertRaises(AppError, LocalDoc(self.app_dir).doc)
+
+class EncodedTests(AppTestCase):
+
+    def testAttachmentsKept(self):
+        # only the JSON of encoded attachments is kept between pushes
+        localdoc = LocalDoc(self.app_dir)
+        doc = json.loads(encode_doc(localdoc.doc()))
+        self.assertEqual(sorted(localdoc._attachments.keys()),
+                         sorted(doc['_attachments'].keys()))
+        for name, attachment in localdoc._attachments.items():
+            self.assert_(isinstance(attachment, EncodedAttachment))
+            content = util.read(os.path.join(self.app_dir, '_attachments',
+                                             name), utf8=False)
+            self.assertEqual(doc['_attachments'][name]['data'],
+                             base64.b64encode(content))
+
+    def testMembersNotCopied(self):
+        # documents of each database only get their own top-level members
+        localdoc = LocalDoc(self.app_dir)
+        doc1 = localdoc.doc()
+        doc2 = localdoc.doc_for({'_rev': '1-abc'})
+        self.assert_(doc1['views'] is doc2['views'])
+        self.assert_(doc1._body is doc2._body)
+        self.assertEqual(doc2['_rev'], '1-abc')
+        self.assert_('_rev' not in doc1)
+        doc1['views'] = {}
+        self.assert_(doc2['views'])
+        doc3 = json.loads(encode_doc(localdoc.doc_for({})))
+        self.assert_(doc3['views'])
+        self.assertEqual(sorted(doc3['_attachments'].keys()), 
+                         sorted(doc1['_attachments'].keys()))
+
+class WalkTests(AppTestCase):
+
+    def _fields(self, files):
+        # replace each file of `files` by its content
+        fields = {}
+        for name, value in files.items():
+            if isinstance(value, dict):
+                fields[name] = self._fields(value)
+            else:
+                fields[name] = util.read(os.path.join(self.app_dir, value))
+        return fields
+
+    def _build(self):
+        localdoc = LocalDoc(self.app_dir)
+        manifest = []
+        fields = localdoc.dir_to_fields(self.app_dir, manifest=manifest,
+                                        entries=localdoc.walk())
+        attachments = [name for name, path in localdoc.attachments()]
+        return fields, sorted(manifest), sorted(attachments)
+
+    def _write(self, relpath, content=''):
+        path = os.path.join(self.app_dir, *relpath.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        util.write(path, content)
+
+    def testFields(self):
+        fields, manifest, attachments = self._build()
+        self.assertEqual(fields, self._fields(TESTAPP_FIELDS))
+        self.assertEqual(manifest, TESTAPP_MANIFEST)
+        self.assertEqual(attachments, TESTAPP_ATTACHMENTS)
+        # a second build reads the fields cache
+        self.assertEqual(self._build(), (fields, manifest, attachments))
+
+    def testListdirFallback(self):
+        scandir = walker.scandir
+        walker.scandir = None
+        stat = os.stat
+        stats = []
+        def counted_stat(path):
+            stats.append(path)
+            return stat(path)
+        try:
+            fields, manifest, attachments = self._build()
+            os.stat = counted_stat
+            entries = list(walker.walk(self.app_dir))
+            for entry in entries:
+                entry.stat()
+                entry.stat()
+        finally:
+            os.stat = stat
+            walker.scandir = scandir
+        self.assertEqual(fields, self._fields(TESTAPP_FIELDS))
+        self.assertEqual(manifest, TESTAPP_MANIFEST)
+        self.assertEqual(attachments, TESTAPP_ATTACHMENTS)
+        # each file or folder is stat'ed once
+        self.assertEqual(sorted(stats), sorted(set(stats)))
+        for entry in entries:
+            self.assert_(entry.path in stats)
+        if scandir is not None:
+            self.assertEqual([(e.kind, e.name, e.relpath, e.depth)
+                              for e in walker.walk(self.app_dir)],
+                             [(e.kind, e.name, e.relpath, e.depth)
+                              for e in entries])
+
+    def testVendorAndIgnores(self):
+        self._write('vendor/foo/_attachments/js/a.js')
+        self._write('vendor/foo/_attachments/.svn/entries')
+        self._write('vendor/foo/_attachments/ignored/b.js')
+        self._write('vendor/foo/lib/c.js', 'c')
+        self._write('_attachments/.hidden/d.js')
+        self._write('_attachments/ignored/e.js')
+        self._write('lib/ignored/f.js')
+        util.write_json(os.path.join(self.app_dir, '.couchappignore'),
+                        ["^ignored$"])
+        fields, manifest, attachments = self._build()
+        self.assertEqual(attachments, TESTAPP_ATTACHMENTS + 
+                         ['vendor/foo/js/a.js'])
+        self.assertEqual(fields['vendor'], {'foo': {'lib': {'c': 'c'}}})
+        self.assertEqual(fields['lib'], self._fields(TESTAPP_FIELDS['lib']))
+        self.assertEqual(manifest, sorted(TESTAPP_MANIFEST + ['vendor/',
+                'vendor/foo/', 'vendor/foo/lib/', 'vendor/foo/lib/c.js']))
+
+class StubsTests(AppTestCase):
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        util.write(os.path.join(self.app_dir, '_attachments', 'new.txt'), 
+                   'new')
+        signatures = LocalDoc(self.app_dir).doc()['couchapp']['signatures']
+        self.olddoc = {
+            '_id': '_design/my-app',
+            '_rev': '1-abc',
+            'couchapp': {'signatures': {
+                'index.html': signatures['index.html'],
+                'style/main.css': 'changed',
+                # saved without the attachment
+                'new.txt': signatures['new.txt']
+            }},
+            '_attachments': {
+                'index.html': {'stub': True, 'length': 906},
+                'style/main.css': {'stub': True, 'length': 10}
+            }
+        }
+        self.logged = []
+
+    def _doc(self, force=False):
+        localdoc = LocalDoc(self.app_dir)
+        localdoc._log_stubs = lambda *args: self.logged.append(args)
+        return localdoc.doc(FakeDatabase(self.olddoc), force=force)
+
+    def testStubs(self):
+        doc = self._doc()
+        self.assertEqual(doc['_rev'], '1-abc')
+        attachments = doc['_attachments']
+        self.assertEqual(sorted(attachments.keys()), 
+                         ['index.html', 'new.txt', 'style/main.css'])
+        self.assertEqual(attachments['index.html'], {'stub': True})
+        self.assert_(isinstance(attachments['style/main.css'], 
+                                EncodedAttachment))
+        self.assert_(isinstance(attachments['new.txt'], EncodedAttachment))
+        self.assertEqual(self.logged, [(1, 906)])
+        # stubs don't change the signatures sent
+        self.assertEqual(doc['couchapp']['signatures'], 
+                         LocalDoc(self.app_dir).doc()['couchapp']['signatures'])
+
+    def testForce(self):
+        doc = self._doc(force=True)
+        for attachment in doc['_attachments'].values():
+            self.assert_(isinstance(attachment, EncodedAttachment))
+        self.assertEqual(self.logged, [])
+
+    def testNoDoc(self):
+        self.olddoc = None
+        doc = self._doc()
+        self.assert_('_rev' not in doc)
+        self.assertEqual(len(doc['_attachments']), 3)
+        self.assertEqual(self.logged, [])
+
+class NoatomicDatabase(FakeDatabase):
+    """ database recording requests of a noatomic push. Each update
+    creates the revision "<n>-x". `conflicts` attachments names are
+    updated by someone else just before they are sent, the push is
+    interrupted when the attachment `interrupt` is sent. """
+
+    def __init__(self, olddoc, conflicts=(), interrupt=None):
+        FakeDatabase.__init__(self, olddoc)
+        self.rev = int(olddoc['_rev'].split('-')[0])
+        self.conflicts = list(conflicts)
+        self.interrupt = interrupt
+        self.requests = []
+
+    def _update(self):
+        self.rev += 1
+        return "%s-x" % self.rev
+
+    def save_doc(self, doc, force_update=False, **params):
+        self.requests.append(('save', doc.get('_rev'), 
+                              sorted(doc['_attachments'].keys())))
+        doc['_rev'] = self._update()
+        self.olddoc = json.loads(encode_doc(doc))
+        return doc
+
+    def put_attachment(self, doc, content=None, name=None, headers=None):
+        self.requests.append(('put', name, doc['_rev']))
+        if name in self.conflicts:
+            self.conflicts.remove(name)
+            self._update()
+        if doc['_rev'] != "%s-x" % self.rev:
+            raise ResourceConflict("conflict")
+        if name == self.interrupt:
+            raise IOError("interrupted")
+        content.read()
+        doc['_rev'] = self._update()
+        self.olddoc['_rev'] = doc['_rev']
+        self.olddoc['_attachments'][name] = {'stub': True}
+        return doc
+
+    def delete_attachment(self, doc, name):
+        self.requests.append(('delete', name, doc['_rev']))
+
+    def last_rev(self, docid):
+        self.requests.append(('last_rev', docid))
+        return "%s-x" % self.rev
+
+class NoatomicTests(AppTestCase):
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        util.write(os.path.join(self.app_dir, '_attachments', 'new.txt'), 
+                   'new')
+        signatures = LocalDoc(self.app_dir).doc()['couchapp']['signatures']
+        self.olddoc = {
+            '_id': '_design/my-app',
+            '_rev': '1-x',
+            'couchapp': {'signatures': {
+                'index.html': signatures['index.html'],
+                'style/main.css': 'changed',
+                'removed.txt': 'removed'
+            }},
+            '_attachments': {
+                'index.html': {'stub': True},
+                'style/main.css': {'stub': True},
+                'removed.txt': {'stub': True},
+                # not pushed by couchapp
+                'other.txt': {'stub': True}
+            }
+        }
+
+    def testRevisions(self):
+        db = NoatomicDatabase(self.olddoc)
+        doc = LocalDoc(self.app_dir).push_noatomic(db)
+        # removed and changed attachments are dropped by the save
+        self.assertEqual(db.requests[0], 
+                         ('save', '1-x', ['index.html', 'other.txt']))
+        puts = db.requests[1:]
+        self.assertEqual(sorted([name for kind, name, rev in puts]), 
+                         ['new.txt', 'style/main.css'])
+        # each attachment is sent with the revision of the previous request
+        self.assertEqual([rev for kind, name, rev in puts], ['2-x', '3-x'])
+        self.assertEqual(doc['_rev'], '4-x')
+
+    def testConflictRetry(self):
+        db = NoatomicDatabase(self.olddoc, conflicts=['new.txt'])
+        doc = LocalDoc(self.app_dir).push_noatomic(db)
+        self.assert_(('last_rev', '_design/my-app') in db.requests)
+        puts = [request for request in db.requests if request[0] == 'put']
+        self.assertEqual(len(puts), 3)
+        self.assertEqual(sorted([name for kind, name, rev in puts]), 
+                         ['new.txt', 'new.txt', 'style/main.css'])
+        self.assertEqual(doc['_rev'], '%s-x' % db.rev)
+        self.assertEqual([r for r in db.requests if r[0] == 'delete'], [])
+
+    def testSecondConflict(self):
+        db = NoatomicDatabase(self.olddoc, conflicts=['new.txt', 'new.txt'])
+        self.assertRaises(ResourceConflict, 
+                          LocalDoc(self.app_dir).push_noatomic, db)
+
+    def _interrupted(self):
+        # style/main.css is sent, the push stops at new.txt
+        db = NoatomicDatabase(self.olddoc, interrupt='new.txt')
+        self.assertRaises(IOError, LocalDoc(self.app_dir).push_noatomic, db)
+        db.interrupt = None
+        db.requests = []
+        return db
+
+    def testResume(self):
+        db = self._interrupted()
+        doc = LocalDoc(self.app_dir).push_noatomic(db, resume=True)
+        # the document isn't saved again, style/main.css isn't sent again
+        self.assertEqual(db.requests, [('put', 'new.txt', '3-x')])
+        self.assertEqual(doc['_rev'], '4-x')
+
+    def testResumeChangedField(self):
+        db = self._interrupted()
+        map_js = "function(doc) { emit(doc._id, 1); }"
+        util.write(os.path.join(self.app_dir, 'views', 'example', 'map.js'),
+                   map_js)
+        LocalDoc(self.app_dir).push_noatomic(db, resume=True)
+        # the push starts again, the new field reaches the server
+        self.assertEqual(db.requests[0][0], 'save')
+        self.assertEqual(db.olddoc['views']['example']['map'], map_js)
+        self.assertEqual(sorted(db.olddoc['_attachments'].keys()), 
+                ['index.html', 'new.txt', 'other.txt', 'style/main.css'])
+
+if __name__ == '__main__':
+    unittest.main()
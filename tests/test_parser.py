@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+import socket
+import unittest
+import zlib
+
+from couchapp.restkit.errors import ParserError, UnexpectedEOF
+from couchapp.restkit.parser import Parser
+from couchapp.restkit.tee import StreamInput, DecompressInput
+from couchapp.restkit.util import gzip_compress
+
+HEADERS = "HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n%s\r\n"
+
+def chunked(body, size):
+    chunks = []
+    for i in range(0, len(body), size):
+        chunk = body[i:i + size]
+        chunks.append("%x;ext=1\r\n%s\r\n" % (len(chunk), chunk))
+    return "".join(chunks) + "0\r\nX-Trailer: 1\r\n\r\n"
+
+def parse(data, step):
+    """ feed `data` to a parser `step` bytes at a time, return the
+    parser and the body """
+    p = Parser.parse_response()
+    body = []
+    for i in range(0, len(data), step):
+        p.feed(data[i:i + step])
+        if p.parse_headers():
+            body.append(p.read_body())
+    return p, "".join(body)
+
+class ParserTests(unittest.TestCase):
+
+    def testHeaders(self):
+        p = Parser.parse_response()
+        p.feed("HTTP/1.1 201 Created\r\nLocation: /db/doc\r\n")
+        self.assertFalse(p.parse_headers())
+        p.feed("X-Folded: a\r\n b\r\nContent-Length: 2\r\n\r\n{}")
+        self.assert_(p.parse_headers())
+        self.assertEqual(p.status_int, 201)
+        self.assertEqual(p.version, (1, 1))
+        self.assertEqual(p.headers_dict['Location'], '/db/doc')
+        self.assertEqual(p.headers_dict['X-Folded'], 'ab')
+        self.assertEqual(p.read_body(), '{}')
+        self.assert_(p.body_eof())
+
+    def testContentLength(self):
+        body = "x" * 100000
+        data = HEADERS % ("Content-Length: %s\r\n" % len(body)) + body + \
+                "HTTP/1.1"
+        for step in (1, 7, 4096, len(data)):
+            p, result = parse(data, step)
+            self.assertEqual(result, body)
+            self.assert_(p.body_eof())
+            # the next response isn't part of the body
+            self.assertEqual(p.buffered, len("HTTP/1.1"))
+
+    def testChunked(self):
+        body = "".join([chr(i % 256) for i in range(100000)])
+        data = HEADERS % "Transfer-Encoding: chunked\r\n" + \
+                chunked(body, 1000)
+        for step in (1, 3, 1002, 4096, len(data)):
+            p, result = parse(data, step)
+            self.assertEqual(result, body)
+            self.assert_(p.body_eof())
+            # trailers are consumed, the connection can be reused
+            self.assertEqual(p.buffered, 0)
+
+    def testChunkedEofAfterTrailers(self):
+        data = HEADERS % "Transfer-Encoding: chunked\r\n" + chunked("abc", 2)
+        p, result = parse(data[:-2], len(data))
+        self.assertEqual(result, "abc")
+        self.assertFalse(p.body_eof())
+        p.feed("\r\n")
+        self.assertEqual(p.read_body(), "")
+        self.assert_(p.body_eof())
+
+    def testChunkedError(self):
+        p = Parser.parse_response()
+        p.feed(HEADERS % "Transfer-Encoding: chunked\r\n" + "zz\r\nabc")
+        self.assert_(p.parse_headers())
+        self.assertRaises(ParserError, p.read_body)
+
+    def testUntilClose(self):
+        p = Parser.parse_response()
+        p.feed("HTTP/1.0 200 OK\r\n\r\nabc")
+        self.assert_(p.parse_headers())
+        self.assertEqual(p.read_body(), "abc")
+        p.feed("def")
+        self.assertEqual(p.read_body(), "def")
+        self.assertFalse(p.body_eof())
+
+class StreamInputTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.closed = []
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def _stream(self, head, body):
+        """ send a response whose headers and the start of the body
+        `head` are already received, the rest `body` is in the socket """
+        p = Parser.parse_response()
+        p.feed(head)
+        self.assert_(p.parse_headers())
+        self.peer.sendall(body)
+        return StreamInput(self.sock, p,
+                           maybe_close=lambda: self.closed.append(True))
+
+    def testRead(self):
+        body = "line1\nline2\n" + "x" * 100000
+        data = HEADERS % "Transfer-Encoding: chunked\r\n" + \
+                chunked(body, 1000)
+        s = self._stream(data[:100], data[100:])
+        self.assertEqual(s.readline(), "line1\n")
+        self.assertEqual(s.read(3), "lin")
+        self.assertEqual(s.readline(), "e2\n")
+        self.assertEqual(s.read(10), "x" * 10)
+        self.assertFalse(self.closed)
+        self.assertEqual(s.read(), "x" * 99990)
+        # released once the trailers are read
+        self.assertEqual(self.closed, [True])
+        self.assertEqual(s.read(), "")
+        self.assertRaises(IOError, s.seek, 0)
+
+    def testBodyWithHeaders(self):
+        s = self._stream(HEADERS % "Content-Length: 2\r\n" + "{}", "")
+        self.assertEqual(self.closed, [True])
+        self.assertEqual(s.read(), "{}")
+
+    def testUnexpectedEOF(self):
+        s = self._stream(HEADERS % "Content-Length: 10\r\n", "abc")
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertEqual(s.read(3), "abc")
+        self.assertRaises(UnexpectedEOF, s.read)
+        self.assertEqual(self.closed, [True])
+
+class DecompressInputTests(unittest.TestCase):
+
+    body = "".join(["line %s\n" % i for i in range(10000)])
+
+    def testGzip(self):
+        f = DecompressInput(StringIO(gzip_compress(self.body)), 'gzip')
+        self.assertEqual(f.readline(), "line 0\n")
+        self.assertEqual(f.read(7), "line 1\n")
+        self.assertEqual(f.read(), self.body[14:])
+        f.seek(0)
+        self.assertEqual(f.read(), self.body)
+
+    def testDeflate(self):
+        f = DecompressInput(StringIO(zlib.compress(self.body)), 'deflate')
+        self.assertEqual(f.read(), self.body)
+        # raw deflate data, without the zlib header
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = raw.compress(self.body) + raw.flush()
+        f = DecompressInput(StringIO(data), 'deflate')
+        self.assertEqual(list(f), self.body.splitlines(True))
+
+    def testError(self):
+        f = DecompressInput(StringIO("not gzip data"), 'gzip')
+        self.assertRaises(ParserError, f.read)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import socket
+import unittest
+
+from couchapp.restkit import pool
+from couchapp.restkit.pool import ConnectionPool
+
+ADDRESS = ("127.0.0.1", 5984)
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+
+    def _socketpair(self):
+        pair = socket.socketpair()
+        self.sockets.extend(pair)
+        return pair
+
+    def testReuse(self):
+        p = ConnectionPool()
+        self.assert_(p.get(ADDRESS) is None)
+        s, peer = self._socketpair()
+        p.put(ADDRESS, s)
+        self.assert_(p.get(ADDRESS) is s)
+        self.assert_(p.get(("127.0.0.1", 5985)) is None)
+        self.assert_((p.hits, p.misses) == (1, 2))
+
+    def testStale(self):
+        p = ConnectionPool()
+        s, peer = self._socketpair()
+        p.put(ADDRESS, s)
+        # closed by the server while idle
+        peer.close()
+        self.assert_(p.get(ADDRESS) is None)
+
+    def testIdleTimeout(self):
+        p = ConnectionPool(timeout=-1)
+        s, peer = self._socketpair()
+        p.put(ADDRESS, s)
+        self.assert_(p.get(ADDRESS) is None)
+
+    def testMaxConnections(self):
+        p = ConnectionPool(max_connections=1)
+        s1, peer1 = self._socketpair()
+        s2, peer2 = self._socketpair()
+        p.put(ADDRESS, s1)
+        p.put(ADDRESS, s2)
+        self.assert_(p.get(ADDRESS) is s1)
+        self.assert_(p.get(ADDRESS) is None)
+
+    def testShared(self):
+        self.assert_(pool.get_pool() is pool.get_pool())
+        self.assert_(pool.get_pool(max_connections=2) is not pool.get_pool())
+
+if __name__ == '__main__':
+    unittest.main()
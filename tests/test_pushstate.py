@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import tempfile
+import unittest
+from shutil import rmtree
+
+from couchapp.pushstate import PushState, doc_hash
+
+DBURI = "http://127.0.0.1:5984/couchapp-test"
+OTHER_DBURI = "http://127.0.0.1:5984/couchapp-test2"
+
+class PushStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hash = doc_hash({"_id": "doc", "title": "hello"})
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def testUnchanged(self):
+        state = PushState(self.tmp_dir)
+        state.set("doc.json", self.hash, DBURI, "1-a")
+        state.save()
+
+        state = PushState(self.tmp_dir)
+        self.assert_(state.unchanged("doc.json", self.hash, DBURI, "1-a"))
+        # updated on the server
+        self.assertFalse(state.unchanged("doc.json", self.hash, DBURI, "2-b"))
+        # deleted on the server
+        self.assertFalse(state.unchanged("doc.json", self.hash, DBURI, None))
+        # never pushed there
+        self.assertFalse(state.unchanged("doc.json", self.hash, OTHER_DBURI,
+                                         "1-a"))
+
+    def testChanged(self):
+        state = PushState(self.tmp_dir)
+        state.set("doc.json", self.hash, DBURI, "1-a")
+        state.set("doc.json", self.hash, OTHER_DBURI, "1-c")
+        newhash = doc_hash({"_id": "doc", "title": "bye"})
+        self.assertFalse(state.unchanged("doc.json", newhash, DBURI, "1-a"))
+        # revisions of the previous content are forgotten
+        state.set("doc.json", newhash, DBURI, "2-b")
+        self.assertFalse(state.unchanged("doc.json", newhash, OTHER_DBURI,
+                                         "1-c"))
+
+    def testPrune(self):
+        state = PushState(self.tmp_dir)
+        state.set("doc.json", self.hash, DBURI, "1-a")
+        state.set("other.json", self.hash, DBURI, "1-b")
+        state.prune(["other.json"])
+        state.save()
+        state = PushState(self.tmp_dir)
+        self.assert_(state.docs.keys() == ["other.json"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+import socket
+import tempfile
+import threading
+import unittest
+
+from couchapp.restkit import sock
+
+HEADERS = "PUT /db/doc/att HTTP/1.1\r\nContent-Length: 100\r\n\r\n"
+
+class Writes(object):
+    """ socket recording its writes """
+
+    def __init__(self):
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append(data)
+
+def dechunk(data):
+    body = []
+    while True:
+        size, data = data.split("\r\n", 1)
+        size = int(size, 16)
+        if not size:
+            return "".join(body), data
+        body.append(data[:size])
+        data = data[size + 2:]
+
+class SendTests(unittest.TestCase):
+
+    def testSmallBodyWithHeaders(self):
+        s = Writes()
+        sock.send(s, "{}", prefix=HEADERS)
+        self.assertEqual(s.writes, [HEADERS + "{}"])
+        s = Writes()
+        body = "x" * (sock.CHUNK_SIZE + 1)
+        sock.send(s, body, prefix=HEADERS)
+        self.assertEqual(s.writes, [HEADERS, body])
+
+    def testLines(self):
+        s = Writes()
+        lines = ["a" * 10, "", "b" * 10, StringIO("file"), "c" * 10,
+                 "d" * sock.CHUNK_SIZE]
+        sock.sendlines(s, lines, chunked=True, prefix=HEADERS)
+        self.assertEqual(len(s.writes), 4)
+        self.assert_(s.writes[0].startswith(HEADERS))
+        body, rest = dechunk("".join(s.writes)[len(HEADERS):] + "0\r\n\r\n")
+        self.assertEqual(body, "".join([line for line in lines
+                                if isinstance(line, str)]).replace(
+                                "b" * 10, "b" * 10 + "file"))
+        self.assertEqual(rest, "\r\n")
+
+    def testSmallFileWithHeaders(self):
+        s = Writes()
+        sock.sendfile(s, StringIO("{}"), prefix=HEADERS)
+        self.assertEqual(s.writes, [HEADERS + "{}"])
+
+class SendfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.received = []
+        self.reader = threading.Thread(target=self._read)
+        self.reader.start()
+
+    def tearDown(self):
+        self.sock.close()
+        self.reader.join()
+        self.peer.close()
+
+    def _read(self):
+        while True:
+            data = self.peer.recv(65536)
+            if not data:
+                return
+            self.received.append(data)
+
+    def _received(self):
+        self.sock.shutdown(socket.SHUT_WR)
+        self.reader.join()
+        return "".join(self.received)
+
+    def _file(self, size):
+        f = tempfile.TemporaryFile()
+        f.write("".join([chr(i % 256) for i in range(size)]))
+        f.seek(10)
+        return f
+
+    def testRegularFile(self):
+        # sent by sendfile(2) if available
+        self.sock.settimeout(10)
+        f = self._file(1024 * 1024)
+        sock.sendfile(self.sock, f, prefix=HEADERS)
+        f.seek(0)
+        self.assertEqual(self._received(), HEADERS + f.read())
+
+    def testLibcSendfile(self):
+        libc_sendfile = sock._libc_sendfile()
+        if libc_sendfile is None:
+            return
+        self.assertRaises(OSError, libc_sendfile, -1, -1, 0, 10)
+        saved = sock._sendfile
+        sock._sendfile = libc_sendfile
+        try:
+            self.testRegularFile()
+        finally:
+            sock._sendfile = saved
+
+    def testChunked(self):
+        f = self._file(100000)
+        sock.sendfile(self.sock, f, chunked=True, prefix=HEADERS)
+        sock.send_chunk(self.sock, "")
+        data = self._received()
+        self.assert_(data.startswith(HEADERS))
+        f.seek(0)
+        self.assertEqual(dechunk(data[len(HEADERS):]), (f.read(), "\r\n"))
+
+if __name__ == '__main__':
+    unittest.main()
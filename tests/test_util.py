@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from couchapp import util
+
+class ReadAttachmentTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _check(self, size):
+        content = "".join([chr(i % 251) for i in range(size)])
+        fpath = os.path.join(self.tmp_dir, "att-%s" % size)
+        util.write(fpath, content)
+        signature, data = util.read_attachment(fpath)
+        self.assertEqual(signature, hashlib.md5(content).hexdigest())
+        self.assertEqual(data, base64.b64encode(content))
+
+    def testSmallFiles(self):
+        for size in (0, 1, 2, 3, 100, util.ENCODE_BLOCK_SIZE + 1):
+            self._check(size)
+
+    def testMmapThreshold(self):
+        # the big files are memory mapped, not a multiple of 3 or of
+        # the block size either
+        for size in (util.MMAP_THRESHOLD - 1, util.MMAP_THRESHOLD,
+                     util.MMAP_THRESHOLD + 1, 3 * util.MMAP_THRESHOLD + 2):
+            self._check(size)
+
+def counted(items, taken):
+    """ iterate over `items`, recording in `taken` the items consumed """
+    for item in items:
+        taken.append(item)
+        yield item
+
+def slow_double(i):
+    # the first items finish last
+    time.sleep((10 - i) * 0.002)
+    return i * 2
+
+def fail_on(n):
+    def func(i):
+        time.sleep((10 - i) * 0.002)
+        if i >= n:
+            raise ValueError(i)
+        return i
+    return func
+
+class ParallelMapTests(unittest.TestCase):
+
+    def testOrder(self):
+        self.assertEqual(util.parallel_map(slow_double, range(10), 4),
+                         range(0, 20, 2))
+        self.assertEqual(util.parallel_map(slow_double, range(10)),
+                         range(0, 20, 2))
+        self.assertEqual(util.parallel_map(slow_double, [], 4), [])
+
+    def testError(self):
+        # items 3 to 9 fail, the last ones first: the error of the first
+        # item in error is raised
+        try:
+            util.parallel_map(fail_on(3), range(10), 4)
+        except ValueError, e:
+            self.assertEqual(e.args, (3,))
+        else:
+            self.fail("no error raised")
+
+    def testThreadsDone(self):
+        # all calls are done when it returns, even after an error
+        nb_threads = threading.activeCount()
+        called = []
+        def func(i):
+            called.append(i)
+            return fail_on(5)(i)
+        self.assertRaises(ValueError, util.parallel_map, func, range(10), 4)
+        self.assertEqual(sorted(called), range(10))
+        self.assertEqual(threading.activeCount(), nb_threads)
+
+class ParallelImapTests(unittest.TestCase):
+
+    def testOrder(self):
+        self.assertEqual(list(util.parallel_imap(slow_double, range(10), 4)),
+                         range(0, 20, 2))
+        self.assertEqual(list(util.parallel_imap(slow_double, range(10))),
+                         range(0, 20, 2))
+
+    def testError(self):
+        it = util.parallel_imap(fail_on(2), range(5), 3)
+        self.assertEqual(it.next(), 0)
+        self.assertEqual(it.next(), 1)
+        self.assertRaises(ValueError, it.next)
+
+    def testStopEarly(self):
+        # items are only taken when a thread is free
+        taken = []
+        it = util.parallel_imap(slow_double, counted(xrange(100), taken), 3)
+        self.assertEqual(it.next(), 0)
+        it.close()
+        self.assertEqual(taken, [0, 1, 2])
+
+class BatchesTests(unittest.TestCase):
+
+    def testOrder(self):
+        self.assertEqual(list(util.batches(range(7), 3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(util.batches(range(6), 3)),
+                         [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(list(util.batches(range(7), None)), [range(7)])
+        self.assertEqual(list(util.batches([], 3)), [])
+
+    def testError(self):
+        def items():
+            yield 1
+            yield 2
+            raise ValueError("boom")
+        it = util.batches(items(), 2)
+        self.assertEqual(it.next(), [1, 2])
+        self.assertRaises(ValueError, it.next)
+
+    def testStopEarly(self):
+        taken = []
+        it = util.batches(counted(xrange(100), taken), 3)
+        self.assertEqual(it.next(), [0, 1, 2])
+        it.close()
+        self.assertEqual(taken, [0, 1, 2])
+
+class PrefetchTests(unittest.TestCase):
+
+    def testOrder(self):
+        self.assertEqual(list(util.prefetch(xrange(100), 3)), range(100))
+        self.assertEqual(list(util.prefetch([])), [])
+
+    def testError(self):
+        def items():
+            yield 1
+            raise ValueError("boom")
+        it = util.prefetch(items())
+        self.assertEqual(it.next(), 1)
+        self.assertRaises(ValueError, it.next)
+
+    def testStopEarly(self):
+        taken = []
+        it = util.prefetch(counted(xrange(100), taken), 3)
+        self.assertEqual(it.next(), 0)
+        it.close()
+        # the producer gives up once the consumer is gone, with at most
+        # the queued items and the one it was putting taken
+        time.sleep(0.3)
+        self.assert_(len(taken) <= 5)
+        nb_taken = len(taken)
+        time.sleep(0.3)
+        self.assertEqual(len(taken), nb_taken)
+
+if __name__ == '__main__':
+    unittest.main()